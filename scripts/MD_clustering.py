@@ -1,11 +1,78 @@
-import pandas as pd
-import numpy as np
-import copy
 import os
+import argparse
+import numpy as np
+from trajectory import load_universe, frame_numbers, read_ndx
+
 
+def select_atoms(u, select="name CA", ndx=None, group=None):
+    """Atoms to cluster on: an MDAnalysis selection, or a group of a GROMACS index file."""
+    if ndx:
+        groups = read_ndx(ndx)
+        if group not in groups:
+            raise ValueError(f"Group {group} not in {ndx}; available: {', '.join(groups)}")
+        return u.atoms[groups[group]]
+    return u.select_atoms(select)
 
 
-def cluster_trajectory(replica_path):
+def subset_universe(u, atoms, frames):
+    """
+    In-memory universe with only the selected atoms and frames.
+
+    encore copies the whole trajectory into memory before computing the
+    RMSD matrix, so it gets this subset instead of the solvated system.
+    """
+    import MDAnalysis as mda
+    from MDAnalysis.coordinates.memory import MemoryReader
+
+    coordinates = np.empty((len(frames), atoms.n_atoms, 3), dtype=np.float32)
+    for i, frame in enumerate(frames):
+        u.trajectory[frame]
+        coordinates[i] = atoms.positions
+    subset = mda.Merge(atoms)
+    subset.load_new(coordinates, format=MemoryReader)
+    return subset
+
+
+def file_stamps(*paths):
+    """Absolute path, size and modification time of every file, to tell whether a saved result is still current."""
+    stamps = []
+    for path in paths:
+        info = os.stat(path)
+        stamps.append(f"{os.path.abspath(path)}\t{info.st_size}\t{info.st_mtime_ns}")
+    return np.array(stamps)
+
+
+def rmsd_matrix(subset, frames, selection, matrix_file=None, jobs=1, sources=()):
+    """
+    Pairwise RMSD matrix of the subset frames (superimposed on the same atoms), reloaded from matrix_file if
+    it was computed for the same input files (sources, e.g. topology and trajectory), frames and selection,
+    otherwise computed on jobs workers and saved there.
+    """
+    from MDAnalysis.analysis import encore
+    from MDAnalysis.analysis.encore.utils import TriangularMatrix
+
+    stamps = file_stamps(*sources)
+    if matrix_file and os.path.exists(matrix_file):
+        with np.load(matrix_file) as saved:
+            same_inputs = "sources" in saved.files and np.array_equal(saved["sources"], stamps)
+            if same_inputs and np.array_equal(saved["frames"], frames) and str(saved["selection"]) == selection:
+                print(f"Loading RMSD matrix from {matrix_file}")
+                return TriangularMatrix(np.array(saved["elements"]))
+        print(f"⚠️ {matrix_file} was computed for other input files, frames or atoms, recomputing it")
+
+    print(f"Computing the RMSD matrix of {len(frames)} frames on {jobs} workers")
+    matrix = encore.get_distance_matrix(subset, select="all", superimposition_subset="all", n_jobs=jobs)
+    if matrix_file:
+        np.savez(matrix_file, elements=matrix._elements, frames=np.asarray(frames), selection=np.array(selection),
+                 sources=stamps)
+        print(f"RMSD matrix saved to {matrix_file}")
+    return matrix
+
+
+def cluster_trajectory(replica_path, topology="cyp17a1.pdb", trajectory="cyp17a1.xtc", select="name CA", ndx=None,
+                       group=None, start=None, stop=None, step=None, jobs=1, matrix_file=None, preference=-50.0,
+                       damping=0.9, max_iter=500, convergence_iter=50, output="clusters_cyp17a1.xtc",
+                       info="clusters_info.txt"):
     #
     # Calculate the cluster
     #
@@ -17,38 +84,45 @@ def cluster_trajectory(replica_path):
     print()
     print("Start clustering of:", replica_path)
 
+    sources = [os.path.join(replica_path, topology), os.path.join(replica_path, trajectory)]
+    u = load_universe(*sources)
+    frames = frame_numbers(u, start, stop, step)
+    atoms = select_atoms(u, select, ndx, group)
+    selection = f"{ndx}:{group}" if ndx else select
+    print("The sliced trajectory contains", len(frames), "frames of", atoms.n_atoms, "atoms (", selection, ")")
+
+    subset = subset_universe(u, atoms, frames)
+    matrix = rmsd_matrix(subset, frames, selection, matrix_file, jobs, sources)
 
-    u = mda.Universe(replica_path + "/cyp17a1.pdb", replica_path + "/cyp17a1.xtc")
-    print("The sliced trajectory contains",len(u.trajectory),"frames")
-    
-    clustering_method = clm.AffinityPropagationNative(preference=-50.0,
-                                                damping=0.9,
-                                                max_iter=500,
-                                                convergence_iter=50)
-    print ('Clustering begins!')
-    cluster_collection = encore.cluster([u], method=clustering_method)
+    clustering_method = clm.AffinityPropagationNative(preference=preference,
+                                                      damping=damping,
+                                                      max_iter=max_iter,
+                                                      convergence_iter=convergence_iter)
+    print('Clustering begins!')
+    cluster_collection = encore.cluster(None, method=clustering_method, distance_matrix=matrix)
     print(len(cluster_collection.clusters), "clusters have been found.")
 
-    info_path = os.path.join(replica_path, "clusters_info.txt")
-    with mda.Writer(replica_path + "clusters_cyp17a1.xtc", u.atoms.n_atoms) as w, \
+    info_path = os.path.join(replica_path, info)
+    with mda.Writer(os.path.join(replica_path, output), u.atoms.n_atoms) as w, \
          open(info_path, "w") as info_file:
-        
+
         info_file.write("ClusterNumber\tCentroidFrameID\tClusterSize\n")  # Header
 
         for c_count, cluster in enumerate(cluster_collection.clusters):
             cluster_weight = cluster.size
-            centroid_frameID = cluster.centroid
-            centroid_frameNr = 1 + u.trajectory[cluster.centroid].frame
+            # centroids index the sliced trajectory
+            centroid_frameID = frames[cluster.centroid]
+            centroid_frameNr = 1 + u.trajectory[centroid_frameID].frame
             print("Cluster found:", centroid_frameNr)
-                   
-            # Save the centroid
+
+            # Save the centroid (full system)
             u.trajectory[centroid_frameID]
             w.write(u.atoms)
 
             # Write info to file
             info_file.write(f"{c_count + 1}\t{centroid_frameNr}\t{cluster_weight}\n")
-    
-    print("Clustering done!")      
+
+    print("Clustering done!")
     print()
 
     # Print contents of the info file
@@ -57,10 +131,35 @@ def cluster_trajectory(replica_path):
         print(f.read())
 
     print()
-    print()  
+    print()
     return 0
-    
 
-replica_path = "./"
-cluster_trajectory(replica_path)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Affinity Propagation clustering of MD frames on their pairwise RMSD.")
+    parser.add_argument('-d', '--dir', type=str, default="./", help="Replica directory (file names are relative to it)")
+    parser.add_argument('-s', '--top', type=str, default="cyp17a1.pdb", help="Topology file")
+    parser.add_argument('-f', '--traj', type=str, default="cyp17a1.xtc", help="Trajectory file")
+    parser.add_argument('--select', type=str, default="name CA",
+                        help="MDAnalysis selection for the RMSD, e.g. backbone (default: name CA)")
+    parser.add_argument('-n', '--ndx', type=str, default=None,
+                        help="GROMACS index file (e.g. 07_md/index.ndx); use --group instead of --select")
+    parser.add_argument('--group', type=str, default="Backbone", help="Index group used with --ndx")
+    parser.add_argument('--start', type=int, default=None, help="First frame")
+    parser.add_argument('--stop', type=int, default=None, help="Stop before this frame")
+    parser.add_argument('--step', type=int, default=None, help="Use every step-th frame")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Workers for the RMSD matrix (-1: all cores)")
+    parser.add_argument('-m', '--matrix', type=str, default="rmsd_matrix.npz",
+                        help="RMSD matrix file, reused when it matches the topology and trajectory files (path, size, "
+                             "modification time), frames and atoms (relative to --dir)")
+    parser.add_argument('--preference', type=float, default=-50.0)
+    parser.add_argument('--damping', type=float, default=0.9)
+    parser.add_argument('--max_iter', type=int, default=500)
+    parser.add_argument('--convergence_iter', type=int, default=50)
+    parser.add_argument('-o', '--output', type=str, default="clusters_cyp17a1.xtc", help="Centroid trajectory")
+    parser.add_argument('--info', type=str, default="clusters_info.txt", help="Cluster table")
+    args = parser.parse_args()
+
+    cluster_trajectory(args.dir, args.top, args.traj, args.select, args.ndx, args.group, args.start, args.stop,
+                       args.step, args.jobs, os.path.join(args.dir, args.matrix), args.preference, args.damping,
+                       args.max_iter, args.convergence_iter, args.output, args.info)
@@ -0,0 +1,302 @@
+import os
+import time
+import hashlib
+import warnings
+import numpy as np
+from sklearn.cluster import AffinityPropagation
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.utils import check_random_state
+
+# Default memory budget for one block of the sample x exemplar similarities (bytes)
+DEFAULT_MAX_MEMORY = 256 * 1024 ** 2
+# Bump when the way similarities are computed changes, so old cache files are not reused
+CACHE_VERSION = "negsqeuclidean-v1"
+
+
+def similarities(X, Y):
+    """Negative squared euclidean distances between the rows of X and Y (the affinity sklearn uses)."""
+    return -euclidean_distances(np.asarray(X, dtype=float), np.asarray(Y, dtype=float), squared=True)
+
+
+def content_hash(X, batch_rows=4096):
+    """SHA-256 of the matrix values (as float64) and shape, read in blocks of rows."""
+    digest = hashlib.sha256(f"{CACHE_VERSION} {tuple(X.shape)}".encode())
+    for start in range(0, len(X), batch_rows):
+        digest.update(np.ascontiguousarray(X[start:start + batch_rows], dtype="<f8").tobytes())
+    return digest.hexdigest()
+
+
+def fill_similarity(X, out, max_memory=DEFAULT_MAX_MEMORY):
+    """Write the N x N similarity matrix of X into out (an array or memmap) in blocks of rows."""
+    X = np.asarray(X, dtype=float)
+    rows = max(1, int(max_memory // (8 * max(len(X), 1) * 3)))
+    for start in range(0, len(X), rows):
+        out[start:start + rows] = similarities(X[start:start + rows], X)
+    return out
+
+
+def cached_similarity(X, cache_dir=None, max_memory=DEFAULT_MAX_MEMORY):
+    """
+    Similarity matrix of X as float32, stored in cache_dir under the content hash of X.
+
+    A matrix already in the cache is memory-mapped instead of recomputed, so
+    rerunning the clustering on unchanged vectors (e.g. with another
+    preference or damping) skips the distance computation. Without
+    cache_dir the matrix is computed in memory.
+    """
+    if cache_dir is None:
+        return fill_similarity(X, np.empty((len(X), len(X)), dtype=np.float32), max_memory)
+
+    path = os.path.join(cache_dir, content_hash(X) + ".npy")
+    if os.path.exists(path):
+        print(f"Reusing cached similarity matrix {path}")
+        return np.load(path, mmap_mode="r")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name first, so an interrupted run never leaves a partial cache entry
+    partial = f"{path}.{os.getpid()}.part"
+    S = np.lib.format.open_memmap(partial, mode="w+", dtype=np.float32, shape=(len(X), len(X)))
+    fill_similarity(X, S, max_memory)
+    S.flush()
+    del S
+    os.replace(partial, path)
+    print(f"Similarity matrix cached in {path}")
+    return np.load(path, mmap_mode="r")
+
+
+def affinity_propagation(X, cache_dir=None, engine="sklearn", progress=0, **ap_params):
+    """
+    Affinity Propagation on the rows of X.
+
+    With cache_dir the similarity matrix is taken from (or added to) the
+    cache and passed to AP as precomputed float32 affinities (sklearn holds
+    one float32 copy of it next to its three float64 N x N arrays, so use
+    engine="native" for large N). engine="native" runs
+    propagate() (float32, in place) instead of sklearn and prints its
+    progress every `progress` iterations.
+
+    Returns:
+        cluster_centers_indices (array), labels (array)
+    """
+    if engine == "native":
+        S = cached_similarity(X, cache_dir)
+        preference = ap_params.get("preference")
+        centers, labels, n_iter, converged, R, A = propagate(
+            S, np.median(S) if preference is None else preference, ap_params.get("damping", 0.5),
+            ap_params.get("max_iter", 200), ap_params.get("convergence_iter", 15), ap_params.get("random_state"),
+            callback=print_progress(progress) if progress else None, overwrite=cache_dir is None)
+        print(f"Affinity Propagation {'converged' if converged else 'did not converge'} after {n_iter} iterations")
+        return centers, labels
+    if engine != "sklearn":
+        raise ValueError(f"Unknown Affinity Propagation engine: {engine}")
+    if cache_dir is None:
+        clustering = AffinityPropagation(**ap_params).fit(np.asarray(X, dtype=float))
+    else:
+        S = cached_similarity(X, cache_dir)
+        # sklearn copies a precomputed matrix into a writable array of its own dtype, so passing the float32
+        # matrix keeps that copy at 4 bytes per pair; R, A and its temporary are float64 N x N arrays regardless
+        clustering = AffinityPropagation(affinity="precomputed", **ap_params).fit(S)
+    return np.asarray(clustering.cluster_centers_indices_, dtype=int), clustering.labels_
+
+
+def assign_to_exemplars(X, exemplars, max_memory=DEFAULT_MAX_MEMORY):
+    """
+    Label every row of X with the most similar exemplar (an index into exemplars).
+
+    X is read in blocks of rows so it can be a memory-mapped matrix larger
+    than RAM; exemplars are labelled with their own cluster.
+    """
+    exemplars = np.asarray(exemplars)
+    centres = np.asarray(X[exemplars], dtype=float)
+    rows = max(1, int(max_memory // (8 * max(len(exemplars), 1) * 3)))
+    labels = np.empty(len(X), dtype=int)
+    for start in range(0, len(X), rows):
+        labels[start:start + rows] = np.argmax(similarities(X[start:start + rows], centres), axis=1)
+    labels[exemplars] = np.arange(len(exemplars))
+    return labels
+
+
+def block_slices(n_samples, block_rows):
+    """(start, stop) of consecutive row blocks."""
+    return [(start, min(start + block_rows, n_samples)) for start in range(0, n_samples, block_rows)]
+
+
+def propagate(S, preference, damping=0.5, max_iter=200, convergence_iter=15, random_state=0, R=None, A=None,
+              dtype=np.float32, callback=None, max_memory=DEFAULT_MAX_MEMORY, overwrite=False):
+    """
+    Affinity Propagation message passing on a similarity matrix, in place and with optional warm start.
+
+    The updates, the noise added to S and the exemplar refinement are those
+    of sklearn, so the exemplars are the same as with
+    AffinityPropagation(affinity="precomputed"). Only three N x N arrays
+    (S with the preferences, R and A) are allocated, in dtype; every update
+    runs on blocks of rows within max_memory. preference is a scalar or
+    one value per sample. R and A (e.g. from a converged run with a nearby
+    preference) replace the zero initialisation.
+
+    With overwrite=True an in-memory S of dtype receives the preferences
+    and the noise in place, so it serves as the first of the three arrays;
+    otherwise (and always for a memory-mapped S) S is left untouched and
+    copied.
+
+    callback(iteration, n_exemplars, changed_assignments, elapsed_seconds)
+    is called after every iteration.
+
+    Returns:
+        cluster_centers_indices (array), labels (array), n_iter, converged (bool), R, A
+    """
+    n_samples = len(S)
+    ind = np.arange(n_samples)
+    preference = np.broadcast_to(np.asarray(preference, dtype=float), (n_samples,))
+    random_state = check_random_state(random_state)
+    blocks = block_slices(n_samples, max(1, int(max_memory // (8 * max(n_samples, 1)))))
+    start_time = time.perf_counter()
+
+    # S with the preferences on the diagonal and sklearn's noise against degeneracies; the noise is drawn
+    # row block by row block from the same stream, so it equals sklearn's single draw
+    in_place = (overwrite and isinstance(S, np.ndarray) and not isinstance(S, np.memmap) and S.dtype == dtype
+                and S.flags.writeable)
+    work = S if in_place else np.empty((n_samples, n_samples), dtype=dtype)
+    for start, stop in blocks:
+        block = np.array(S[start:stop], dtype=float)
+        block[ind[:stop - start], ind[start:stop]] = preference[start:stop]
+        block += (np.finfo(dtype).eps * block + np.finfo(dtype).tiny * 100) * random_state.standard_normal(
+            size=block.shape)
+        work[start:stop] = block
+    S = work
+
+    R = np.zeros((n_samples, n_samples), dtype=dtype) if R is None else np.array(R, dtype=dtype)
+    A = np.zeros((n_samples, n_samples), dtype=dtype) if A is None else np.array(A, dtype=dtype)
+    e = np.zeros((n_samples, convergence_iter), dtype=bool)
+    assignment = np.full(n_samples, -1)
+    converged = False
+
+    for it in range(max_iter):
+        # responsibilities: R = damping * R + (1 - damping) * (S - max over the other columns of A + S)
+        for start, stop in blocks:
+            rows = ind[:stop - start]
+            s, r = S[start:stop], R[start:stop]
+            tmp = np.add(A[start:stop], s)
+            I = np.argmax(tmp, axis=1)
+            Y = tmp[rows, I]
+            tmp[rows, I] = -np.inf
+            Y2 = np.max(tmp, axis=1)
+            np.subtract(s, Y[:, None], tmp)
+            tmp[rows, I] = s[rows, I] - Y2
+            tmp *= 1 - damping
+            r *= damping
+            r += tmp
+
+        # availabilities: column sums of the positive responsibilities (the diagonal kept as is) first
+        R_diag = R[ind, ind].copy()
+        column_sums = np.zeros(n_samples)
+        for start, stop in blocks:
+            tmp = np.maximum(R[start:stop], 0)
+            tmp[ind[:stop - start], ind[start:stop]] = R_diag[start:stop]
+            column_sums += tmp.sum(axis=0, dtype=float)
+
+        changed = 0
+        for start, stop in blocks:
+            rows, cols = ind[:stop - start], ind[start:stop]
+            a = A[start:stop]
+            tmp = np.maximum(R[start:stop], 0)
+            tmp[rows, cols] = R_diag[start:stop]
+            tmp -= column_sums.astype(dtype)
+            dA = tmp[rows, cols].copy()
+            np.clip(tmp, 0, np.inf, out=tmp)
+            tmp[rows, cols] = dA
+            tmp *= 1 - damping
+            a *= damping
+            a -= tmp
+            if callback is not None:
+                # current decision of every sample: argmax over k of A + R
+                np.add(a, R[start:stop], out=tmp)
+                new = np.argmax(tmp, axis=1)
+                changed += int(np.count_nonzero(new != assignment[start:stop]))
+                assignment[start:stop] = new
+
+        # exemplars unchanged for convergence_iter iterations
+        E = (A[ind, ind] + R_diag) > 0
+        e[:, it % convergence_iter] = E
+        K = np.sum(E, axis=0)
+        if callback is not None:
+            callback(it + 1, int(K), changed, time.perf_counter() - start_time)
+        if it >= convergence_iter:
+            se = np.sum(e, axis=1)
+            if np.sum((se == convergence_iter) + (se == 0)) == n_samples and K > 0:
+                converged = True
+                break
+
+    I = np.flatnonzero(E)
+    K = I.size
+    if K == 0:
+        warnings.warn("Affinity propagation did not converge and this model will not have any cluster centers.",
+                      ConvergenceWarning)
+        return np.array([], dtype=int), np.full(n_samples, -1), it + 1, False, R, A
+    if not converged:
+        warnings.warn("Affinity propagation did not converge, this model may return degenerate cluster centers "
+                      "and labels.", ConvergenceWarning)
+
+    # Refine the exemplars: the member with the highest summed similarity to its cluster
+    c = np.argmax(S[:, I], axis=1)
+    c[I] = np.arange(K)
+    for k in range(K):
+        ii = np.flatnonzero(c == k)
+        I[k] = ii[np.argmax(np.sum(S[ii[:, None], ii], axis=0, dtype=float))]
+    c = np.argmax(S[:, I], axis=1)
+    c[I] = np.arange(K)
+    labels = I[c]
+    cluster_centers_indices = np.unique(labels)
+    return cluster_centers_indices, np.searchsorted(cluster_centers_indices, labels), it + 1, converged, R, A
+
+
+def print_progress(every=10):
+    """Progress callback for propagate() that prints every few iterations."""
+    def report(iteration, n_exemplars, changed, elapsed):
+        if iteration % every == 0 or iteration == 1:
+            print(f"  iteration {iteration}: {n_exemplars} exemplars, {changed} changed assignments, {elapsed:.1f} s")
+    return report
+
+
+def net_similarity(S, cluster_centers_indices, labels, preference):
+    """AP objective: similarity of every sample to its exemplar plus the preferences of the exemplars."""
+    if len(cluster_centers_indices) == 0:
+        return float("nan")
+    exemplar = np.asarray(cluster_centers_indices)[labels]
+    members = np.flatnonzero(exemplar != np.arange(len(labels)))
+    preference = np.broadcast_to(np.asarray(preference, dtype=float), (len(labels),))
+    return float(np.sum(S[members, exemplar[members]], dtype=float) + preference[cluster_centers_indices].sum())
+
+
+def landmark_indices(n_samples, n_landmarks, seed=0):
+    """Sorted random subset of n_landmarks sample indices (all samples if n_landmarks >= n_samples)."""
+    if n_landmarks is None or n_landmarks >= n_samples:
+        return np.arange(n_samples)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n_samples, size=n_landmarks, replace=False))
+
+
+def landmark_affinity_propagation(X, n_landmarks, seed=0, max_memory=DEFAULT_MAX_MEMORY, cache_dir=None,
+                                  **ap_params):
+    """
+    Affinity Propagation on a subset of landmark samples, then out-of-sample assignment.
+
+    The N x N matrices of AP are only built for the landmarks; every other
+    sample joins the exemplar it is most similar to, the same rule AP uses
+    for its own labels. With n_landmarks >= N this is plain AP.
+
+    Returns:
+        cluster_centers_indices (array of indices into X), labels (array)
+    """
+    landmarks = landmark_indices(len(X), n_landmarks, seed)
+    sample = X if len(landmarks) == len(X) else np.asarray(X[landmarks], dtype=float)
+    centers, labels = affinity_propagation(sample, cache_dir, **ap_params)
+
+    if len(centers) == 0:
+        return centers, np.full(len(X), -1)
+    if len(landmarks) == len(X):
+        return centers, labels
+
+    exemplars = landmarks[centers]
+    return exemplars, assign_to_exemplars(X, exemplars, max_memory)
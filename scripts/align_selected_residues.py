@@ -1,14 +1,77 @@
 #!/usr/bin/env python3
 
-import sys
-from pymol import cmd
-from pymol import finish_launching
+import argparse
+import numpy as np
+from alignment import BACKBONE, read_pdb, write_pdb, select, match_atoms, fit, transform
+from trajectory import load_universe, frame_numbers, universe_structure, write_transformed
 
 def parse_ranges(ranges_str):
     """Parses input like '150-167,242-273' into a list of (start, end) tuples"""
     return [tuple(map(int, part.strip().split('-'))) for part in ranges_str.split(',')]
 
+def align_numpy(ref_pdb, mobile_pdb, output_pdb, residue_ranges, cycles=5, cutoff=2.0):
+    """
+    Superpose the mobile structure on the reference using the backbone atoms of the selected residues.
+
+    Atoms are paired by residue number and name and fitted with the same
+    outlier rejection as PyMOL's align (cycles, cutoff in RMSD units).
+    Returns the RMSD over the atoms kept in the last cycle.
+    """
+    ref = read_pdb(ref_pdb)
+    mobile = read_pdb(mobile_pdb)
+    ref_atoms, mobile_atoms = match_atoms(ref, select(ref, name=BACKBONE, residue_ranges=residue_ranges),
+                                          mobile, select(mobile, name=BACKBONE, residue_ranges=residue_ranges))
+    if len(ref_atoms) < 3:
+        raise ValueError(f"Only {len(ref_atoms)} matching backbone atoms in the selected residues")
+
+    R, t, rms, used = fit(mobile["coords"][mobile_atoms], ref["coords"][ref_atoms], cycles, cutoff)
+    write_pdb(output_pdb, mobile, transform(mobile["coords"], R, t))
+    return float(rms)
+
+def trajectory_fits(ref, universe, frames, residue_ranges, cycles=5, cutoff=2.0, batch_frames=1024):
+    """
+    Rotation and translation that superpose every frame on the reference structure, as in align_numpy().
+
+    ref is a structure from read_pdb() or trajectory.universe_structure().
+    Only the fitted backbone atoms are read from each frame, and the frames
+    are fitted batch_frames at a time in one batched operation.
+    Returns R (F, 3, 3), t (F, 3) and the RMSD of every frame.
+    """
+    topology = universe_structure(universe)
+    ref_atoms, mobile_atoms = match_atoms(ref, select(ref, name=BACKBONE, residue_ranges=residue_ranges),
+                                          topology, select(topology, name=BACKBONE, residue_ranges=residue_ranges))
+    if len(ref_atoms) < 3:
+        raise ValueError(f"Only {len(ref_atoms)} matching backbone atoms in the selected residues")
+
+    R = np.empty((len(frames), 3, 3))
+    t = np.empty((len(frames), 3))
+    rms = np.empty(len(frames))
+    for start in range(0, len(frames), batch_frames):
+        batch = frames[start:start + batch_frames]
+        coords = np.empty((len(batch), len(mobile_atoms), 3), dtype=np.float32)
+        for i, frame in enumerate(batch):
+            coords[i] = universe.trajectory[frame].positions[mobile_atoms]
+        stop = start + len(batch)
+        R[start:stop], t[start:stop], rms[start:stop], used = fit(coords, ref["coords"][ref_atoms], cycles, cutoff)
+    return R, t, rms
+
+def align_trajectory(ref_pdb, topology, trajectory, residue_ranges, output, start=None, stop=None, step=None,
+                     rmsd_file=None):
+    """Write the trajectory (every atom) superposed on the reference, in one process; the format follows the output extension."""
+    universe = load_universe(topology, trajectory)
+    frames = frame_numbers(universe, start, stop, step)
+    R, t, rms = trajectory_fits(read_pdb(ref_pdb), universe, frames, residue_ranges)
+    write_transformed(universe, frames, R, t, output)
+    if rmsd_file:
+        with open(rmsd_file, "w") as f:
+            f.writelines(f"{frame} {value:.4f}\n" for frame, value in zip(frames, rms))
+    print(f"✅ Aligned {len(frames)} frames to {output} (RMSD mean {rms.mean():.3f}, max {rms.max():.3f})")
+    return rms
+
 def align_custom(ref_pdb, mobile_pdb, output_pdb, residue_ranges, ref_name="ref", mobile_name="mobile"):
+    from pymol import cmd
+    from pymol import finish_launching
+
     # Start PyMOL without GUI
     finish_launching(['pymol', '-cq'])
 
@@ -33,15 +96,30 @@ def align_custom(ref_pdb, mobile_pdb, output_pdb, residue_ranges, ref_name="ref"
     cmd.quit()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 5:
-        print("Usage: python3 align_structures.py ref.pdb mobile.pdb '150-167,242-273,401-412,304-317' output_aligned.pdb")
-        sys.exit(1)
-
-    ref_pdb = sys.argv[1]
-    mobile_pdb = sys.argv[2]
-    ranges_str = sys.argv[3]
-    output_pdb = sys.argv[4]
-
-    ranges = parse_ranges(ranges_str)
-    align_custom(ref_pdb, mobile_pdb, output_pdb, ranges)
+    parser = argparse.ArgumentParser(
+        description="Align a structure to a reference on the backbone of selected residues.",
+        usage="python3 align_selected_residues.py ref.pdb mobile.pdb '150-167,242-273,401-412,304-317' output_aligned.pdb")
+    parser.add_argument("ref_pdb", help="Reference PDB file")
+    parser.add_argument("mobile_pdb", help="PDB file to align (the topology, e.g. md_final.gro, with --traj)")
+    parser.add_argument("ranges", help="Residue ranges, e.g. '150-167,242-273'")
+    parser.add_argument("output_pdb", help="Aligned output PDB file (aligned trajectory, e.g. .xtc, with --traj)")
+    parser.add_argument("--backend", choices=["numpy", "pymol"], default="numpy",
+                        help="Align with NumPy (default) or with PyMOL (reference)")
+    parser.add_argument("-t", "--traj", type=str, default=None,
+                        help="Align every frame of this trajectory (e.g. XTC) in one run instead of one PDB")
+    parser.add_argument("--start", type=int, default=None, help="First frame for --traj")
+    parser.add_argument("--stop", type=int, default=None, help="Last frame (exclusive) for --traj")
+    parser.add_argument("--step", type=int, default=None, help="Frame stride for --traj")
+    parser.add_argument("--rmsd", type=str, default=None, help="Optional output file with the RMSD of every frame (--traj)")
+    args = parser.parse_args()
+    if args.traj and args.backend != "numpy":
+        parser.error("--traj requires the numpy backend")
 
+    ranges = parse_ranges(args.ranges)
+    if args.traj:
+        align_trajectory(args.ref_pdb, args.mobile_pdb, args.traj, ranges, args.output_pdb, args.start, args.stop,
+                         args.step, args.rmsd)
+    elif args.backend == "numpy":
+        align_numpy(args.ref_pdb, args.mobile_pdb, args.output_pdb, ranges)
+    else:
+        align_custom(args.ref_pdb, args.mobile_pdb, args.output_pdb, ranges)
@@ -0,0 +1,335 @@
+import fnmatch
+import numpy as np
+
+BACKBONE = ("N", "CA", "C", "O")
+
+# CE constants, as in PyMOL's cealign
+CE_D0 = 3.0
+CE_D1 = 4.0
+CE_WINDOW = 8
+CE_GAP_MAX = 30
+CE_MAX_KEPT = 20
+
+
+def read_pdb(path):
+    """
+    Read the ATOM/HETATM records of a PDB (or PQR) file.
+
+    Returns a dict with the file lines (kept to write the structure back)
+    and, per atom, the line number, record, name, residue name, residue
+    number, chain and coordinates as arrays.
+    """
+    with open(path, "r") as f:
+        lines = f.readlines()
+    rows, records, names, resnames, resids, chains, coords = [], [], [], [], [], [], []
+    for row, line in enumerate(lines):
+        if not (line.startswith("ATOM") or line.startswith("HETATM")):
+            continue
+        rows.append(row)
+        records.append(line[:6].strip())
+        names.append(line[12:16].strip().upper())
+        resnames.append(line[17:21].strip().upper())
+        resids.append(int(line[22:26]))
+        chains.append(line[21:22].strip())
+        coords.append([float(line[30:38]), float(line[38:46]), float(line[46:54])])
+    return {"lines": lines,
+            "rows": np.array(rows, dtype=int),
+            "records": np.array(records),
+            "names": np.array(names),
+            "resnames": np.array(resnames),
+            "resids": np.array(resids, dtype=int),
+            "chains": np.array(chains),
+            "coords": np.array(coords, dtype=float).reshape(-1, 3)}
+
+
+def write_pdb(path, structure, coords=None):
+    """Write the structure with new coordinates; every other column of the input lines is kept."""
+    coords = structure["coords"] if coords is None else coords
+    lines = list(structure["lines"])
+    for row, (x, y, z) in zip(structure["rows"], coords):
+        line = lines[row].rstrip("\n").ljust(54)
+        lines[row] = f"{line[:30]}{x:8.3f}{y:8.3f}{z:8.3f}{line[54:]}\n"
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def select(structure, resn=None, name=None, residue_ranges=None, record=None):
+    """
+    Indices of the atoms that match every given criterion.
+
+    resn and name are case-insensitive patterns (HEM* matches HEM and HEMO)
+    or lists of them; residue_ranges is a list of inclusive (start, end)
+    residue numbers, as returned by align_selected_residues.parse_ranges().
+    """
+    keep = np.ones(len(structure["names"]), dtype=bool)
+    for field, patterns in (("resnames", resn), ("names", name), ("records", record)):
+        if patterns is None:
+            continue
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        values = structure[field]
+        match = np.zeros(len(values), dtype=bool)
+        for pattern in patterns:
+            match |= np.array([fnmatch.fnmatchcase(v, pattern.upper()) for v in values], dtype=bool)
+        keep &= match
+    if residue_ranges is not None:
+        resids = structure["resids"]
+        in_range = np.zeros(len(resids), dtype=bool)
+        for start, end in residue_ranges:
+            in_range |= (resids >= start) & (resids <= end)
+        keep &= in_range
+    return np.flatnonzero(keep)
+
+
+def match_atoms(structure_a, indices_a, structure_b, indices_b):
+    """Pairs of atoms with the same residue number and atom name (first occurrence), in the order of structure_a."""
+    position = {}
+    for i in indices_b:
+        position.setdefault((structure_b["resids"][i], structure_b["names"][i]), i)
+    pairs = [(i, position[(structure_a["resids"][i], structure_a["names"][i])]) for i in indices_a
+             if (structure_a["resids"][i], structure_a["names"][i]) in position]
+    pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def kabsch(mobile, target, weights=None):
+    """
+    Least-squares superposition of matched coordinates (Kabsch).
+
+    mobile and target are (..., N, 3) arrays; leading dimensions are
+    batched, so all frames of a trajectory are fitted in one call.
+    weights (..., N) restricts or weights the atoms used in each fit.
+    Returns R (..., 3, 3) and t (..., 3) with mobile @ R.T + t ~ target.
+    """
+    mobile = np.asarray(mobile, dtype=float)
+    target = np.asarray(target, dtype=float)
+    if weights is None:
+        weights = np.ones(mobile.shape[:-1])
+    weights = np.asarray(weights, dtype=float)[..., None]
+    total = weights.sum(axis=-2)
+    mobile_centre = (weights * mobile).sum(axis=-2) / total
+    target_centre = (weights * target).sum(axis=-2) / total
+    covariance = np.swapaxes(weights * (mobile - mobile_centre[..., None, :]), -1, -2) @ \
+        (target - target_centre[..., None, :])
+    U, _, Vt = np.linalg.svd(covariance)
+    V = np.swapaxes(Vt, -1, -2)
+    # flip the last axis where the best orthogonal fit would be a reflection
+    sign = np.sign(np.linalg.det(V @ np.swapaxes(U, -1, -2)))
+    sign = np.where(sign == 0, 1.0, sign)
+    V[..., :, 2] *= sign[..., None]
+    R = V @ np.swapaxes(U, -1, -2)
+    t = target_centre - np.einsum('...ij,...j->...i', R, mobile_centre)
+    return R, t
+
+
+def transform(coords, R, t):
+    """Apply x -> R x + t to (..., N, 3) coordinates."""
+    return np.asarray(coords) @ np.swapaxes(R, -1, -2) + np.asarray(t)[..., None, :]
+
+
+def rmsd(a, b):
+    """RMSD of matched coordinates, over the last two axes."""
+    return np.sqrt(((np.asarray(a) - np.asarray(b)) ** 2).sum(axis=-1).mean(axis=-1))
+
+
+def fit(mobile, target, cycles=5, cutoff=2.0):
+    """
+    Superpose matched atoms with outlier rejection, like PyMOL's align.
+
+    After every fit, pairs that deviate by more than cutoff times the RMSD
+    are dropped and the rest fitted again, for up to cycles rounds (while
+    more than 3 pairs remain and the set changes). mobile may hold a batch
+    of frames (F, N, 3); each frame drops its own outliers.
+    Returns R, t, the final RMSD and the mask of the pairs used.
+    """
+    mobile = np.asarray(mobile, dtype=float)
+    target = np.broadcast_to(np.asarray(target, dtype=float), mobile.shape)
+    batch = mobile.reshape(-1, *mobile.shape[-2:])
+    target_batch = target.reshape(batch.shape)
+    used = np.ones(batch.shape[:-1], dtype=bool)
+    R, t = kabsch(batch, target_batch)
+    deviation = np.linalg.norm(transform(batch, R, t) - target_batch, axis=-1)
+    rms = np.sqrt((deviation ** 2).mean(axis=-1))
+    active = np.ones(len(batch), dtype=bool)
+    for _ in range(cycles):
+        keep = used & (deviation <= cutoff * rms[:, None])
+        n_keep = keep.sum(axis=-1)
+        active &= (rms >= 1e-4) & (n_keep < used.sum(axis=-1)) & (n_keep > 3)
+        if not active.any():
+            break
+        used[active] = keep[active]
+        R[active], t[active] = kabsch(batch[active], target_batch[active], used[active])
+        deviation[active] = np.linalg.norm(transform(batch[active], R[active], t[active]) - target_batch[active],
+                                           axis=-1)
+        rms[active] = np.sqrt((deviation[active] ** 2 * used[active]).sum(axis=-1) / used[active].sum(axis=-1))
+    shape = mobile.shape[:-2]
+    return R.reshape(*shape, 3, 3), t.reshape(*shape, 3), rms.reshape(shape), used.reshape(mobile.shape[:-1])
+
+
+def rotation_matrix(axis, angle_degree):
+    """Rotation by angle_degree about axis (right-handed), like PyMOL's rotate."""
+    axis = np.asarray(axis, dtype=float)
+    axis = axis / np.linalg.norm(axis)
+    angle = np.deg2rad(angle_degree)
+    x, y, z = axis
+    K = np.array([[0.0, -z, y], [z, 0.0, -x], [-y, x, 0.0]])
+    return np.eye(3) + np.sin(angle) * K + (1.0 - np.cos(angle)) * (K @ K)
+
+
+def ce_similarity(dA, dB, window=CE_WINDOW):
+    """
+    CE similarity of every pair of fragments of window residues (lower is better).
+
+    S[i, j] is the mean absolute difference of the intra-fragment distances
+    of A[i:i + window] and B[j:j + window] (neighbouring residues skipped);
+    -1 where a fragment would run past the end of a chain.
+    """
+    lenA, lenB = len(dA), len(dB)
+    S = np.full((lenA, lenB), -1.0)
+    nA, nB = lenA - window + 1, lenB - window + 1
+    if nA <= 0 or nB <= 0:
+        return S
+    score = np.zeros((nA, nB))
+    for row in range(window - 2):
+        for col in range(row + 2, window):
+            a = np.diagonal(dA, col - row)[row:row + nA]
+            b = np.diagonal(dB, col - row)[row:row + nB]
+            score += np.abs(a[:, None] - b[None, :])
+    S[:nA, :nB] = score / ((window - 1) * (window - 2) / 2)
+    return S
+
+
+def ce_paths(S, dA, dB, window=CE_WINDOW, gap_max=CE_GAP_MAX, d0=CE_D0, d1=CE_D1):
+    """
+    Combinatorial extension of aligned fragment pairs (AFPs).
+
+    A port of the path search in PyMOL's cealign: from every well-matching
+    AFP, the path is extended by the best next AFP within gap_max residues
+    while the fragment distance scores stay below d0 / d1. Returns the last
+    CE_MAX_KEPT improvements of the best path, each as a (k, 2) array of
+    AFP start residues in A and B.
+    """
+    lenA, lenB = len(dA), len(dB)
+    smaller = min(lenA, lenB)
+    win_sum = (window - 1) * (window - 2) // 2
+    win_cache = [(i + 1) * i * window / 2 + (i + 1) * win_sum for i in range(smaller + 1)]
+
+    # candidate next AFPs in PyMOL's order: no gap, then gaps of 1, 2, ... alternately in A and B,
+    # as offsets into S padded with -1 so candidates past the end of a chain drop out with the bad ones
+    g = np.arange(2 * gap_max + 1)
+    step = (g + 1) // 2
+    gap_a = np.where((g + 1) % 2 == 0, step, 0) + window
+    gap_b = np.where((g + 1) % 2 == 0, 0, step) + window
+    width = lenB + gap_max + window
+    padded = np.full((lenA + gap_max + window, width), -1.0)
+    padded[:lenA, :lenB] = S
+    padded = padded.ravel()
+    gap_flat = gap_a * width + gap_b
+    # residue offsets of the inter-fragment distances compared by CE, on the flattened distance matrices
+    k = np.arange(window)
+    cross = window - 1 - k
+    cross[0], cross[-1] = 0, window - 1
+    flat_a, flat_b = dA.ravel(), dB.ravel()
+    rows_a = np.empty((smaller, window), dtype=int)
+    rows_b = np.empty((smaller, window), dtype=int)
+
+    best_path = None
+    best_length = 0
+    best_score = 1e6
+    buffer_paths = [None] * CE_MAX_KEPT
+    buffer_lengths = [0] * CE_MAX_KEPT
+    buffer_scores = [1e6] * CE_MAX_KEPT
+    buffer_index = 0
+    buffer_size = 0
+
+    starts = (S < d0) & (S != -1.0)
+    for iA in range(lenA):
+        if iA > lenA - window * (best_length - 1):
+            break
+        for iB in np.flatnonzero(starts[iA]):
+            if iB > lenB - window * (best_length - 1):
+                break
+
+            path_a = [iA]
+            path_b = [iB]
+            rows_a[0] = (iA + k) * lenA
+            rows_b[0] = (iB + k) * lenB
+            total = S[iA, iB]
+            length = 1
+            while True:
+                candidates = path_a[-1] * width + path_b[-1] + gap_flat
+                s_next = padded[candidates]
+                good = np.flatnonzero((s_next <= d0) & (s_next != -1.0))
+                if not len(good):
+                    break
+                jA = path_a[-1] + gap_a[good]
+                jB = path_b[-1] + gap_b[good]
+
+                diff = np.abs(flat_a[rows_a[:length, None, :] + (jA[:, None] + cross)] -
+                              flat_b[rows_b[:length, None, :] + (jB[:, None] + cross)])
+                scores = diff.sum(axis=(0, 2)) / (window * length)
+                # first candidate with the lowest score below d1
+                best = np.argmin(np.where(scores < d1, scores, np.inf))
+                if scores[best] >= d1:
+                    break
+                gA, gB = jA[best], jB[best]
+
+                score1 = (scores[best] * window * length + s_next[good[best]] * win_sum) / (window * length + win_sum)
+                score2 = (total * win_cache[length - 1] +
+                          score1 * (win_cache[length] - win_cache[length - 1])) / win_cache[length]
+                if score2 > d1:
+                    break
+                total = score2
+                path_a.append(gA)
+                path_b.append(gB)
+                rows_a[length] = (gA + k) * lenA
+                rows_b[length] = (gB + k) * lenB
+                length += 1
+
+                if length > best_length or (length == best_length and total < best_score):
+                    best_length = length
+                    best_score = total
+                    best_path = np.array([path_a, path_b]).T
+
+            if best_path is not None and (best_length > buffer_lengths[buffer_index] or
+                                          (best_length == buffer_lengths[buffer_index] and
+                                           best_score < buffer_scores[buffer_index])):
+                buffer_paths[buffer_index] = best_path
+                buffer_lengths[buffer_index] = best_length
+                buffer_scores[buffer_index] = best_score
+                buffer_index = (buffer_index + 1) % CE_MAX_KEPT
+                buffer_size = min(buffer_size + 1, CE_MAX_KEPT)
+
+    return [path for path in buffer_paths[:buffer_size] if path is not None]
+
+
+def cealign(coords_a, coords_b, window=CE_WINDOW, gap_max=CE_GAP_MAX, d0=CE_D0, d1=CE_D1):
+    """
+    CE structural alignment of two chains given by their CA coordinates (A is the target).
+
+    Sequences do not need to match. Among the paths kept by ce_paths(), the
+    one with the lowest RMSD after superposition is used. Returns a dict
+    with "RMSD", "alignment_length" (residues), "pairs" (aligned residue
+    indices in A and B) and R, t superposing B onto A.
+    """
+    coords_a = np.asarray(coords_a, dtype=float)
+    coords_b = np.asarray(coords_b, dtype=float)
+    if len(coords_a) < 2 * window or len(coords_b) < 2 * window:
+        raise ValueError(f"CE needs at least {2 * window} residues per structure")
+    dA = np.linalg.norm(coords_a[:, None] - coords_a[None], axis=-1)
+    dB = np.linalg.norm(coords_b[:, None] - coords_b[None], axis=-1)
+    S = ce_similarity(dA, dB, window)
+
+    best = None
+    k = np.arange(window)
+    for path in ce_paths(S, dA, dB, window, gap_max, d0, d1):
+        residues_a = (path[:, 0, None] + k).ravel()
+        residues_b = (path[:, 1, None] + k).ravel()
+        R, t = kabsch(coords_b[residues_b], coords_a[residues_a])
+        rms = rmsd(transform(coords_b[residues_b], R, t), coords_a[residues_a])
+        if best is None or rms < best["RMSD"]:
+            best = {"RMSD": float(rms), "alignment_length": len(residues_a),
+                    "pairs": (residues_a, residues_b), "R": R, "t": t}
+    if best is None:
+        raise ValueError("CE found no alignment")
+    return best
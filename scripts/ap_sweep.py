@@ -0,0 +1,205 @@
+import os
+import argparse
+import tempfile
+import traceback
+import warnings
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from parallel import WORKER, share_array, attach_array
+from vecfile import load_vectors
+from affinity import cached_similarity, propagate, net_similarity
+
+# Read the vectors of a post_first_clustering.py file (center, file name, count, values...)
+def read_exemplar_vectors(input_file):
+    rows = []
+    with open(input_file, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) > 3:
+                rows.append(np.array(parts[3:], dtype=float))
+    return np.array(rows)
+
+def load_similarity(input_file, exemplars=False, cache_dir=None):
+    """Similarity matrix for the sweep: a saved .npy matrix, or computed (and cached) from a vector file."""
+    if input_file.endswith(".npy"):
+        return np.load(input_file, mmap_mode="r")
+    if exemplars:
+        X = read_exemplar_vectors(input_file)
+    else:
+        ids, X, info = load_vectors(input_file)
+    return cached_similarity(X, cache_dir)
+
+def parse_grid(values):
+    """Comma-separated values, or start:stop:num for num evenly spaced values."""
+    if ':' in values:
+        start, stop, num = values.split(':')
+        return [float(v) for v in np.linspace(float(start), float(stop), int(num))]
+    return [float(v) for v in values.split(',')]
+
+def setting_distance(a, b, spans):
+    """Distance between two (preference, damping) settings, each axis scaled by the span of the grid."""
+    return sum(abs(x - y) / span for x, y, span in zip(a, b, spans))
+
+def dispatch_order(settings, jobs):
+    """
+    Order in which the settings are started.
+
+    The first wave (one setting per worker) is spread evenly over the grid
+    and starts cold; the rest follow in grid order, so each one can
+    warm-start from a converged neighbour.
+    """
+    first = sorted(set(np.linspace(0, len(settings) - 1, min(jobs, len(settings))).round().astype(int)))
+    return [settings[i] for i in first] + [s for i, s in enumerate(settings) if i not in first]
+
+def init_sweep_worker(spec, options):
+    WORKER.clear()
+    if isinstance(spec, tuple):
+        WORKER['shm'], spec = attach_array(spec)
+    WORKER['S'] = spec
+    WORKER['options'] = options
+
+def run_setting(task):
+    """
+    Run AP for one (preference, damping) setting, warm-started from a saved state if given.
+
+    The responsibilities and availabilities of a converged run are saved
+    so later settings can start from them. Returns (task, result, error).
+    """
+    index, (preference, damping), start, state_dir = task
+    try:
+        S = WORKER['S']
+        options = WORKER['options']
+        R = A = None
+        if start is not None:
+            R, A = np.load(start + "_R.npy"), np.load(start + "_A.npy")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            centers, labels, n_iter, converged, R, A = propagate(
+                S, preference, damping, options['max_iter'], options['convergence_iter'], options['seed'], R, A)
+        state = None
+        if converged:
+            state = os.path.join(state_dir, f"setting{index}")
+            np.save(state + "_R.npy", R)
+            np.save(state + "_A.npy", A)
+        result = {"clusters": len(centers), "iterations": n_iter, "converged": converged,
+                  "net_similarity": net_similarity(S, centers, labels, preference), "state": state}
+        return task, result, None
+    except Exception:
+        return task, None, traceback.format_exc()
+
+def sweep(S, preferences, dampings, jobs=1, max_iter=500, convergence_iter=100, seed=0):
+    """
+    Affinity Propagation for every preference x damping combination over one similarity matrix.
+
+    Settings run on jobs worker processes that share S; each setting
+    warm-starts from the nearest setting that has already converged. If a
+    worker process dies (e.g. killed when out of memory), the settings
+    running at that moment are reported as failed and the sweep goes on
+    with a new pool.
+
+    Returns:
+        list of (preference, damping, result dict or None, warm-start setting or None, error or None) in grid order
+    """
+    settings = [(p, d) for d in dampings for p in preferences]
+    spans = [max(np.ptp(preferences), 1e-12), max(np.ptp(dampings), 1e-12)]
+    options = {"max_iter": max_iter, "convergence_iter": convergence_iter, "seed": seed}
+    pending = dispatch_order(settings, jobs)
+    results = {}
+    warm_from = {}
+    converged = {}
+
+    def record(task, result, error):
+        index, setting, start, _ = task
+        results[setting] = (result, error)
+        if result and result["state"]:
+            converged[setting] = result["state"]
+        status = error.strip().splitlines()[-1] if error else \
+            f"{result['clusters']} clusters, {result['iterations']} iterations"
+        print(f"preference {setting[0]:g}, damping {setting[1]:g}: {status}")
+
+    def collect(future, task):
+        # returns False if the worker running the task died
+        try:
+            record(*future.result())
+            return True
+        except BrokenProcessPool:
+            record(task, None, "Worker process died (e.g. killed when out of memory)\n")
+            return False
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        shm = executor = None
+        if jobs > 1:
+            shm, spec = share_array(S)
+        else:
+            init_sweep_worker(S, options)
+        running = {}
+        try:
+            while pending or running:
+                while pending and len(running) < max(jobs, 1):
+                    setting = pending.pop(0)
+                    nearest = min(converged, key=lambda s: setting_distance(setting, s, spans), default=None)
+                    warm_from[setting] = nearest
+                    task = (settings.index(setting), setting, converged.get(nearest), state_dir)
+                    if jobs <= 1:
+                        record(*run_setting(task))
+                        continue
+                    if executor is None:
+                        executor = ProcessPoolExecutor(jobs, initializer=init_sweep_worker, initargs=(spec, options))
+                    running[executor.submit(run_setting, task)] = task
+                if not running:
+                    continue
+
+                # blocks until a worker reports back (or the pool breaks)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = not all([collect(future, running.pop(future)) for future in finished])
+                if broken:
+                    # every setting still running on the broken pool fails with it
+                    for future in wait(running).done:
+                        collect(future, running.pop(future))
+                    executor.shutdown()
+                    executor = None
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return [(p, d, results[(p, d)][0], warm_from[(p, d)], results[(p, d)][1]) for p, d in settings]
+
+def write_table(rows, output_file):
+    with open(output_file, "w") as f:
+        f.write("preference\tdamping\tclusters\titerations\tconverged\tnet_similarity\twarm_start\n")
+        for preference, damping, result, warm, error in rows:
+            start = f"{warm[0]:g}/{warm[1]:g}" if warm else "-"
+            if result is None:
+                f.write(f"{preference:g}\t{damping:g}\t-\t-\terror\t-\t{start}\n")
+                continue
+            f.write(f"{preference:g}\t{damping:g}\t{result['clusters']}\t{result['iterations']}\t"
+                    f"{'yes' if result['converged'] else 'no'}\t{result['net_similarity']:.4f}\t{start}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Affinity Propagation over a grid of preference and damping values.")
+    parser.add_argument('input', help="Vector file (text or .vec), post_first_clustering.py output with --exemplars, "
+                                      "or a similarity matrix saved as .npy")
+    parser.add_argument('output', help="Output table (tab-separated)")
+    parser.add_argument('--preferences', type=str, required=True,
+                        help="Comma-separated preferences, or start:stop:num, e.g. -4000:-1000:7")
+    parser.add_argument('--dampings', type=str, default="0.9", help="Comma-separated dampings, or start:stop:num")
+    parser.add_argument('--exemplars', action='store_true',
+                        help="Input is a post_first_clustering.py file (second-round clustering)")
+    parser.add_argument('--cache', type=str, default=None, help="Similarity matrix cache directory (see first_clustering.py)")
+    parser.add_argument('--max_iter', type=int, default=500)
+    parser.add_argument('--convergence_iter', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the noise AP adds to the similarities")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Settings run in parallel")
+    args = parser.parse_args()
+
+    S = load_similarity(args.input, args.exemplars, args.cache)
+    print(f"Similarity matrix: {S.shape[0]} x {S.shape[1]}")
+    rows = sweep(S, parse_grid(args.preferences), parse_grid(args.dampings), args.jobs,
+                 args.max_iter, args.convergence_iter, args.seed)
+    write_table(rows, args.output)
+    print(f"\n✅ Sweep of {len(rows)} settings saved to {args.output}")
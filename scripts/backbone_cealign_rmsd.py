@@ -4,23 +4,34 @@ parallel_pymol_rmsd_pdb.py
 
 - Finds all PDB files in current directory
 - Uses filename (without .pdb) as label
-- Runs parallel PyMOL backbone RMSD calculations (align) on all pairs
-- Outputs full RMSD matrix CSV
+- Runs parallel backbone RMSD calculations (CE alignment) on all pairs
+  in a pool of long-lived worker processes, with the in-project NumPy
+  CE implementation (alignment.py) or with PyMOL's cealign
+- Keeps every pair result in a store keyed by the content hashes of the two
+  PDB files, so reruns compute only missing pairs
+- Outputs full RMSD matrix CSV (and a compact binary .npz)
 
 Usage:
-  python parallel_pymol_rmsd_pdb.py --out_csv rmsd_matrix.csv --workers 32 --concurrency 8
+  python parallel_pymol_rmsd_pdb.py --out_csv rmsd_matrix.csv --concurrency 8
 """
 
 import os
-import sys
-import math
+import time
+import hashlib
 import argparse
-import tempfile
-import subprocess
+import importlib.util
 import numpy as np
 import pandas as pd
-from multiprocessing import cpu_count
-from time import sleep
+from multiprocessing import Pool, cpu_count
+from alignment import read_pdb, select, cealign
+
+BACKBONE = ("N", "CA", "C", "O")
+# Recorded in the pair store, so results of another method (or backend) are never mixed in
+METHOD = "cealign-backbone"
+METHODS = {"numpy": METHOD + "-numpy", "pymol": METHOD}
+
+# State of the current worker process, filled once by init_numpy_worker() or init_pymol_worker()
+WORKER = {}
 
 def gather_pdbs_in_folder(folder):
     pdb_files = [os.path.abspath(os.path.join(folder, f))
@@ -37,169 +48,236 @@ def build_pair_list(n):
             pairs.append((i, j))
     return pairs
 
-def chunk_pairs(pairs, workers):
-    total = len(pairs)
-    per = math.ceil(total / workers)
-    chunks = [pairs[i:i+per] for i in range(0, total, per)]
-    return chunks
-
-def write_worker_script(tmpdir, idx, needed_files, labels_map, pairs, out_chunk_path, pdb_files):
-    load_lines = []
-    for pdb in needed_files:
-        label = labels_map[pdb]
-        pdb_escaped = pdb.replace("\\", "\\\\")
-        load_lines.append(f'cmd.load(r"{pdb_escaped}", "{label}")\n')
-
-    pairs_list_py = "[" + ", ".join([f'("{labels_map[pdb_files[i]]}", "{labels_map[pdb_files[j]]}")' 
-                                     for (i, j) in pairs]) + "]"
-
-    worker_code = f'''
-from pymol import cmd, finish_launching
-print("Worker {idx} PyMOL script started with offscreen mode", flush=True)
-finish_launching(['pymol', '-cq'])
-
-{"".join(load_lines)}
-
-out_path = r"{out_chunk_path}"
-
-with open(out_path, "w") as fout:
-    for (lab_a, lab_b) in {pairs_list_py}:
-        sel_a = f"{{lab_a}} and name N+CA+C+O"
-        sel_b = f"{{lab_b}} and name N+CA+C+O"
-
-        result = cmd.cealign(sel_a, sel_b)
+def count_backbone_atoms(pdb_file):
+    """Number of backbone (N, CA, C, O) atoms, read from the ATOM records."""
+    count = 0
+    with open(pdb_file, "r") as fh:
+        for line in fh:
+            if line.startswith("ATOM") and line[12:16].strip() in BACKBONE:
+                count += 1
+    return count
+
+def file_hash(path):
+    """SHA-256 of the file content: a structure keeps its results when renamed and loses them when edited."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_pair_store(path, method=METHOD):
+    """
+    Pair results of one method saved so far, as {(hash_a, hash_b): rms}.
+
+    The store is an append-only tab-separated file (method, hash_a, hash_b,
+    rms, label_a, label_b); a line cut off by an interrupted run is skipped.
+    """
+    store = {}
+    if not os.path.exists(path):
+        return store
+    with open(path, "r") as fh:
+        for line in fh:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) != 6 or parts[0] != method:
+                continue
+            try:
+                store[(parts[1], parts[2])] = float(parts[3])
+            except ValueError:
+                continue
+    return store
+
+def open_pair_store(path):
+    """Open the store for appending, starting on a new line if the last one was cut off."""
+    cut_off = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as fh:
+            fh.seek(-1, os.SEEK_END)
+            cut_off = fh.read(1) != b"\n"
+    store_file = open(path, "a")
+    if cut_off:
+        store_file.write("\n")
+    return store_file
+
+def stored_rms(store, hash_a, hash_b):
+    """RMSD of a pair from the store in either order, or None."""
+    if (hash_a, hash_b) in store:
+        return store[(hash_a, hash_b)]
+    return store.get((hash_b, hash_a))
+
+def order_largest_first(pairs, sizes):
+    """Pairs sorted by estimated CE-align cost (product of backbone sizes), largest first, so no large pair is left for the end."""
+    return sorted(pairs, key=lambda pair: sizes[pair[0]] * sizes[pair[1]], reverse=True)
+
+def default_backend():
+    """PyMOL's cealign when PyMOL is importable (much faster), the NumPy CE port otherwise."""
+    return "pymol" if importlib.util.find_spec("pymol") is not None else "numpy"
+
+def init_numpy_worker(pdb_files, labels):
+    """Prepare a worker for the NumPy backend; CA coordinates are read on first use and kept."""
+    WORKER['backend'] = "numpy"
+    WORKER['files'] = dict(zip(labels, pdb_files))
+    WORKER['ca'] = {}
+
+def init_pymol_worker(pdb_files, labels):
+    """Start an embedded PyMOL once per worker; structures are loaded on first use and kept."""
+    import pymol
+    pymol.finish_launching(['pymol', '-cq'])
+    from pymol import cmd
+    WORKER['backend'] = "pymol"
+    WORKER['cmd'] = cmd
+    WORKER['files'] = dict(zip(labels, pdb_files))
+    WORKER['loaded'] = set()
+
+def ensure_loaded(label):
+    if label not in WORKER['loaded']:
+        WORKER['cmd'].load(WORKER['files'][label], label)
+        WORKER['loaded'].add(label)
+
+def ca_coords(label):
+    # cealign in PyMOL also aligns only the CA atoms of a backbone selection
+    if label not in WORKER['ca']:
+        structure = read_pdb(WORKER['files'][label])
+        WORKER['ca'][label] = structure["coords"][select(structure, name="CA", record="ATOM")]
+    return WORKER['ca'][label]
+
+def cealign_pair(pair):
+    """Backbone CE-align RMSD of one (label_a, label_b) pair; nan if the alignment fails. Returns (label_a, label_b, rms, error)."""
+    lab_a, lab_b = pair
+    try:
+        if WORKER['backend'] == "numpy":
+            return lab_a, lab_b, cealign(ca_coords(lab_a), ca_coords(lab_b))["RMSD"], None
+        ensure_loaded(lab_a)
+        ensure_loaded(lab_b)
+        sel_a = f"{lab_a} and name N+CA+C+O"
+        sel_b = f"{lab_b} and name N+CA+C+O"
+
+        result = WORKER['cmd'].cealign(sel_a, sel_b)
 
         if result and "RMSD" in result:
             rms = result["RMSD"]
         else:
             rms = float("nan")
-
-        fout.write(f"{{lab_a}},{{lab_b}},{{rms:.4f}}\\n")
-
-cmd.quit()
-'''
-    script_path = os.path.join(tmpdir, f"worker_{idx:04d}.py")
-    with open(script_path, "w") as fh:
-        fh.write(worker_code)
-    return script_path
-
-def merge_chunks(chunk_files, labels, out_csv):
-    n = len(labels)
+        return lab_a, lab_b, rms, None
+    except Exception as exc:
+        return lab_a, lab_b, float("nan"), f"{type(exc).__name__}: {exc}"
+
+def run_pairs(pdb_files, labels, pairs, concurrency, backend=None):
+    """
+    Yield (label_a, label_b, rms, error) for every pair as soon as it is done.
+
+    A fixed pool of workers pulls pairs one at a time from the pool's
+    shared task queue, so a worker that finishes early takes the next pair
+    instead of waiting for a static chunk; the parent blocks on the result
+    stream instead of polling.
+    """
+    tasks = [(labels[i], labels[j]) for i, j in pairs]
+    if not tasks:
+        return
+    backend = backend or default_backend()
+    init_worker = init_numpy_worker if backend == "numpy" else init_pymol_worker
+    if concurrency <= 1:
+        init_worker(pdb_files, labels)
+        for task in tasks:
+            yield cealign_pair(task)
+        return
+    with Pool(concurrency, initializer=init_worker, initargs=(pdb_files, labels)) as pool:
+        for result in pool.imap_unordered(cealign_pair, tasks, chunksize=1):
+            yield result
+
+def build_matrix(results, labels):
     idx_map = {lab: i for i, lab in enumerate(labels)}
-    mat = np.zeros((n, n), dtype=float)
-
-    for cf in sorted(chunk_files):
-        with open(cf, "r") as fh:
-            for line in fh:
-                line = line.strip()
-                if not line:
-                    continue
-                a, b, rms = line.split(",")
-                i = idx_map[a]
-                j = idx_map[b]
-                val = float(rms)
-                mat[i, j] = val
-                mat[j, i] = val
-
+    mat = np.zeros((len(labels), len(labels)), dtype=float)
+    for a, b, rms in results:
+        i = idx_map[a]
+        j = idx_map[b]
+        # same 4-decimal precision as the per-pair CSV lines before
+        val = float(f"{rms:.4f}")
+        mat[i, j] = val
+        mat[j, i] = val
+    return mat
+
+def write_matrix(mat, labels, out_csv):
     df = pd.DataFrame(mat, index=labels, columns=labels)
     df.to_csv(out_csv)
     print(f"Saved merged RMSD matrix to {out_csv}", flush=True)
 
+def write_binary_matrix(mat, labels, hashes, out_npz):
+    """Upper triangle (with diagonal) as float32, plus labels and file hashes."""
+    rows, cols = np.triu_indices(len(labels))
+    np.savez_compressed(out_npz, labels=np.array(labels), hashes=np.array(hashes),
+                        triangle=mat[rows, cols].astype(np.float32))
+    print(f"Saved binary RMSD matrix to {out_npz}", flush=True)
+
+def load_binary_matrix(path):
+    """Full symmetric matrix and labels from write_binary_matrix()."""
+    with np.load(path) as data:
+        labels = [str(label) for label in data["labels"]]
+        mat = np.zeros((len(labels), len(labels)))
+        rows, cols = np.triu_indices(len(labels))
+        mat[rows, cols] = data["triangle"]
+        mat[cols, rows] = data["triangle"]
+    return mat, labels
+
 def main():
-    parser = argparse.ArgumentParser(description="Parallel PyMOL RMSD on all PDB files in current folder")
+    parser = argparse.ArgumentParser(description="Parallel backbone CE-align RMSD on all PDB files in current folder")
     parser.add_argument("--out_csv", default="rmsd_matrix_pymol.csv", help="Output CSV RMSD matrix file")
-    parser.add_argument("--workers", type=int, default=32, help="Number of worker scripts (chunks)")
-    parser.add_argument("--concurrency", type=int, default=min(8, cpu_count()), help="Number of pymol processes to run simultaneously")
+    parser.add_argument("--concurrency", type=int, default=min(8, cpu_count()), help="Number of worker processes")
+    parser.add_argument("--backend", choices=["numpy", "pymol"], default=default_backend(),
+                        help="CE alignment with PyMOL's cealign (default when PyMOL is importable) "
+                             "or the NumPy port in alignment.py (default otherwise; much slower)")
     parser.add_argument("--folder", default=".", help="Folder containing PDB files")
+    parser.add_argument("--store", default=None,
+                        help="Pair result store, reused and extended by every run (default: <out_csv>.pairs.tsv)")
     args = parser.parse_args()
+    store_path = args.store or os.path.splitext(args.out_csv)[0] + ".pairs.tsv"
 
-    import shutil
-    pymol_python = shutil.which("pymol")
-    if pymol_python is None:
-        raise RuntimeError("Could not find 'pymol' executable in PATH. Please ensure PyMOL is installed and accessible.")
-    print(f"Using pymol executable at: {pymol_python}", flush=True)
-
-    tmpdir = tempfile.mkdtemp(prefix="pymol_rmsd_")
-    os.makedirs(tmpdir, exist_ok=True)
-    print(f"Temporary working directory is: {tmpdir}", flush=True)
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    os.environ["PYMOL_NO_MAIN"] = "1"
 
     pdb_files, labels = gather_pdbs_in_folder(args.folder)
     n = len(pdb_files)
     print(f"Found {n} PDB files: {labels}", flush=True)
 
-    labels_map = {p: os.path.splitext(os.path.basename(p))[0] for p in pdb_files}
-
-    pairs = build_pair_list(n)
-    chunks = chunk_pairs(pairs, args.workers)
-    print(f"Total pairs: {len(pairs)}, split into {len(chunks)} chunks", flush=True)
-
-    worker_scripts = []
-    chunk_out_files = []
-
-    for idx, chunk in enumerate(chunks):
-        needed_idx = set()
-        for (i, j) in chunk:
-            needed_idx.add(i)
-            needed_idx.add(j)
-        needed_files = [pdb_files[k] for k in needed_idx]
-        out_chunk = os.path.join(tmpdir, f"chunk_{idx:04d}.csv")
-        script_path = write_worker_script(tmpdir, idx, needed_files, labels_map, chunk, out_chunk, pdb_files)
-        worker_scripts.append(script_path)
-        chunk_out_files.append(out_chunk)
-
-    running = []
-    env = os.environ.copy()
-    env["QT_QPA_PLATFORM"] = "offscreen"
-    env["PYMOL_NO_MAIN"] = "1"
-
-    print(f"Launching up to {args.concurrency} PyMOL worker processes in offscreen mode.")
-    for idx, script_path in enumerate(worker_scripts):
-        while len(running) >= args.concurrency:
-            for i, proc in enumerate(running):
-                ret = proc.poll()
-                if ret is not None:
-                    stdout, stderr = proc.communicate(timeout=1)
-                    if ret != 0:
-                        print(f"[ERROR] Worker {i} exited with code {ret}")
-                        print(f"----- stdout -----\n{stdout}\n----- stderr -----\n{stderr}\n------------------")
-                    else:
-                        print(f"[INFO] Worker {i} finished successfully")
-                    running.pop(i)
-                    break
-            else:
-                sleep(0.1)
-
-        cmdline = [pymol_python, "-cq", script_path]
-        print(f"Starting worker {idx} with command: {' '.join(cmdline)}", flush=True)
-        proc = subprocess.Popen(cmdline,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                env=env,
-                                universal_newlines=True,
-                                bufsize=1)
-        running.append(proc)
-
-    while running:
-        for i, proc in enumerate(running):
-            ret = proc.poll()
-            if ret is not None:
-                stdout, stderr = proc.communicate(timeout=1)
-                if ret != 0:
-                    print(f"[ERROR] Worker {i} exited with code {ret}")
-                    print(f"----- stdout -----\n{stdout}\n----- stderr -----\n{stderr}\n------------------")
-                else:
-                    print(f"[INFO] Worker {i} finished successfully")
-                running.pop(i)
-                break
+    hashes = [file_hash(p) for p in pdb_files]
+    hash_of = dict(zip(labels, hashes))
+    method = METHODS[args.backend]
+    store = load_pair_store(store_path, method)
+    all_pairs = build_pair_list(n)
+    results = []
+    missing = []
+    for i, j in all_pairs:
+        rms = stored_rms(store, hashes[i], hashes[j])
+        if rms is None:
+            missing.append((i, j))
         else:
-            sleep(0.1)
-
-    print("All workers completed. Merging chunk CSV files...")
-    merge_chunks(chunk_out_files, labels, args.out_csv)
-
-    print(f"Temporary directory used: {tmpdir}")
+            results.append((labels[i], labels[j], rms))
+    print(f"Total pairs: {len(all_pairs)}, {len(results)} found in {store_path}, {len(missing)} to compute "
+          f"on {args.concurrency} {args.backend} workers", flush=True)
+
+    sizes = [count_backbone_atoms(p) for p in pdb_files]
+    pairs = order_largest_first(missing, sizes)
+    failed = 0
+    start = time.time()
+    # every result is appended and flushed as it arrives, so an interrupted run resumes from here
+    with open_pair_store(store_path) as store_file:
+        finished = run_pairs(pdb_files, labels, pairs, args.concurrency, args.backend)
+        for done, (lab_a, lab_b, rms, error) in enumerate(finished, 1):
+            if error:
+                failed += 1
+                print(f"[ERROR] {lab_a} vs {lab_b}: {error}", flush=True)
+            elif not np.isnan(rms):
+                store_file.write(f"{method}\t{hash_of[lab_a]}\t{hash_of[lab_b]}\t{rms!r}\t{lab_a}\t{lab_b}\n")
+                store_file.flush()
+            results.append((lab_a, lab_b, rms))
+            if done % 100 == 0 or done == len(pairs):
+                print(f"[INFO] {done}/{len(pairs)} pairs done ({time.time() - start:.0f} s)", flush=True)
+
+    if failed:
+        print(f"⚠️ {failed} pairs failed; they are nan in the matrix and will be retried by the next run", flush=True)
+    mat = build_matrix(results, labels)
+    write_matrix(mat, labels, args.out_csv)
+    write_binary_matrix(mat, labels, hashes, os.path.splitext(args.out_csv)[0] + ".npz")
     print("Done.")
 
 if __name__ == "__main__":
     main()
-
@@ -2,9 +2,20 @@ import math
 import numpy as np
 import argparse
 import os
+from contextlib import ExitStack
+from raycast import DEFAULT_MAX_MEMORY, DEFAULT_SKIN, cast_cutoffs, file_method, ray_lengths, hit_vectors
+from trajectory import load_universe, frame_numbers, frame_coords, frame_transform, site_for_args
+from topology import read_reference, topology_template, template_atoms
+from heme_frame import transforms_for_args
+from parallel import WORKER, map_ordered
+from vecfile import open_writer, cutoff_paths
 
 # Read coordinates from PDB
 def read_pdb_coords(pdb_filename):
+    # Full precision lattice written by triangular_lattice_sphere.py --binary
+    if pdb_filename.endswith(".npz"):
+        from triangular_lattice_sphere import read_lattice
+        return read_lattice(pdb_filename)["coords"]
     coords = []
     with open(pdb_filename, 'r') as file:
         for line in file:
@@ -15,32 +26,9 @@ def read_pdb_coords(pdb_filename):
                 coords.append([x, y, z])
     return np.array(coords)
 
-# Read new reference file format
-def read_reference_file(ref_file):
-    ref_map = {}
-    with open(ref_file, 'r') as f:
-        for line in f:
-            if not line.strip():
-                continue
-            parts = line.split()
-            if len(parts) != 4:
-                continue  # skip malformed lines
-            atom_name = parts[0].strip()
-            res_name = parts[1].strip()
-            charge = float(parts[2])
-            radius = float(parts[3])
-            key = (res_name.upper(), atom_name.upper())
-            ref_map[key] = (charge, radius)
-    return ref_map
-
-# Normalize vector and scale by t1
-def new_vector(V, t1):
-    V_unit = V / np.linalg.norm(V)
-    return t1 * V_unit
-
 # Main cavity calculation
-def cavity(name_file, surface_coords, radius_sphere, ref_map):
-    radius_limit = radius_sphere + 2
+def cavity(name_file, surface_coords, radii_sphere, ref_map, max_memory=DEFAULT_MAX_MEMORY, method="index"):
+    radius_limit = max(radii_sphere) + 2
     protein_coords = []
     atom_radii = []
     charges = []
@@ -71,82 +59,137 @@ def cavity(name_file, surface_coords, radius_sphere, ref_map):
                 charges.append(charge)
                 original_keys.append(ref_key)
 
-    if not protein_coords:
-        print(f"⚠️ No hits found in: {name_file}")
-        return [], [], [], [], []
-
-    protein_coords = np.array(protein_coords)
+    protein_coords = np.array(protein_coords).reshape(-1, 3)
     atom_radii = np.array(atom_radii)
 
-    surface_vectors = []
-    distance_vectors = []
-    hit_keys = []
-
-    for vector in surface_coords:
-        V = np.array(vector)
-        min_dist = float('inf')
-        final_vector = V
-        final_index = -1
-
-        for i, (S, r) in enumerate(zip(protein_coords, atom_radii)):
-            d = np.linalg.norm(S)
-            cos_alpha = np.dot(S, V) / (d * np.linalg.norm(V))
-
-            if np.array_equal(S, V):
-                t1 = d - r
-                temp_vector = new_vector(V, t1)
-            elif 0 <= cos_alpha <= 1:
-                y = d * math.sqrt(1.0 - cos_alpha**2)
-                if y < r:
-                    x = math.sqrt(r * r - y * y)
-                    t = abs(np.dot(S, V)) / np.linalg.norm(V)
-                    t1 = t - x
-                    temp_vector = new_vector(V, t1 if t1 < radius_sphere else radius_sphere)
-                elif y == r:
-                    t1 = np.dot(S, V) / np.linalg.norm(V)
-                    temp_vector = new_vector(V, t1 if t1 < radius_sphere else radius_sphere)
-                else:
-                    continue
-            else:
-                continue
-
-            if t1 < min_dist:
-                final_vector = temp_vector
-                min_dist = t1
-                final_index = i
-
-        if min_dist > radius_sphere:
-            min_dist = radius_sphere
-
-        distance_vectors.append(np.round(min_dist, 3))
-        surface_vectors.append(final_vector)
-        hit_keys.append(original_keys[final_index] if final_index != -1 else None)
-
-    hit_charges = [ref_map[k][0] if k else 0.0 for k in hit_keys]
-    hit_atom_names = [k[1] if k else "UNK" for k in hit_keys]
-    hit_residue_names = [k[0] if k else "UNK" for k in hit_keys]
-
-    return np.array(distance_vectors), np.array(surface_vectors), hit_charges, hit_atom_names, hit_residue_names
+    # A cutoff without atoms gives a full row of misses (charge 0.0 for every vector), so every row keeps its width
+    d = np.linalg.norm(protein_coords, axis=1)
+    for radius_sphere in radii_sphere:
+        if not (d < radius_sphere + 2).any():
+            print(f"⚠️ No hits found in: {name_file}" + (f" (radius {radius_sphere})" if len(radii_sphere) > 1 else ""))
+
+    return cavity_vectors(protein_coords, atom_radii, original_keys, surface_coords, radii_sphere, ref_map,
+                          max_memory, method)
+
+# Vector lengths and hit charges per cutoff for atoms that are already filtered to the binding site (largest cutoff)
+def cavity_vectors(protein_coords, atom_radii, original_keys, surface_coords, radii_sphere, ref_map,
+                   max_memory=DEFAULT_MAX_MEMORY, method="index", ids=None, cache=None):
+
+    # Cast all lattice vectors against the retained atoms once, for every cutoff
+    results = []
+    for radius_sphere, (t_near, hit_index, members) in zip(radii_sphere, cast_cutoffs(
+            surface_coords, protein_coords, atom_radii, radii_sphere, None, max_memory, method, ids, cache)):
+        distance_vectors = ray_lengths(t_near, radius_sphere)
+        surface_vectors = hit_vectors(surface_coords, t_near, radius_sphere)
+        hit_keys = [original_keys[i] if i != -1 else None for i in hit_index]
+
+        hit_charges = [ref_map[k][0] if k else 0.0 for k in hit_keys]
+        hit_atom_names = [k[1] if k else "UNK" for k in hit_keys]
+        hit_residue_names = [k[0] if k else "UNK" for k in hit_keys]
+        results.append((distance_vectors, surface_vectors, hit_charges, hit_atom_names, hit_residue_names))
+
+    return results
+
+
+# Per-worker state for --jobs: the parsed arguments, the reference map and, for --traj, the open trajectory and atom template
+def worker_setup(args):
+    state = {'args': args, 'ref_map': read_reference(args.ref)}
+    if args.traj:
+        universe = load_universe(args.top, args.traj)
+        state['universe'] = universe
+        template = topology_template(universe, args.top, args.ref, args.template_cache)
+        state['ray_cache'] = {"skin": args.skin}
+        state['template'] = template_atoms(template, "ref")
+    return state
+
+# Snapshot name and hit charges per cutoff for a protein file or trajectory frame, computed in a worker
+def charge_row(task):
+    args = WORKER['args']
+    ref_map = WORKER['ref_map']
+    surface_coords = WORKER['lattice']
+    max_memory = args.memory * 1024 ** 2
+    if args.traj:
+        indices, atom_radii, charges, keys = WORKER['template']
+        protein_coords, kept = frame_coords(WORKER['universe'], indices, task, max(args.radius),
+                                            transform=frame_transform(args.transforms, task),
+                                            site=args.site)
+        results = cavity_vectors(
+            protein_coords, atom_radii[kept], [keys[i] for i in kept], surface_coords, args.radius, ref_map,
+            max_memory, args.method, kept, WORKER['ray_cache']
+        )
+        base_name = str(task)
+    else:
+        base_name = os.path.splitext(os.path.basename(task))[0]
+        results = cavity(task, surface_coords, args.radius, ref_map, max_memory, file_method(args.method))
+    return base_name, [np.round(hit_charges, 4) for dist_vals, surface_vectors, hit_charges, *names in results]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Calculate vector distances and partial charges.")
-    parser.add_argument('-n', '--name', nargs='+', type=str, required=True, help="Protein PDB file(s)")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-n', '--name', nargs='+', type=str, help="Protein PDB file(s)")
+    inputs.add_argument('-t', '--traj', type=str, help="Trajectory (e.g. XTC) in the heme frame (or use --heme_frame), instead of PDB files")
+    parser.add_argument('-s', '--top', type=str, help="Topology (GRO/PDB) for --traj")
+    parser.add_argument('--start', type=int, default=None, help="First frame for --traj")
+    parser.add_argument('--stop', type=int, default=None, help="Last frame (exclusive) for --traj")
+    parser.add_argument('--step', type=int, default=None, help="Frame stride for --traj")
+    parser.add_argument('--heme_frame', action='store_true',
+                        help="Put every frame of --traj in the heme frame on the fly (see heme_frame.py)")
+    parser.add_argument('--ranges', type=str, default=None,
+                        help="With --heme_frame: residue ranges to superpose every frame on the first one (e.g. '5-8,32-40')")
+    parser.add_argument('--frame_ref', type=str, default=None,
+                        help="With --heme_frame and --ranges: reference PDB (e.g. 4I3Q) the first frame is CE-aligned to")
+    parser.add_argument('--resn', type=str, default="HEM*", help="Heme residue name pattern for --heme_frame (default: HEM*)")
+    parser.add_argument('--template_cache', type=str, default=None,
+                        help="Directory to cache the per-topology atom template for --traj (reused by later runs and workers)")
+    parser.add_argument('--preselect', type=float, default=None, metavar='MARGIN',
+                        help="Pre-select the atoms that come within the cutoff + MARGIN (A) once per trajectory and only "
+                             "read those from every frame (--traj)")
+    parser.add_argument('--preselect_step', type=int, default=10, help="Frame stride of the --preselect pass (default: 10)")
     parser.add_argument('-pdb', '--pdb', type=str, required=True, help="PDB file with surface coordinates")
-    parser.add_argument('-r', '--radius', type=int, required=True, help="Max sphere radius")
+    parser.add_argument('-r', '--radius', type=int, nargs='+', required=True,
+                        help="Max sphere radius; several radii are computed in one pass, one output each")
     parser.add_argument('--ref', type=str, required=True, help="Reference file with radii and charges")
-    parser.add_argument('-c', '--charge_output', type=str, required=True, help="Output file for hit charges")
+    parser.add_argument('-c', '--charge_output', type=str, required=True, help="Output file for hit charges (*.vec for the binary vector format; <name>_r<radius> per radius for several radii)")
+    parser.add_argument('-m', '--memory', type=int, default=DEFAULT_MAX_MEMORY // 1024 ** 2, help="Memory budget for ray casting in MB")
+    parser.add_argument('--method', choices=["index", "dense", "incremental"], default="index",
+                        help="Ray casting method: cone index over lattice rays, all ray x atom pairs, or (--traj) the "
+                             "cone index with candidate lists reused between frames (pqr files use index)")
+    parser.add_argument('--skin', type=float, default=DEFAULT_SKIN,
+                        help=f"Skin (A) of the candidate lists of --method incremental (default: {DEFAULT_SKIN})")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--chunksize', type=int, default=None, help="Files/frames sent to a worker at a time (default: automatic)")
 
     args = parser.parse_args()
+    if args.traj and not args.top:
+        parser.error("--traj requires --top")
+    if args.heme_frame and not args.traj:
+        parser.error("--heme_frame requires --traj")
+    if len(set(args.radius)) != len(args.radius):
+        parser.error("-r/--radius values must be distinct")
 
     surface_coords = read_pdb_coords(args.pdb)
-    ref_map = read_reference_file(args.ref)
-
-    with open(args.charge_output, 'w') as charge_file:
-        for protein_file in args.name:
-            base_name = os.path.splitext(os.path.basename(protein_file))[0]
-            dist_vals, surface_vectors, hit_charges, hit_atom_names, hit_residue_names = cavity(
-                protein_file, surface_coords, args.radius, ref_map
-            )
-            charge_file.write(base_name + " " + ' '.join(map(str, np.round(hit_charges, 4))) + "\n")
-
+    if args.traj:
+        tasks = frame_numbers(load_universe(args.top, args.traj), args.start, args.stop, args.step)
+    else:
+        tasks = args.name
+    args.transforms = transforms_for_args(args, tasks) if args.traj else None
+    args.site = site_for_args(args, tasks, "ref", None) if args.traj else None
+
+    # Rows are written in input order; a failed file/frame is reported and skipped
+    failed = []
+    with ExitStack() as stack:
+        charge_files = [stack.enter_context(open_writer(path, {"lattice": args.pdb, "n_rays": len(surface_coords),
+                                                               "radius": radius}, [["charges", len(surface_coords)]]))
+                        for radius, path in zip(args.radius, cutoff_paths(args.charge_output, args.radius))]
+        for task, row, error in map_ordered(charge_row, tasks, surface_coords, args.jobs, args.chunksize,
+                                            worker_setup, (args,)):
+            if error:
+                print(f"⚠️ Failed: {task}\n{error}")
+                failed.append(task)
+                continue
+            base_name, charges = row
+            for charge_file, hit_charges in zip(charge_files, charges):
+                charge_file.write(base_name, hit_charges)
+    if failed:
+        print(f"⚠️ {len(failed)} of {len(tasks)} inputs failed: {' '.join(map(str, failed))}")
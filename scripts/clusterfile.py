@@ -0,0 +1,72 @@
+import os
+import json
+import numpy as np
+
+# Machine-readable clustering result written next to every text report
+# (clusters_3a4.txt -> clusters_3a4.npz): plain arrays, loaded without pickle or text parsing.
+CLUSTER_SUFFIX = ".npz"
+
+
+def result_path(report_path):
+    """Path of the structured result that belongs to a text report."""
+    return os.path.splitext(report_path)[0] + CLUSTER_SUFFIX
+
+
+def save_clusters(path, report, snapshot_ids, cluster_centers_indices, labels, centroid_vectors):
+    """
+    Save a clustering result.
+
+    Arrays: snapshot_ids and labels (one per snapshot), centroid_rows
+    (positions of the exemplars in the input), centroid_ids, sizes and
+    centroid_vectors (one per cluster), and the name of the text report.
+    """
+    centroid_rows = np.asarray(cluster_centers_indices, dtype=int)
+    labels = np.asarray(labels, dtype=int)
+    snapshot_ids = np.asarray([str(i) for i in snapshot_ids])
+    np.savez(path,
+             report=np.array(os.path.basename(report)),
+             snapshot_ids=snapshot_ids,
+             labels=labels,
+             centroid_rows=centroid_rows,
+             centroid_ids=snapshot_ids[centroid_rows] if len(centroid_rows) else np.array([], dtype=str),
+             sizes=np.bincount(labels[labels >= 0], minlength=len(centroid_rows)),
+             centroid_vectors=np.asarray(centroid_vectors, dtype=float).reshape(len(centroid_rows), -1))
+
+
+def load_clusters(path):
+    """Load a result saved by save_clusters() as a dict of arrays ("report" is a str)."""
+    with np.load(path, allow_pickle=False) as data:
+        result = {key: data[key] for key in data.files}
+    result["report"] = str(result["report"])
+    return result
+
+
+def parse_report(path):
+    """
+    Read a first_clustering.py text report (for results without a .npz) in one pass.
+
+    Returns the same dict as load_clusters(), without per-snapshot labels.
+    """
+    centroid_ids = []
+    sizes = []
+    vectors = []
+    with open(path, "r") as f:
+        pending = None
+        for line in f:
+            stripped = line.strip()
+            if pending is not None:
+                # vector lists may be wrapped over several lines
+                pending += " " + stripped
+            elif stripped.startswith("Centroid Structure Index:"):
+                centroid_ids.append(stripped.split(":", 1)[1].strip())
+            elif stripped.startswith("Number of Structures:"):
+                sizes.append(int(stripped.split(":", 1)[1]))
+            elif stripped.startswith("Vectors lengths for centroid structure:"):
+                pending = stripped.split(":", 1)[1].strip()
+            if pending is not None and pending.endswith("]"):
+                vectors.append(json.loads(pending))
+                pending = None
+    return {"report": os.path.basename(path),
+            "centroid_ids": np.array(centroid_ids),
+            "sizes": np.array(sizes, dtype=int),
+            "centroid_vectors": np.array(vectors, dtype=float)}
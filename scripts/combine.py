@@ -1,22 +1,149 @@
+import os
 import argparse
+from contextlib import ExitStack
+import numpy as np
+from vecfile import VEC_SUFFIX, is_vector_file, read_vectors, open_writer
 
-def merge_files(file1_path, file2_path, output_path):
-    with open(file1_path, 'r') as file1, open(file2_path, 'r') as file2, open(output_path, 'w') as outfile:
-        for line1, line2 in zip(file1, file2):
-            parts1 = line1.strip().split()
-            parts2 = line2.strip().split()[1:]  # Skip the first element of line2
-            merged_line = parts1 + parts2
-            outfile.write(' '.join(merged_line) + '\n')
+def index_file(path):
+    """
+    Snapshot ids of a vector file and a function that reads one row by position.
+
+    Binary files are memory-mapped; text files are scanned once for the byte
+    offset of every line, so no values are held in memory.
+
+    Returns:
+        ids (list of str), read_row (function), blocks (list of [name, size]),
+        metadata (dict of a binary file, None for text), close (function that releases the file)
+    """
+    if is_vector_file(path):
+        ids, matrix, info = read_vectors(path)
+        return ids, lambda i: matrix[i], info["blocks"], info["metadata"], lambda: None
+
+    ids = []
+    offsets = []
+    n_values = 0
+    with open(path, 'rb') as f:
+        position = 0
+        for line in f:
+            parts = line.split(None, 1)
+            if parts:
+                if not ids:
+                    n_values = len(line.split()) - 1
+                ids.append(parts[0].decode())
+                offsets.append(position)
+            position += len(line)
+
+    handle = open(path, 'r')
+
+    def read_row(i):
+        # text values are kept as the original tokens
+        handle.seek(offsets[i])
+        return handle.readline().split()[1:]
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    return ids, read_row, [[name, n_values]], None, handle.close
+
+def report_mismatches(paths, ids_per_file, shown=10):
+    """Print the snapshot ids that are duplicated in a file or missing from it; returns True if any."""
+    all_ids = set().union(*map(set, ids_per_file))
+    mismatched = False
+    for path, ids in zip(paths, ids_per_file):
+        present = set(ids)
+        missing = [i for i in ids_per_file[0] if i not in present]
+        missing += sorted(all_ids - present - set(ids_per_file[0]))
+        duplicated = len(ids) - len(present)
+        if missing:
+            mismatched = True
+            print(f"⚠️ {path}: {len(missing)} snapshot IDs missing, e.g. {' '.join(missing[:shown])}")
+        if duplicated:
+            mismatched = True
+            print(f"⚠️ {path}: {duplicated} duplicated snapshot IDs (the first occurrence is used)")
+    return mismatched
+
+def merged_metadata(input_paths, weights, metadata_per_file):
+    """
+    Metadata of a joined file: the inputs and weights, the metadata of every
+    binary input, and the entries (e.g. lattice, n_rays) all binary inputs agree on.
+    """
+    metadata = {"inputs": list(input_paths), "weights": weights}
+    known = [m for m in metadata_per_file if m is not None]
+    if known:
+        metadata.update({key: value for key, value in known[0].items() if all(m.get(key) == value for m in known)})
+        metadata["input_metadata"] = metadata_per_file
+    return metadata
+
+def merge_files(input_paths, output_path, weights=None, strict=False):
+    """
+    Join any number of vector files on their snapshot ID.
+
+    Rows are written in the order of the first file, with the values of
+    every file (multiplied by its weight) side by side. Snapshots missing
+    from any file are reported and left out; with strict=True any
+    mismatch is an error and nothing is written.
+    """
+    weights = weights or [1.0] * len(input_paths)
+    if len(weights) != len(input_paths):
+        raise ValueError(f"Got {len(weights)} weights for {len(input_paths)} input files")
+
+    with ExitStack() as stack:
+        indexed = []
+        for path in input_paths:
+            ids, read_row, blocks, metadata, close = index_file(path)
+            stack.callback(close)
+            indexed.append((ids, read_row, blocks, metadata))
+        ids_per_file = [ids for ids, *_ in indexed]
+        if report_mismatches(input_paths, ids_per_file) and strict:
+            raise ValueError("Snapshot IDs do not match between the input files")
+
+        positions = []
+        for ids in ids_per_file:
+            position = {}
+            for i, snapshot_id in enumerate(ids):
+                position.setdefault(snapshot_id, i)
+            positions.append(position)
+
+        blocks = [block for ids, read_row, file_blocks, file_metadata in indexed for block in file_blocks]
+        sizes = [sum(size for name, size in file_blocks) for ids, read_row, file_blocks, file_metadata in indexed]
+        # Original tokens can be passed through only for unweighted text-to-text joins
+        raw = not output_path.endswith(VEC_SUFFIX) and all(w == 1 for w in weights)
+
+        written = 0
+        seen = set()
+        metadata = merged_metadata(input_paths, weights, [file_metadata for *_, file_metadata in indexed])
+        with open_writer(output_path, metadata, blocks) as writer:
+            for snapshot_id in ids_per_file[0]:
+                if snapshot_id in seen or not all(snapshot_id in position for position in positions):
+                    continue
+                seen.add(snapshot_id)
+                parts = []
+                for (ids, read_row, file_blocks, file_metadata), position, weight, size, path in zip(
+                        indexed, positions, weights, sizes, input_paths):
+                    values = read_row(position[snapshot_id])
+                    if len(values) != size:
+                        raise ValueError(f"{path}: snapshot {snapshot_id} has {len(values)} values, expected {size}")
+                    if raw and not isinstance(values, list):
+                        values = [str(v) for v in values]
+                    elif not raw:
+                        values = np.asarray(values, dtype=float) * weight
+                    parts.append(values)
+                writer.write(snapshot_id, [v for values in parts for v in values] if raw else np.concatenate(parts))
+                written += 1
+
+    print(f"Joined {written} snapshots from {len(input_paths)} files into {output_path}")
+    return written
 
 def main():
-    parser = argparse.ArgumentParser(description='Merge two files line by line, skipping first element of second file\'s lines.')
-    parser.add_argument('file1', help='Path to the first input file')
-    parser.add_argument('file2', help='Path to the second input file')
-    parser.add_argument('output', help='Path to the output file')
+    parser = argparse.ArgumentParser(description='Join vector files (lengths, charges, ...) on their snapshot ID.')
+    parser.add_argument('files', nargs='+', help='Paths to the input files followed by the path to the output file '
+                                                 '(*.vec for the binary vector format)')
+    parser.add_argument('--weights', type=str, default=None, help='Comma-separated weight for every input file')
+    parser.add_argument('--strict', action='store_true', help='Fail instead of skipping snapshots with mismatched IDs')
 
     args = parser.parse_args()
-    merge_files(args.file1, args.file2, args.output)
+    if len(args.files) < 3:
+        parser.error("Give at least two input files and the output file")
+    weights = [float(w) for w in args.weights.split(',')] if args.weights else None
+    merge_files(args.files[:-1], args.files[-1], weights, args.strict)
 
 if __name__ == '__main__':
     main()
-
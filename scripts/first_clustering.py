@@ -1,26 +1,12 @@
-import sys
+import argparse
 import numpy as np
-from sklearn.cluster import AffinityPropagation
+from vecfile import load_vectors
+from affinity import landmark_affinity_propagation
+from clusterfile import result_path, save_clusters
 
-def perform_clustering(input_file, output_file):
-    # Load the dataset
-    with open(input_file, "r") as f:
-        data = [list(map(float, line.strip().split())) for line in f]
-
-    # Extract structure indices and feature vectors
-    structure_indices = [int(row[0]) for row in data]
-    feature_vectors = np.array([row[1:] for row in data])
-    print(f"Feature vector shape: {feature_vectors.shape}")
-
-    # Perform Affinity Propagation clustering
-    clustering = AffinityPropagation(preference=-2000, damping=0.9, max_iter=500, convergence_iter=100)
-    clustering.fit(feature_vectors)
-
-    # Extract clustering results
-    cluster_centers_indices = clustering.cluster_centers_indices_
-    labels = clustering.labels_
-
-    # Save clustering results to a file
+# Write the text report and the structured result (.npz) of a clustering
+def write_report(output_file, structure_indices, matrix, cluster_centers_indices, labels):
+    centroid_vectors = []
     with open(output_file, "w") as f:
         f.write(f"Total clusters found: {len(cluster_centers_indices)}\n\n")
 
@@ -29,8 +15,9 @@ def perform_clustering(input_file, output_file):
             cluster_members = np.where(labels == cluster_id)[0]
             cluster_size = len(cluster_members)  # Number of structures in the cluster
 
-            # Extract feature vector of centroid structure
-            centroid_features = feature_vectors[centroid_index]
+            # Extract feature vector of centroid structure (shortest repr of the stored dtype, e.g. float32 .vec input)
+            centroid_features = np.array([float(str(v)) for v in matrix[centroid_index]])
+            centroid_vectors.append(centroid_features)
 
             # Write cluster information
             f.write(f"Cluster {cluster_id}:\n")
@@ -38,14 +25,49 @@ def perform_clustering(input_file, output_file):
             f.write(f"  Number of Structures: {cluster_size}\n")
             f.write(f"  Vectors lengths for centroid structure: {centroid_features.tolist()}\n\n")
 
-    print(f"Clustering complete. Results saved to {output_file}")
+    # Same result as arrays, for post_first_clustering.py
+    save_clusters(result_path(output_file), output_file, structure_indices, cluster_centers_indices, labels,
+                  centroid_vectors)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python clustering_script.py <input_file.txt> <output_file.txt>")
-    else:
-        input_file = sys.argv[1]
-        output_file = sys.argv[2]
-        perform_clustering(input_file, output_file)
+def perform_clustering(input_file, output_file, landmarks=0, seed=0, preference=-2000, damping=0.9, cache_dir=None,
+                       engine="sklearn", progress=0):
+    # Load the dataset (text or binary vector matrix)
+    snapshot_ids, matrix, info = load_vectors(input_file)
 
+    # Extract structure indices and feature vectors
+    structure_indices = [int(float(snapshot_id)) for snapshot_id in snapshot_ids]
+    print(f"Feature vector shape: {matrix.shape}")
+
+    # Perform Affinity Propagation clustering (on a landmark subset if requested, the rest is assigned afterwards)
+    if landmarks and landmarks < len(matrix):
+        print(f"Clustering {landmarks} landmark frames, assigning the other {len(matrix) - landmarks}")
+    cluster_centers_indices, labels = landmark_affinity_propagation(
+        matrix, landmarks or len(matrix), seed=seed, cache_dir=cache_dir, engine=engine, progress=progress,
+        preference=preference, damping=damping, max_iter=500, convergence_iter=100)
+    if len(cluster_centers_indices) == 0:
+        print("⚠️ Affinity Propagation did not converge, no clusters found")
+
+    write_report(output_file, structure_indices, matrix, cluster_centers_indices, labels)
+
+    print(f"Clustering complete. Results saved to {output_file} and {result_path(output_file)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Affinity Propagation clustering of binding site vectors.")
+    parser.add_argument('input', help="Input vector file (text or binary .vec)")
+    parser.add_argument('output', help="Output text file with the clusters")
+    parser.add_argument('--landmarks', type=int, default=0,
+                        help="Cluster only this many randomly chosen frames and assign the rest to the nearest "
+                             "exemplar (default 0: all frames)")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed for choosing the landmark frames")
+    parser.add_argument('--preference', type=float, default=-2000, help="Affinity Propagation preference")
+    parser.add_argument('--damping', type=float, default=0.9, help="Affinity Propagation damping")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Directory for similarity matrices, reused while the input vectors are unchanged")
+    parser.add_argument('--engine', choices=["sklearn", "native"], default="sklearn",
+                        help="sklearn AffinityPropagation, or the in-project float32 kernel (about 3 N x N float32 arrays)")
+    parser.add_argument('--progress', type=int, default=0,
+                        help="With --engine native, print exemplars and changed assignments every N iterations")
+    args = parser.parse_args()
 
+    perform_clustering(args.input, args.output, args.landmarks, args.seed, args.preference, args.damping, args.cache,
+                       args.engine, args.progress)
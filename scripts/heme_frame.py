@@ -0,0 +1,118 @@
+import argparse
+from functools import partial
+import numpy as np
+from alignment import read_pdb, select, cealign
+from trajectory import load_universe, frame_numbers, universe_structure, write_transformed
+from trans_rot_4i3q import heme_atom, heme_transform
+from align_selected_residues import parse_ranges, trajectory_fits
+
+# Residue names treated as protein when the first frame is CE-aligned to the reference
+# (GROMOS names included; heme, ions and water excluded)
+PROTEIN_RESN = ["ALA", "ARG", "ASN", "ASP", "ASPH", "CYS", "CYS1", "CYS2", "CYSH", "GLN", "GLU", "GLUH", "GLY",
+                "HIS", "HISA", "HISB", "HISH", "HIE", "HID", "HIP", "ILE", "LEU", "LYS", "LYSH", "MET", "PHE",
+                "PRO", "SER", "THR", "TRP", "TYR", "VAL"]
+
+def reference_alignment(reference, structure, axis="xy", resn="HEM*"):
+    """
+    (R, t) that superposes structure on the reference put in the heme frame.
+
+    The reference (e.g. 4I3Q) is canonicalized like trans_rot_4i3q.py and the
+    structure is CE-aligned to it on the CA atoms, so the sequences may differ.
+    """
+    R_ref, t_ref = heme_transform(heme_atom(reference, resn, "FE"), heme_atom(reference, resn, "NA"),
+                                  heme_atom(reference, resn, "NB"), axis)
+    ref_ca = reference["coords"][select(reference, name="CA", record="ATOM")] @ R_ref.T + t_ref
+    result = cealign(ref_ca, structure["coords"][select(structure, name="CA", resn=PROTEIN_RESN)])
+    return result["R"], result["t"]
+
+def heme_atoms(universe, resn="HEM*"):
+    """Universe indices of the FE, NA and NB atoms of the heme."""
+    structure = universe_structure(universe)
+    heme = [select(structure, resn=resn, name=name)[:1] for name in ("FE", "NA", "NB")]
+    if any(len(atom) == 0 for atom in heme):
+        raise ValueError(f"No FE, NA and NB atoms in residue {resn}")
+    return np.array([atom[0] for atom in heme])
+
+def own_heme_transform(positions, heme, axis="xy"):
+    """(R, t) that puts one frame (all positions of the universe) in the frame of its own heme (FE, NA, NB indices)."""
+    fe, na, nb = positions[heme].astype(float)
+    return heme_transform(fe, na, nb, axis)
+
+def heme_frame_transforms(universe, frames, residue_ranges=None, reference=None, resn="HEM*", axis="xy"):
+    """
+    One rigid transform (R, t) per frame that puts the trajectory in the heme frame.
+
+    Without residue_ranges every frame is canonicalized from its own heme:
+    FE at the origin, the porphyrin (FE, NA, NB) in the plane of `axis`,
+    FE->NA along x. With residue_ranges, the chain trans_rot_4i3q.py ->
+    trans_first_frame.py -> align_selected_residues.py becomes one transform
+    per frame: the first frame is CE-aligned to the reference in the heme
+    frame (or canonicalized from its own heme without a reference) and its
+    FE moved to the origin, then every frame is superposed on it on the
+    backbone of the selected residues, in batches.
+
+    Returns R (F, 3, 3), t (F, 3).
+    """
+    if residue_ranges is None:
+        heme = heme_atoms(universe, resn)
+        R = np.empty((len(frames), 3, 3))
+        t = np.empty((len(frames), 3))
+        for i, frame in enumerate(frames):
+            R[i], t[i] = own_heme_transform(universe.trajectory[frame].positions, heme, axis)
+        return R, t
+
+    first = universe_structure(universe, frames[0])
+    if reference is None:
+        R0, t0 = heme_transform(heme_atom(first, resn, "FE"), heme_atom(first, resn, "NA"),
+                                heme_atom(first, resn, "NB"), axis)
+    else:
+        R0, t0 = reference_alignment(reference, first, axis, resn)
+    # FE of the aligned first frame to the origin (trans_first_frame.py)
+    t0 = t0 - (R0 @ heme_atom(first, resn, "FE") + t0)
+    first["coords"] = first["coords"] @ R0.T + t0
+
+    R, t, rms = trajectory_fits(first, universe, frames, residue_ranges)
+    return R, t
+
+def transforms_for_args(args, frames):
+    """
+    Transforms for the --heme_frame options of surface.py, charge.py and vectors.py, or None.
+
+    With --ranges the frames are fitted in batches up front and this is
+    {frame: (R, t)}; otherwise it is a function of a frame's positions that
+    frame_coords() calls on the frame it has already loaded.
+    """
+    if not args.heme_frame:
+        return None
+    universe = load_universe(args.top, args.traj)
+    if not args.ranges:
+        return partial(own_heme_transform, heme=heme_atoms(universe, args.resn))
+    reference = read_pdb(args.frame_ref) if args.frame_ref else None
+    R, t = heme_frame_transforms(universe, frames, parse_ranges(args.ranges), reference, args.resn)
+    print(f"Heme frame transforms computed for {len(frames)} frames")
+    return {frame: (R[i], t[i]) for i, frame in enumerate(frames)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Put a trajectory in the heme frame (FE at the origin, porphyrin in "
+                                                 "the xy-plane, FE->NA along x) with one transform per frame.")
+    parser.add_argument('-s', '--top', type=str, required=True, help="Topology (GRO/PDB)")
+    parser.add_argument('-t', '--traj', type=str, required=True, help="Trajectory (e.g. XTC)")
+    parser.add_argument('-o', '--output', type=str, required=True, help="Output trajectory (format from the extension)")
+    parser.add_argument('--ranges', type=str, default=None,
+                        help="Residue ranges to superpose every frame on the first one, e.g. '5-8,32-40' "
+                             "(default: every frame from its own heme)")
+    parser.add_argument('--ref', type=str, default=None,
+                        help="Reference PDB (e.g. 4I3Q) the first frame is CE-aligned to, with --ranges")
+    parser.add_argument('--resn', type=str, default="HEM*", help="Heme residue name pattern (default: HEM*)")
+    parser.add_argument('-a', '--axis', type=str, default="xy", help="Plane of the porphyrin (default: xy)")
+    parser.add_argument('--start', type=int, default=None, help="First frame")
+    parser.add_argument('--stop', type=int, default=None, help="Last frame (exclusive)")
+    parser.add_argument('--step', type=int, default=None, help="Frame stride")
+    args = parser.parse_args()
+
+    universe = load_universe(args.top, args.traj)
+    frames = frame_numbers(universe, args.start, args.stop, args.step)
+    R, t = heme_frame_transforms(universe, frames, parse_ranges(args.ranges) if args.ranges else None,
+                                 read_pdb(args.ref) if args.ref else None, args.resn, args.axis)
+    write_transformed(universe, frames, R, t, args.output)
+    print(f"✅ {len(frames)} frames in the heme frame written to {args.output}")
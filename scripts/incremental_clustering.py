@@ -0,0 +1,198 @@
+import os
+import json
+import argparse
+import warnings
+import numpy as np
+from vecfile import load_vectors
+from affinity import affinity_propagation, similarities
+from clusterfile import result_path, load_clusters
+import first_clustering
+import second_clustering
+
+def cluster_radii(X, rows, labels, exemplar_rows):
+    """Largest distance between an exemplar and the members of its cluster (0 for singletons)."""
+    radii = np.zeros(len(exemplar_rows))
+    for k, exemplar in enumerate(exemplar_rows):
+        members = rows[labels == k]
+        if len(members):
+            radii[k] = np.sqrt(-similarities(X[members], X[[exemplar]]).min())
+    return radii
+
+def nearest_exemplars(X, rows, exemplar_rows, n_nearest=1, batch_rows=4096):
+    """Indices (into exemplar_rows) and distances of the n_nearest exemplars of every row, nearest first."""
+    order = np.empty((len(rows), n_nearest), dtype=int)
+    distance = np.empty((len(rows), n_nearest))
+    centres = X[exemplar_rows]
+    for start in range(0, len(rows), batch_rows):
+        S = similarities(X[rows[start:start + batch_rows]], centres)
+        nearest = np.argsort(-S, axis=1, kind="stable")[:, :n_nearest]
+        order[start:start + batch_rows] = nearest
+        distance[start:start + batch_rows] = np.sqrt(-np.take_along_axis(S, nearest, axis=1))
+    return order, distance
+
+def update_clustering(X, ids, previous, threshold=None, neighbours=1, **ap_params):
+    """
+    Update a stored clustering after snapshots were added (or removed) without clustering everything again.
+
+    New snapshots join their nearest exemplar when they are within its
+    threshold: the given distance, or by default the cluster's own radius
+    (largest member distance, at least the median radius of all clusters).
+    The rest, together with the members of their `neighbours` nearest
+    clusters and of clusters whose exemplar was removed or changed, are
+    clustered again with Affinity Propagation; all other clusters are kept
+    as they are.
+
+    Returns:
+        cluster_centers_indices (rows of X), labels, changes (dict)
+    """
+    position = {snapshot_id: row for row, snapshot_id in enumerate(ids)}
+    old_ids = [str(i) for i in previous["snapshot_ids"]]
+    old_labels = np.asarray(previous["labels"])
+    kept = np.array([i in position for i in old_ids], dtype=bool)
+    centroid_ids = [str(i) for i in previous["centroid_ids"]]
+
+    # clusters whose exemplar disappeared or whose exemplar vector changed are rebuilt
+    broken = set()
+    for k, (centroid, vector) in enumerate(zip(centroid_ids, previous["centroid_vectors"])):
+        if centroid not in position or not np.allclose(np.asarray(X[position[centroid]], dtype=float), vector,
+                                                       atol=1e-3):
+            broken.add(k)
+
+    labels = np.full(len(ids), -1)
+    old_rows = np.array([position[i] for i, keep in zip(old_ids, kept) if keep], dtype=int)
+    labels[old_rows] = old_labels[kept]
+    # old snapshots left unlabelled (-1) by a run that did not converge are treated as new
+    new_rows = np.flatnonzero(labels < 0)
+    exemplar_rows = np.array([position.get(c, -1) for c in centroid_ids], dtype=int)
+
+    valid = np.array([k not in broken for k in range(len(centroid_ids))], dtype=bool)
+    valid_clusters = np.flatnonzero(valid)
+    affected = set(broken)
+    assigned = np.array([], dtype=int)
+    rejected = new_rows
+    if len(new_rows) and len(valid_clusters):
+        n_nearest = min(max(neighbours, 1), len(valid_clusters))
+        order, distance = nearest_exemplars(X, new_rows, exemplar_rows[valid_clusters], n_nearest)
+        # radii of the valid clusters only, with their members labelled by position in valid_clusters
+        members = old_rows[np.isin(labels[old_rows], valid_clusters)]
+        radii = cluster_radii(X, members, np.searchsorted(valid_clusters, labels[members]),
+                              exemplar_rows[valid_clusters])
+        if threshold is None:
+            limits = np.maximum(radii, np.median(radii))
+        else:
+            limits = np.full(len(valid_clusters), float(threshold))
+        nearest = order[:, 0]
+        accept = distance[:, 0] <= limits[nearest]
+        assigned = new_rows[accept]
+        labels[assigned] = valid_clusters[nearest[accept]]
+        rejected = new_rows[~accept]
+        affected.update(valid_clusters[order[~accept]].ravel().tolist())
+
+    grown = sorted(set(labels[assigned].tolist()) - affected)
+    subset = np.union1d(rejected, np.flatnonzero(np.isin(labels, sorted(affected))))
+
+    # clusters that are kept, then new exemplars from the reclustered neighbourhood
+    kept_clusters = [k for k in range(len(centroid_ids)) if k not in affected]
+    exemplars = [exemplar_rows[k] for k in kept_clusters]
+    final = np.full(len(ids), -1)
+    for new_label, k in enumerate(kept_clusters):
+        final[labels == k] = new_label
+
+    if len(subset) == 1:
+        exemplars.append(subset[0])
+        final[subset] = len(exemplars) - 1
+    elif len(subset):
+        sub_centers, sub_labels = affinity_propagation(np.asarray(X[subset], dtype=float), **ap_params)
+        if len(sub_centers) == 0:
+            warnings.warn("Affinity Propagation did not converge on the reclustered snapshots; "
+                          "they are left unassigned (label -1)")
+        else:
+            final[subset] = sub_labels + len(exemplars)
+            exemplars.extend(subset[sub_centers].tolist())
+
+    # exemplars in row order, like a full AP run
+    exemplars = np.array(exemplars, dtype=int)
+    order = np.argsort(exemplars, kind="stable")
+    relabel = np.empty(len(order), dtype=int)
+    relabel[order] = np.arange(len(order))
+    final[final >= 0] = relabel[final[final >= 0]]
+
+    changes = {
+        "new_snapshots": int(len(new_rows)),
+        "removed_snapshots": int((~kept).sum()),
+        "assigned_to_existing": int(len(assigned)),
+        "reclustered_snapshots": int(len(subset)),
+        "replaced_clusters": [centroid_ids[k] for k in sorted(affected)],
+        "grown_clusters": [centroid_ids[k] for k in grown],
+        "new_clusters": [ids[r] for r in exemplars[order] if ids[r] not in set(centroid_ids)],
+        "exemplars_changed": {ids[r] for r in exemplars} != set(centroid_ids),
+    }
+    return exemplars[order], final, changes
+
+def record_invalidated(path, previous_path, output_file, changes, downstream):
+    """Write what changed and which stored results no longer match (the previous result and everything built on it)."""
+    changed = bool(changes["new_snapshots"] or changes["removed_snapshots"] or changes["replaced_clusters"])
+    invalidated = []
+    if changed:
+        if os.path.abspath(previous_path) != os.path.abspath(result_path(output_file)):
+            invalidated.append(previous_path)
+        invalidated.extend(downstream)
+    record = dict(changes)
+    record["previous_result"] = previous_path
+    record["result"] = result_path(output_file)
+    record["invalidated"] = invalidated
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+    return record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update a first- or second-round clustering with new snapshots or systems.")
+    parser.add_argument('input', help="All vectors, old and new: vector file (first round) or post_first_clustering.py "
+                                      "output (second round, with --exemplars)")
+    parser.add_argument('previous', help="Previous result (.npz written by first_clustering.py or second_clustering.py)")
+    parser.add_argument('output', help="Output text report (the .npz and .invalidated.json are written next to it)")
+    parser.add_argument('--exemplars', action='store_true', help="Second round: input is a post_first_clustering.py file")
+    parser.add_argument('--threshold', type=float, default=None,
+                        help="Distance within which a new snapshot joins an existing exemplar "
+                             "(default: the radius of that cluster)")
+    parser.add_argument('--neighbours', type=int, default=1,
+                        help="Nearest clusters of every unassigned snapshot that are clustered again with it")
+    parser.add_argument('--preference', type=float, default=None,
+                        help="Affinity Propagation preference (default: -2000, or -22000 with --exemplars)")
+    parser.add_argument('--damping', type=float, default=None,
+                        help="Affinity Propagation damping (default: 0.9, or 0.5 with --exemplars)")
+    parser.add_argument('--engine', choices=["sklearn", "native"], default="sklearn")
+    parser.add_argument('--downstream', nargs='*', default=[],
+                        help="Results built from the previous one (merged exemplar file, second-round reports) "
+                             "to list as invalidated")
+    args = parser.parse_args()
+
+    if args.exemplars:
+        all_data, contributing_snapshots = second_clustering.read_exemplars(args.input)
+        ids = second_clustering.exemplar_ids(all_data)
+        X = np.array([data[3] for data in all_data])
+        defaults = (-22000, 0.5)
+    else:
+        snapshot_ids, X, info = load_vectors(args.input)
+        structure_indices = [int(float(snapshot_id)) for snapshot_id in snapshot_ids]
+        ids = [str(i) for i in structure_indices]
+        defaults = (-2000, 0.9)
+
+    previous = load_clusters(args.previous)
+    centers, labels, changes = update_clustering(
+        X, ids, previous, args.threshold, args.neighbours, engine=args.engine,
+        preference=defaults[0] if args.preference is None else args.preference,
+        damping=defaults[1] if args.damping is None else args.damping, max_iter=500, convergence_iter=100)
+
+    if args.exemplars:
+        second_clustering.write_report(args.output, all_data, contributing_snapshots, centers, labels)
+    else:
+        first_clustering.write_report(args.output, structure_indices, X, centers, labels)
+
+    log = os.path.splitext(args.output)[0] + ".invalidated.json"
+    record = record_invalidated(log, args.previous, args.output, changes, args.downstream)
+    print(f"{changes['new_snapshots']} new and {changes['removed_snapshots']} removed snapshots: "
+          f"{changes['assigned_to_existing']} joined existing clusters, {changes['reclustered_snapshots']} reclustered "
+          f"({len(changes['replaced_clusters'])} clusters replaced, {len(changes['new_clusters'])} new)")
+    print(f"✅ Updated clustering saved to {args.output}; invalidated results listed in {log}")
@@ -1,33 +1,124 @@
+import json
+import argparse
 import numpy as np
+from vecfile import iter_batches, read_info, open_writer
 
-# === CONFIGURATION ===
-input_file = "../charge.txt"    # <-- change this
-output_file = "charge.txt"  # <-- change this
+def fit_statistics(input_file, batch_rows=4096):
+    """
+    Per-column count, mean and sum of squared deviations (M2) in one streaming pass.
 
-# === LOAD FILE & COMPUTE STD ===
-all_values = []
+    Batches are merged with the parallel form of Welford's algorithm (Chan et al.),
+    so only one batch is held in memory and the result is numerically stable.
+    """
+    count = 0
+    mean = None
+    m2 = None
+    for ids, values in iter_batches(input_file, batch_rows):
+        n = len(values)
+        if n == 0:
+            continue
+        batch_mean = values.mean(axis=0)
+        batch_m2 = ((values - batch_mean) ** 2).sum(axis=0)
+        if mean is None:
+            count, mean, m2 = n, batch_mean, batch_m2
+            continue
+        delta = batch_mean - mean
+        total = count + n
+        mean = mean + delta * n / total
+        m2 = m2 + batch_m2 + delta ** 2 * count * n / total
+        count = total
 
-with open(input_file, 'r') as f:
-    for line in f:
-        parts = line.strip().split()
-        values = list(map(float, parts[1:]))  # skip snapshot ID
-        all_values.extend(values)
+    if count == 0:
+        raise ValueError(f"No rows in {input_file}: cannot fit normalization statistics")
+    info = read_info(input_file)
+    return {"count": count, "mean": mean.tolist(), "m2": m2.tolist(), "blocks": info["blocks"]}
 
-all_values_np = np.array(all_values)
-global_std = np.std(all_values_np)
+def pooled_std(count, mean, m2):
+    """Population std of the union of columns that each have count values, given their means and M2."""
+    mean = np.asarray(mean)
+    m2 = np.asarray(m2)
+    total_mean = mean.mean()
+    total_m2 = m2.sum() + count * ((mean - total_mean) ** 2).sum()
+    return float(np.sqrt(total_m2 / (count * len(mean))))
 
-print(f"File: {input_file}")
-print(f"Global std: {global_std:.4f}")
+def column_scales(stats, mode="global"):
+    """
+    Divisor for every column.
 
-# === NORMALIZE (values / global_std) & SAVE ===
-with open(input_file, 'r') as fin, open(output_file, 'w') as fout:
-    for line in fin:
-        parts = line.strip().split()
-        snapshot_id = parts[0]
-        values = np.array(list(map(float, parts[1:])))
-        norm_values = values / global_std
-        norm_str = ' '.join(f"{v:.6f}" for v in norm_values)
-        fout.write(f"{snapshot_id} {norm_str}\n")
+    global: one std over all values (the original normalization).
+    column: the std of every column.
+    block:  one std per block (e.g. lengths and charges).
+    """
+    count = stats["count"]
+    mean = np.asarray(stats["mean"])
+    m2 = np.asarray(stats["m2"])
+    if mode == "global":
+        scales = np.full(len(mean), pooled_std(count, mean, m2))
+    elif mode == "column":
+        scales = np.sqrt(m2 / count)
+    elif mode == "block":
+        sizes = [size for name, size in stats["blocks"]]
+        if sum(sizes) != len(mean):
+            raise ValueError(f"Block sizes {','.join(map(str, sizes))} add up to {sum(sizes)}, "
+                             f"but there are {len(mean)} columns")
+        scales = np.full(len(mean), np.nan)
+        start = 0
+        for name, size in stats["blocks"]:
+            scales[start:start + size] = pooled_std(count, mean[start:start + size], m2[start:start + size])
+            start += size
+    else:
+        raise ValueError(f"Unknown normalization mode: {mode}")
+    # constant columns are left unscaled instead of becoming inf/nan
+    scales[scales == 0] = 1.0
+    return scales
 
-print(f"\n✅ Normalization complete. Output saved to: {output_file}")
+def normalize(input_file, output_file, scales, blocks=None, batch_rows=4096):
+    """Divide every row by the column scales, streaming from input to output."""
+    info = read_info(input_file)
+    with open_writer(output_file, info["metadata"], blocks or info["blocks"], fmt=".6f") as fout:
+        for ids, values in iter_batches(input_file, batch_rows):
+            for snapshot_id, row in zip(ids, values / scales):
+                fout.write(snapshot_id, row)
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Normalize vector lengths and/or charges by their standard deviation.")
+    parser.add_argument('input', help="Input vector file (text or binary .vec)")
+    parser.add_argument('output', help="Output vector file (*.vec for the binary vector format)")
+    parser.add_argument('--mode', choices=["global", "column", "block"], default="global",
+                        help="One std for all values, one per column, or one per block (lengths/charges)")
+    parser.add_argument('--blocks', type=str, default=None,
+                        help="Comma-separated block sizes, e.g. 745,745 for a combined text file (default: from the file)")
+    parser.add_argument('--save_stats', type=str, default=None, help="Save the fitted statistics to this JSON file")
+    parser.add_argument('--stats', type=str, default=None,
+                        help="Use statistics saved with --save_stats instead of fitting them on the input")
+    parser.add_argument('--batch', type=int, default=4096, help="Rows read at a time")
+    args = parser.parse_args()
+
+    if args.stats:
+        with open(args.stats, 'r') as f:
+            stats = json.load(f)
+    else:
+        stats = fit_statistics(args.input, args.batch)
+    if args.blocks:
+        sizes = [int(size) for size in args.blocks.split(',')]
+        if sum(sizes) != len(stats["mean"]):
+            parser.error(f"--blocks {args.blocks} adds up to {sum(sizes)} columns, the statistics have {len(stats['mean'])}")
+        stats["blocks"] = [[f"block{i}", size] for i, size in enumerate(sizes)]
+    if args.save_stats:
+        with open(args.save_stats, 'w') as f:
+            json.dump(stats, f)
+
+    scales = column_scales(stats, args.mode)
+    print(f"File: {args.input}")
+    if args.mode == "global":
+        print(f"Global std: {scales[0]:.4f}")
+    elif args.mode == "block":
+        start = 0
+        for name, size in stats["blocks"]:
+            print(f"{name} std: {scales[start]:.4f}")
+            start += size
+
+    normalize(args.input, args.output, scales, stats["blocks"], args.batch)
+
+    print(f"\n✅ Normalization complete. Output saved to: {args.output}")
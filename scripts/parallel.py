@@ -0,0 +1,78 @@
+import traceback
+import numpy as np
+from multiprocessing import Pool, shared_memory
+
+# State of the current worker process, filled once by init_worker()
+WORKER = {}
+
+def share_array(array):
+    """Copy an array into shared memory. Returns the block and a picklable (name, shape, dtype) spec."""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    """Map an array created by share_array() without copying it."""
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def init_worker(lattice, function, setup=None, setup_args=()):
+    """
+    Prepare a worker once: attach the lattice and run setup(*setup_args).
+
+    lattice is either an array (in-process run) or a share_array() spec.
+    setup returns a dict of per-worker state (e.g. an open trajectory)
+    that the task function reads from WORKER. An exception in the setup
+    (e.g. a missing trajectory) is kept in WORKER['setup_error'] and
+    reported for every task, instead of letting the pool restart the
+    worker forever.
+    """
+    WORKER.clear()
+    try:
+        if isinstance(lattice, tuple):
+            # keep the block referenced so the mapping lives as long as the worker
+            WORKER['shm'], lattice = attach_array(lattice)
+        WORKER['lattice'] = lattice
+        WORKER['function'] = function
+        if setup:
+            WORKER.update(setup(*setup_args))
+    except Exception:
+        WORKER['setup_error'] = traceback.format_exc()
+
+def _run(task):
+    if 'setup_error' in WORKER:
+        return task, None, f"Worker setup failed:\n{WORKER['setup_error']}"
+    try:
+        return task, WORKER['function'](task), None
+    except Exception:
+        return task, None, traceback.format_exc()
+
+def map_ordered(function, tasks, lattice, jobs=1, chunksize=None, setup=None, setup_args=()):
+    """
+    Run function(task) for every task, on jobs worker processes.
+
+    The lattice is placed in shared memory once instead of being pickled
+    with every task, and tasks are dispatched in chunks. Results are
+    yielded as (task, result, error) in input order; error is the
+    traceback text if the task raised, so one failed frame does not stop
+    the run.
+    """
+    if jobs <= 1:
+        init_worker(lattice, function, setup, setup_args)
+        for task in tasks:
+            yield _run(task)
+        return
+
+    tasks = list(tasks)
+    if chunksize is None:
+        chunksize = max(1, len(tasks) // (jobs * 4))
+    shm, spec = share_array(lattice)
+    try:
+        with Pool(jobs, initializer=init_worker, initargs=(spec, function, setup, setup_args)) as pool:
+            for result in pool.imap(_run, tasks, chunksize):
+                yield result
+    finally:
+        shm.close()
+        shm.unlink()
@@ -1,83 +1,55 @@
 import os
-import numpy as np
-
-def extract_centroids(cluster_filename):
-    """Extract centroid indices from a cluster file using a generator."""
-    with open(cluster_filename, 'r') as file:
-        for line in file:
-            if line.startswith("  Centroid Structure Index: "):
-                yield line.split(": ")[1].strip()
-def extract_snapshot_number(cluster_filename):
-    '''Extracts the number of snapshots populating each cluster'''
-    with open(cluster_filename,'r') as file:
-        numbers=[]
-        for line in file:
-            if line.startswith("  Number of Structures:"):
-                numbers.append(line.split(": ")[1].strip())
-    return (np.array(numbers))
-def read_vectors(cluster_filename):
-    """Read all vector lengths for centroid structures from a file and return as a list of NumPy arrays."""
-    vectors_list = []
-    with open(cluster_filename, 'r') as file:
-        for line in file:
-            if line.strip().startswith("Vectors lengths for centroid structure:"):
-                values_str = line.split(":", 1)[1].strip()
-
-                while not values_str.endswith("]"):
-                    next_line = next(file).strip()
-                    values_str += " " + next_line
-
-                values = eval(values_str)  # controlled input, safe use here
-                vectors_list.append(np.array(values))
-
-    return vectors_list
-
+import glob
+import argparse
+from clusterfile import CLUSTER_SUFFIX, result_path, load_clusters, parse_report
+
+def find_cluster_files(patterns):
+    """
+    Expand glob patterns into cluster results, one per system, in the order given (sorted within a pattern).
+
+    A text report is replaced by its .npz result when one exists; reports
+    without one (older runs) are parsed as text.
+    """
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"⚠️ No cluster files match {pattern}")
+        for path in matches:
+            if not path.endswith(CLUSTER_SUFFIX) and os.path.exists(result_path(path)):
+                path = result_path(path)
+            if path not in files:
+                files.append(path)
+    # a system given both as .npz and as its report is read once
+    return [path for path in files
+            if path.endswith(CLUSTER_SUFFIX) or result_path(path) not in files]
+
+def load_result(path):
+    """Centroid ids, cluster sizes and centroid vectors of one system, from the .npz result or the text report."""
+    if path.endswith(CLUSTER_SUFFIX):
+        return load_clusters(path)
+    return parse_report(path)
 
 def process_cluster_files(clusters, output_filename):
-    """Process cluster files and write matching centroids to output."""
+    """Write the exemplars of every system as: centroid, report name, cluster size, centroid vector."""
     results = []
     for cluster_file in clusters:
-        vectors = read_vectors(cluster_file)
-        cluster_filename = os.path.basename(cluster_file)  # Get filename only
-        numbers=extract_snapshot_number(cluster_file)
-        i=0
-        centroids = extract_centroids(cluster_file)
-        for centroid in centroids:
-            vector_str = ' '.join(f"{x:.3f}" for x in vectors[i])  # format floats nicely
-            results.append(f"{centroid} {cluster_filename} {numbers[i]} {vector_str}\n")
-            i+=1
+        result = load_result(cluster_file)
+        for centroid, size, vector in zip(result["centroid_ids"], result["sizes"], result["centroid_vectors"]):
+            vector_str = ' '.join(f"{x:.3f}" for x in vector)  # format floats nicely
+            results.append(f"{centroid} {result['report']} {size} {vector_str}\n")
 
     # Write everything at once to improve performance
     with open(output_filename, 'w') as output_file:
         output_file.writelines(results)
+    print(f"Merged {len(results)} exemplars from {len(clusters)} systems into {output_filename}")
 
 if __name__ == "__main__":
-    clusters = [
- 	        ("clusters_3a4.txt"),
-       ("clusters_1a2.txt"),
-        ("clusters_2d6.txt"),
-        ("clusters_2c9.txt"),
-        ("clusters_2c19.txt"),
-        
-        ("clusters_81a1.txt"),
-        ("clusters_81a2.txt"),
-        ("clusters_81a4.txt"),
-        ("clusters_81a9.txt"),
-        ("clusters_81a16.txt"),
-        
-        ("clusters_72a31.txt"),
-        ("clusters_81a6.txt"),
-        
-        ("clusters_72a188.txt"),
-        ("clusters_72a208.txt"),
-        ("clusters_79a1.txt"),
-        ("clusters_79e1.txt"),
-        ("clusters_81f2.txt"),
-        ("clusters_81f4.txt"),
-        ("clusters_90c1.txt"),
-        ("clusters_90d1.txt"),
-        ("clusters_2a6.txt")
-    ]  # Add all corresponding cluster and vector file pairs here
-    output_file = "clusters_all_vectors.txt"
-    process_cluster_files(clusters, output_file)
-
+    parser = argparse.ArgumentParser(description="Merge the first-round exemplars of all systems into one weighted file.")
+    parser.add_argument('clusters', nargs='*', default=["clusters_*" + CLUSTER_SUFFIX],
+                        help="Cluster results (.npz) or reports (.txt), as files or glob patterns "
+                             "(default: clusters_*.npz)")
+    parser.add_argument('-o', '--output', type=str, default="clusters_all_vectors.txt", help="Output file")
+    args = parser.parse_args()
+
+    process_cluster_files(find_cluster_files(args.clusters), args.output)
@@ -0,0 +1,454 @@
+import numpy as np
+
+# Default memory budget for the ray x atom temporaries of one chunk (bytes)
+DEFAULT_MAX_MEMORY = 256 * 1024 ** 2
+
+# Rough number of bytes held per ray/atom pair while a chunk is evaluated
+# (dot products, cosines, distances and masks as float64/bool temporaries)
+_PAIR_BYTES = 12 * 8
+
+# Padding (in A) added to atom radii when selecting candidate rays, so that
+# rounding of d, y and t near tangency cannot drop a real hit
+CONE_MARGIN = 0.01
+
+# Default skin (in A) of the per-ray candidate lists of method="incremental"
+DEFAULT_SKIN = 1.0
+
+
+def pair_distances(dots, d, vnorm, r, same, decimals=None):
+    """
+    Distance from the origin along a ray to the first touch of an atom sphere.
+
+    All arguments are broadcastable arrays over ray/atom pairs:
+        dots (array): S . V for the atom centre S and lattice vector V.
+        d (array): |S|, distance of the atom centre from the origin.
+        vnorm (array): |V|, length of the lattice vector.
+        r (array): Atom radius.
+        same (array): True where S and V are the same point.
+        decimals (int): Round d, y and t like surface.py does (None = no rounding).
+
+    Returns inf for pairs where the ray misses the sphere.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if decimals is not None:
+            d = np.round(d, decimals)
+        cos_alpha = dots / (d * vnorm)
+        facing = (cos_alpha >= 0) & (cos_alpha <= 1)
+
+        # y is the distance of the atom centre from the ray
+        y = d * np.sqrt(np.clip(1.0 - cos_alpha * cos_alpha, 0.0, None))
+        t = np.abs(dots) / vnorm
+        if decimals is not None:
+            y = np.round(y, decimals)
+            t = np.round(t, decimals)
+        x = np.sqrt(np.clip(r * r - y * y, 0.0, None))
+
+        t1 = np.where(y < r, t - x, dots / vnorm)
+        t1 = np.where(facing & (y <= r), t1, np.inf)
+        t1 = np.where(same, d - r, t1)
+    return t1
+
+
+def cast_rays(surface_coords, protein_coords, atom_radius, decimals=None, max_memory=DEFAULT_MAX_MEMORY,
+              method="index", ids=None, cache=None):
+    """
+    Cast every lattice vector against the atom spheres as array operations.
+
+    method="dense" tests all ray x atom pairs, in chunks of rays so that the
+    temporaries stay below max_memory bytes. method="index" first selects,
+    for each atom, only the rays inside the cone its sphere subtends from
+    the origin, so the cost scales with the number of hits.
+    method="incremental" is the index method for consecutive frames of one
+    system: ids are stable, increasing atom identifiers (e.g. positions in
+    the atom template) and cache a dict kept between frames (see
+    cast_incremental()).
+
+    Returns:
+        t_near (array): Distance to the nearest hit for each ray (inf if none).
+        hit_index (array): Index of the nearest hit atom for each ray (-1 if none).
+    """
+    surface_coords = np.asarray(surface_coords, dtype=float)
+    protein_coords = np.asarray(protein_coords, dtype=float).reshape(-1, 3)
+    atom_radius = np.asarray(atom_radius, dtype=float)
+
+    n_rays = len(surface_coords)
+    n_atoms = len(protein_coords)
+    t_near = np.full(n_rays, np.inf)
+    hit_index = np.full(n_rays, -1, dtype=int)
+    if n_rays == 0 or (n_atoms == 0 and method != "incremental"):
+        return t_near, hit_index
+
+    if method == "index":
+        return _cast_indexed(surface_coords, protein_coords, atom_radius, decimals, max_memory)
+    if method == "incremental":
+        return cast_incremental(cache, surface_coords, protein_coords, atom_radius, ids, decimals)
+    if method != "dense":
+        raise ValueError(f"Unknown ray casting method: {method}")
+
+    d = np.linalg.norm(protein_coords, axis=1)
+    vnorm = np.linalg.norm(surface_coords, axis=1)
+    chunk = max(1, int(max_memory // (n_atoms * _PAIR_BYTES)))
+
+    for start in range(0, n_rays, chunk):
+        V = surface_coords[start:start + chunk]
+        dots = V @ protein_coords.T
+        same = np.all(V[:, None, :] == protein_coords[None, :, :], axis=2)
+        t1 = pair_distances(dots, d[None, :], vnorm[start:start + chunk, None],
+                            atom_radius[None, :], same, decimals)
+
+        # argmin keeps the first atom on ties, like the strict < of the loops
+        nearest = np.argmin(t1, axis=1)
+        best = t1[np.arange(len(V)), nearest]
+        hit = np.isfinite(best)
+        t_near[start:start + chunk] = best
+        hit_index[start:start + chunk] = np.where(hit, nearest, -1)
+
+    return t_near, hit_index
+
+
+def cast_sequential(surface_coords, protein_coords, atom_radius, radius_sphere):
+    """
+    The lattice loop of the original surface.py, one atom at a time over all rays at once.
+
+    Unlike cast_rays(), the loop rescales each lattice vector V to every
+    hit it finds (capped at radius_sphere, kept only if it stays in the
+    upper hemisphere) and divides by |V| rounded to 3 decimals, so later
+    atoms see a slightly different ray. This reproduces its lengths exactly;
+    they differ from the fixed-ray geometry by up to about 1.4 A on rays
+    that graze an atom.
+
+    Returns:
+        t_near (array): Distance to the nearest hit for each ray (inf if none).
+        hit_index (array): Index of the nearest hit atom for each ray (-1 if none).
+    """
+    V = np.array(surface_coords, dtype=float).reshape(-1, 3)
+    protein_coords = np.asarray(protein_coords, dtype=float).reshape(-1, 3)
+    t_near = np.full(len(V), np.inf)
+    hit_index = np.full(len(V), -1, dtype=int)
+
+    def dot(a, b):
+        # row-wise, with the same arithmetic as np.dot() on one pair of 3-vectors
+        return np.matmul(a[:, None, :], b[:, :, None])[:, 0, 0]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, (S, r) in enumerate(zip(protein_coords, atom_radius)):
+            d = np.round(np.linalg.norm(S), 3)
+            dots = dot(V, np.broadcast_to(S, V.shape))
+            vnorm = np.sqrt(dot(V, V))
+            cos_alpha = dots / (d * np.round(vnorm, 3))
+            same = np.all(V == S, axis=1)
+            facing = ~same & (cos_alpha >= 0) & (cos_alpha <= 1)
+            y = np.round(d * np.sqrt(1.0 - cos_alpha * cos_alpha), 3)
+            through = facing & (y < r)
+            tangent = facing & (y == r)
+            t1 = np.where(through, np.round(np.abs(dots) / vnorm, 3) - np.sqrt(r * r - y * y), dots / vnorm)
+            t1 = np.where(same, d - r, t1)
+
+            # the vector moves to a through hit (capped, upper hemisphere only) and to d - r on an atom centre
+            scaled = np.where(same, t1, np.minimum(t1, radius_sphere))[:, None] * (V / vnorm[:, None])
+            moved = same | (through & (scaled[:, 2] >= 0))
+            V[moved] = scaled[moved]
+
+            closer = (same | through | tangent) & (t1 < t_near)
+            t_near[closer] = t1[closer]
+            hit_index[closer] = i
+    return t_near, hit_index
+
+
+def file_method(method):
+    """Ray casting method for single structure files: "incremental" only pays off across trajectory frames."""
+    return "index" if method == "incremental" else method
+
+
+def cast_cutoffs(surface_coords, protein_coords, atom_radius, cutoffs, decimals=None, max_memory=DEFAULT_MAX_MEMORY,
+                 method="index", ids=None, cache=None, sequential=False):
+    """
+    Nearest hits for several sphere cutoffs from one ray cast.
+
+    protein_coords are the atoms within the largest cutoff + 2 of the origin;
+    the atoms of cutoff r are those closer than r + 2, the prefilter of the
+    scripts. The rays are cast once against all atoms, and only the rays
+    whose nearest atom lies outside the prefilter of a smaller cutoff are
+    cast again against that cutoff's atoms, so each result is identical to
+    a separate cast_rays() run on the atoms of that cutoff.
+
+    With sequential=True every cutoff is cast separately with
+    cast_sequential() (the cutoff changes how its rays are rescaled), and
+    decimals, max_memory, method, ids and cache are not used.
+
+    Returns one (t_near, hit_index, members) per cutoff, with hit_index into
+    protein_coords and members the mask of the atoms of the cutoff.
+    """
+    protein_coords = np.asarray(protein_coords, dtype=float).reshape(-1, 3)
+    atom_radius = np.asarray(atom_radius, dtype=float)
+    if sequential:
+        d = np.linalg.norm(protein_coords, axis=1)
+        results = []
+        for cutoff in cutoffs:
+            members = d < cutoff + 2
+            atoms = np.flatnonzero(members)
+            t_near, hit_index = cast_sequential(surface_coords, protein_coords[atoms], atom_radius[atoms], cutoff)
+            hit_index[hit_index != -1] = atoms[hit_index[hit_index != -1]]
+            results.append((t_near, hit_index, members))
+        return results
+    t_all, hit_all = cast_rays(surface_coords, protein_coords, atom_radius, decimals, max_memory, method, ids, cache)
+    d = np.linalg.norm(protein_coords, axis=1)
+
+    results = []
+    for cutoff in cutoffs:
+        members = d < cutoff + 2
+        t_near, hit_index = t_all.copy(), hit_all.copy()
+        recast = hit_index != -1
+        recast[recast] = ~members[hit_index[recast]]
+        if recast.any():
+            atoms = np.flatnonzero(members)
+            t_near[recast], hits = cast_rays(np.asarray(surface_coords, dtype=float)[recast], protein_coords[atoms],
+                                             atom_radius[atoms], decimals, max_memory, file_method(method))
+            hit_index[recast] = -1
+            hit_index[np.flatnonzero(recast)[hits != -1]] = atoms[hits[hits != -1]]
+        results.append((t_near, hit_index, members))
+    return results
+
+
+def candidate_pairs(surface_coords, protein_coords, atom_radius, margin=CONE_MARGIN, tree=None):
+    """
+    Ray/atom pairs whose sphere can intersect the ray.
+
+    Rays all start at the origin, so a sphere of radius r at distance d can
+    only be hit by rays within asin(r / d) of its centre direction (the
+    whole facing hemisphere if the origin is inside the sphere). The lattice
+    directions are put in a KD-tree and each atom queries the chord that
+    matches its cone; the radius is padded by margin so rounded distances
+    near tangency are still tested exactly. A KD-tree over the lattice
+    directions from an earlier call can be passed as tree.
+
+    Returns:
+        rays (array), atoms (array): Index pairs, sorted by atom.
+    """
+    from scipy.spatial import cKDTree
+
+    units = surface_coords / np.linalg.norm(surface_coords, axis=1)[:, None]
+    d = np.linalg.norm(protein_coords, axis=1)
+    padded = atom_radius + margin
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        half_angle = np.arcsin(np.clip(padded / d, 0.0, 1.0))
+        centres = protein_coords / d[:, None]
+    chord = 2.0 * np.sin(half_angle / 2.0) + 1e-9
+    # the cone test is meaningless when the origin is inside the sphere
+    inside = ~(d > padded)
+    chord[inside] = 2.0 + 1e-9
+    centres[inside] = 0.0
+
+    if tree is None:
+        tree = cKDTree(units)
+    hits = tree.query_ball_point(centres, chord)
+    counts = np.fromiter((len(h) for h in hits), dtype=int, count=len(hits))
+    rays = np.fromiter((i for h in hits for i in h), dtype=int, count=counts.sum())
+    atoms = np.repeat(np.arange(len(protein_coords)), counts)
+    return rays, atoms
+
+
+def _cast_indexed(surface_coords, protein_coords, atom_radius, decimals, max_memory):
+    """Nearest hit per ray, testing only the candidate pairs from candidate_pairs()."""
+    n_rays = len(surface_coords)
+    t_near = np.full(n_rays, np.inf)
+    hit_index = np.full(n_rays, -1, dtype=int)
+
+    rays, atoms = candidate_pairs(surface_coords, protein_coords, atom_radius)
+    chunk = max(1, int(max_memory // _PAIR_BYTES))
+    for start in range(0, len(rays), chunk):
+        ray = rays[start:start + chunk]
+        atom = atoms[start:start + chunk]
+        V = surface_coords[ray]
+        S = protein_coords[atom]
+        t1 = pair_distances(np.einsum('ij,ij->i', S, V), np.linalg.norm(S, axis=1),
+                            np.linalg.norm(V, axis=1), atom_radius[atom],
+                            np.all(S == V, axis=1), decimals)
+
+        # Pairs arrive sorted by atom, so within a ray the earlier atom wins ties
+        hit = np.isfinite(t1)
+        ray, atom, t1 = ray[hit], atom[hit], t1[hit]
+        order = np.lexsort((atom, t1, ray))
+        ray, atom, t1 = ray[order], atom[order], t1[order]
+        first = np.ones(len(ray), dtype=bool)
+        first[1:] = ray[1:] != ray[:-1]
+        ray, atom, t1 = ray[first], atom[first], t1[first]
+
+        better = t1 < t_near[ray]
+        t_near[ray[better]] = t1[better]
+        hit_index[ray[better]] = atom[better]
+
+    return t_near, hit_index
+
+
+def _entry_bounds(surface_coords, ref, atom_radius, rays, atoms, spread, decimals=None):
+    """
+    Lower and upper bounds on t1 of each ray/atom pair while the atom stays
+    within spread of its reference position: the first touch of the sphere
+    grown by spread (it contains the moved sphere) and of the sphere shrunk
+    by spread (contained in it). The radii are padded for the rounding of
+    pair_distances(): rounding d to decimals shifts y^2 by up to about
+    d * 10^-decimals. Pairs with the origin inside the grown sphere are
+    never bounded, and rays that can pass through the centre give no upper
+    bound.
+    """
+    S = ref[atoms]
+    V = surface_coords[rays]
+    dots = np.einsum('ij,ij->i', S, V)
+    d = np.linalg.norm(S, axis=1)
+    vnorm = np.linalg.norm(V, axis=1)
+    no_same = np.zeros(len(rays), dtype=bool)
+    pad = CONE_MARGIN
+    if decimals is not None:
+        pad = pad + np.sqrt((d + spread + 1.0) * 10.0 ** -decimals)
+    grown = atom_radius[atoms] + spread + pad
+    shrunk = atom_radius[atoms] - spread - pad
+    lower = pair_distances(dots, d, vnorm, grown, no_same) - CONE_MARGIN
+    upper = np.where(shrunk > 0, pair_distances(dots, d, vnorm, np.clip(shrunk, 0.0, None), no_same), np.inf)
+    upper = upper + CONE_MARGIN
+    # A ray through (or next to) the centre can miss after rounding (cos_alpha > 1), so it gives no upper bound
+    with np.errstate(invalid='ignore'):
+        y = np.sqrt(np.clip(d * d - (dots / vnorm) ** 2, 0.0, None))
+    upper[y <= spread + pad] = np.inf
+    unbounded = d <= grown
+    lower[unbounded] = -np.inf
+    upper[unbounded] = np.inf
+    return lower, upper
+
+
+def _ray_minimum(n_rays, rays, values):
+    """Smallest value per ray (inf for rays without values); rays must be sorted."""
+    best = np.full(n_rays, np.inf)
+    if len(rays):
+        starts = np.flatnonzero(np.concatenate([[True], rays[1:] != rays[:-1]]))
+        best[rays[starts]] = np.minimum.reduceat(values, starts)
+    return best
+
+
+# Per-pair arrays of the incremental cache, kept sorted by (ray, atom id)
+_PAIR_FIELDS = ("key", "rays", "slots", "lower", "upper")
+
+
+def cast_incremental(cache, surface_coords, protein_coords, atom_radius, ids, decimals=None):
+    """
+    Nearest hit per ray for one frame of a trajectory, reusing earlier frames.
+
+    Verlet-style candidate lists: every atom keeps the rays of its cone
+    padded by half the skin (cache["skin"]) around the position where the
+    list was built, with bounds on the hit distance that hold as long as no
+    atom has moved more than half the skin. A ray then only evaluates the
+    atoms whose lower bound is not beyond the smallest upper bound of its
+    atoms; the lists and bounds are built again when some atom has moved
+    further, and atoms entering the binding site are queried on their own.
+    Ties go to the lower id, so the result is identical to cast_rays() with
+    method="index" on the same atoms.
+
+    cache is a dict, e.g. {"skin": 1.0}, that holds the state between calls
+    for one lattice. ids are stable, increasing atom identifiers (e.g.
+    positions in the atom template).
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    spread = cache.setdefault("skin", DEFAULT_SKIN) / 2
+    n_rays = len(surface_coords)
+    if "tree" not in cache:
+        from scipy.spatial import cKDTree
+
+        cache.update(tree=cKDTree(surface_coords / np.linalg.norm(surface_coords, axis=1)[:, None]),
+                     vnorm=np.linalg.norm(surface_coords, axis=1), n_rays=n_rays, decimals=decimals,
+                     slot_of=np.full(0, -1, dtype=np.int64), slot_ids=np.empty(0, dtype=np.int64),
+                     ref=np.empty((0, 3)), radius=np.empty(0), listed=np.empty(0, dtype=bool),
+                     active=np.empty(0, dtype=bool), bound=np.full(n_rays, np.inf), rebuilds=0)
+        cache.update({field: np.empty(0, dtype=np.int64 if field in ("key", "rays", "slots") else float)
+                      for field in _PAIR_FIELDS})
+    if cache["n_rays"] != n_rays or cache["decimals"] != decimals:
+        raise ValueError("The incremental ray cache belongs to another lattice")
+
+    # Slots for atoms seen for the first time
+    if len(ids) and ids.max() >= len(cache["slot_of"]):
+        grown = np.full(ids.max() + 1, -1, dtype=np.int64)
+        grown[:len(cache["slot_of"])] = cache["slot_of"]
+        cache["slot_of"] = grown
+    new_ids = ids[cache["slot_of"][ids] == -1]
+    if len(new_ids):
+        cache["slot_of"][new_ids] = len(cache["slot_ids"]) + np.arange(len(new_ids))
+        cache["slot_ids"] = np.concatenate([cache["slot_ids"], new_ids])
+        cache["ref"] = np.concatenate([cache["ref"], np.zeros((len(new_ids), 3))])
+        cache["radius"] = np.concatenate([cache["radius"], np.zeros(len(new_ids))])
+        cache["listed"] = np.concatenate([cache["listed"], np.zeros(len(new_ids), dtype=bool)])
+        cache["active"] = np.concatenate([cache["active"], np.zeros(len(new_ids), dtype=bool)])
+
+    n_slots = len(cache["slot_ids"])
+    slot = cache["slot_of"][ids]
+    coords = np.zeros((n_slots, 3))
+    coords[slot] = protein_coords
+    active = np.zeros(n_slots, dtype=bool)
+    active[slot] = True
+    radius = cache["radius"].copy()
+    radius[slot] = atom_radius
+    listed = cache["listed"].copy()
+
+    # Lists of atoms that moved more than half the skin are no longer valid: build all lists again
+    moved = listed[slot] & ((np.linalg.norm(protein_coords - cache["ref"][slot], axis=1) > spread) |
+                            (atom_radius != cache["radius"][slot]))
+    if moved.any() or not listed.any():
+        listed[:] = False
+        cache.update({field: cache[field][:0] for field in _PAIR_FIELDS})
+        cache.update(bound=np.full(n_rays, np.inf), active=np.zeros(n_slots, dtype=bool))
+        cache["rebuilds"] += 1
+
+    # Atoms without a list (after a rebuild or entering the binding site) are queried on their own
+    query = np.flatnonzero(active & ~listed)
+    if len(query):
+        rays, atoms = candidate_pairs(surface_coords, coords[query], radius[query], CONE_MARGIN + spread,
+                                      cache["tree"])
+        lower, upper = _entry_bounds(surface_coords, coords[query], radius[query], rays, atoms, spread, decimals)
+        new = {"key": rays * (1 << 32) + cache["slot_ids"][query[atoms]], "rays": rays, "slots": query[atoms],
+               "lower": lower, "upper": upper}
+        order = np.argsort(new["key"], kind="stable")
+        at = np.searchsorted(cache["key"], new["key"][order])
+        cache.update({field: np.insert(cache[field], at, new[field][order]) for field in _PAIR_FIELDS})
+        cache["ref"][query] = coords[query]
+        listed[query] = True
+
+    # Upper bound of every ray over its active atoms, updated for the rays of atoms that entered or left
+    flipped = active != cache["active"]
+    if flipped.any():
+        touched = np.zeros(n_rays, dtype=bool)
+        touched[cache["rays"][flipped[cache["slots"]]]] = True
+        sel = touched[cache["rays"]] & active[cache["slots"]]
+        cache["bound"][touched] = _ray_minimum(n_rays, cache["rays"][sel], cache["upper"][sel])[touched]
+    cache.update(radius=radius, listed=listed, active=active)
+
+    # Exact hit distances only for the pairs that can still be the nearest hit of their ray
+    sel = active[cache["slots"]] & (cache["lower"] <= cache["bound"][cache["rays"]])
+    ray, pair_slot = cache["rays"][sel], cache["slots"][sel]
+    S = coords[pair_slot]
+    V = surface_coords[ray]
+    t1 = pair_distances(np.einsum('ij,ij->i', S, V), np.linalg.norm(coords, axis=1)[pair_slot],
+                        cache["vnorm"][ray], radius[pair_slot], np.all(S == V, axis=1), decimals)
+
+    # Pairs are sorted by ray and id: the first pair at the minimum of its ray wins, like the index method
+    hit = np.isfinite(t1)
+    ray, pair_slot, t1 = ray[hit], pair_slot[hit], t1[hit]
+    t_near = _ray_minimum(n_rays, ray, t1)
+    nearest = t1 == t_near[ray]
+    ray, pair_slot = ray[nearest], pair_slot[nearest]
+    first = np.ones(len(ray), dtype=bool)
+    first[1:] = ray[1:] != ray[:-1]
+    hit_index = np.full(n_rays, -1, dtype=int)
+    hit_index[ray[first]] = np.searchsorted(ids, cache["slot_ids"][pair_slot[first]])
+    return t_near, hit_index
+
+
+def ray_lengths(t_near, radius_sphere):
+    """Cap the nearest-hit distances at the sphere radius and round them."""
+    return np.round(np.minimum(t_near, radius_sphere), 3)
+
+
+def hit_vectors(surface_coords, t_near, radius_sphere):
+    """Scale each lattice vector to its capped hit distance (unchanged if no hit)."""
+    surface_coords = np.asarray(surface_coords, dtype=float)
+    units = surface_coords / np.linalg.norm(surface_coords, axis=1)[:, None]
+    scaled = units * np.minimum(t_near, radius_sphere)[:, None]
+    return np.where(np.isfinite(t_near)[:, None], scaled, surface_coords)
@@ -7,9 +7,21 @@ OUTPUT_DIR="/pool/teakuvek/new_vectors/CYP3A4_4I3Q/aligned_snapshots"
 PYTHON_SCRIPT="align_selected_residues.py"
 RANGES="5-8,32-40,45-49,52-56,62-66,97-105,115-136,146-158,193-197,219-230,265-277,283-295,301-309,320-324,330-339,346-349,366-369,371-375,418-433,464-468"
 
+# Trajectory mode: set TOP and TRAJ to align the whole trajectory in one process
+# (one aligned trajectory instead of one PDB per snapshot)
+TOP=""   # e.g. 07_md/md_final.gro
+TRAJ=""  # e.g. 07_md/md_final.xtc
+
 # Create output dir if it doesn't exist
 mkdir -p "$OUTPUT_DIR"
 
+if [ -n "$TRAJ" ]; then
+    echo "Aligning $TRAJ -> $OUTPUT_DIR/aligned.xtc"
+    python3 "$PYTHON_SCRIPT" "$REF_PDB" "$TOP" "$RANGES" "$OUTPUT_DIR/aligned.xtc" --traj "$TRAJ" \
+        --rmsd "$OUTPUT_DIR/aligned_rmsd.txt"
+    exit 0
+fi
+
 # Loop over frames
 for pdb in "$TRAJ_DIR"/FRAME_*.pdb; do
     base=$(basename "$pdb" .pdb)
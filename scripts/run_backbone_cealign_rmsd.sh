@@ -17,4 +17,4 @@ conda activate pymol_env
 export QT_QPA_PLATFORM=offscreen
 
 # Run your script with full paths and correct pymol_python executable
-python3 /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/full_backbone_rmsd_cealign/script.py --out_csv /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/full_backbone_rmsd_cealign/rmsd_matrix.csv --workers 32 --concurrency 32 --folder /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/.
+python3 /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/full_backbone_rmsd_cealign/script.py --out_csv /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/full_backbone_rmsd_cealign/rmsd_matrix.csv --concurrency 32 --folder /pool/teakuvek/new_vectors/pdb_humans/downloaded_pdb_cif/downloads_pdb_cifs_filtered_1/filtered_rmsd/fixed_pdbs/chainA_filtered/.
@@ -10,13 +10,14 @@
 '''
 
 
-import sys
+import argparse
 import numpy as np
 import os
-from sklearn.cluster import AffinityPropagation
-from sklearn.metrics import pairwise_distances
+from affinity import affinity_propagation
+from clusterfile import result_path, save_clusters
 
-def perform_clustering(input_file, output_file):
+# Read a post_first_clustering.py file: (center, file name, contributing snapshots, vector) per exemplar
+def read_exemplars(input_file):
     all_data = []
     file_sources = []
     contributing_snapshots = {}
@@ -35,22 +36,32 @@ def perform_clustering(input_file, output_file):
                 if snapshot_name not in contributing_snapshots:
                     contributing_snapshots[snapshot_name] = {}
                 contributing_snapshots[snapshot_name][snapshot_center] = num_snapshots
-    
-    structure_indices = [data[0] for data in all_data]
+    return all_data, contributing_snapshots
+
+# Row ids of the second round: exemplar centers are only unique within their file
+def exemplar_ids(all_data):
+    return [f"{data[1]}:{data[0]}" for data in all_data]
+
+def perform_clustering(input_file, output_file, preference=-22000, damping=0.5, cache_dir=None, engine="sklearn",
+                       progress=0):
+    all_data, contributing_snapshots = read_exemplars(input_file)
     feature_vectors = np.array([data[3] for data in all_data])
-    file_names = [data[1] for data in all_data]
 
-    
     print(f"Feature vector shape: {feature_vectors.shape}")
 
     #prije max_iter 200 con 15 
-    #Perform Affinity Propagation clustering
-    clustering = AffinityPropagation(preference=-22000, damping=0.5, max_iter=500, convergence_iter=100)
-    clustering.fit(feature_vectors)
-    
-    cluster_centers_indices = clustering.cluster_centers_indices_
-    labels = clustering.labels_
-    
+    #Perform Affinity Propagation clustering (similarities reused from cache_dir if the vectors are unchanged)
+    cluster_centers_indices, labels = affinity_propagation(feature_vectors, cache_dir, engine, progress,
+                                                           preference=preference, damping=damping,
+                                                           max_iter=500, convergence_iter=100)
+
+    write_report(output_file, all_data, contributing_snapshots, cluster_centers_indices, labels)
+    print(f"Clustering complete. Results saved to {output_file}")
+
+# Write the text report (with the per-file distribution) and the structured result (.npz) of a clustering
+def write_report(output_file, all_data, contributing_snapshots, cluster_centers_indices, labels):
+    structure_indices = [data[0] for data in all_data]
+    file_names = [data[1] for data in all_data]
     cluster_counts = {}
     cluster_snapshots = {}
     
@@ -90,14 +101,24 @@ def perform_clustering(input_file, output_file):
             
             f.write(f"  Cluster Members: {', '.join(map(str, [structure_indices[i] for i in cluster_members]))}\n")
             f.write("\n")
-    
-    print(f"Clustering complete. Results saved to {output_file}")
+
+    save_clusters(result_path(output_file), output_file, exemplar_ids(all_data), cluster_centers_indices, labels,
+                  [all_data[i][3] for i in cluster_centers_indices])
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: python clustering_script.py cluster_vectors.txt output.txt")
-    else:
-        input_file = sys.argv[1]
-        output_file = sys.argv[2]
-        perform_clustering(input_file, output_file)
+    parser = argparse.ArgumentParser(description="Second-round Affinity Propagation clustering of first-round exemplars.")
+    parser.add_argument('input', help="Weighted exemplar file from post_first_clustering.py")
+    parser.add_argument('output', help="Output text file with the clusters")
+    parser.add_argument('--preference', type=float, default=-22000, help="Affinity Propagation preference")
+    parser.add_argument('--damping', type=float, default=0.5, help="Affinity Propagation damping")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Directory for similarity matrices, reused while the input vectors are unchanged")
+    parser.add_argument('--engine', choices=["sklearn", "native"], default="sklearn",
+                        help="sklearn AffinityPropagation, or the in-project float32 kernel (about 3 N x N float32 arrays)")
+    parser.add_argument('--progress', type=int, default=0,
+                        help="With --engine native, print exemplars and changed assignments every N iterations")
+    args = parser.parse_args()
+
+    perform_clustering(args.input, args.output, args.preference, args.damping, args.cache,
+                       args.engine, args.progress)
 
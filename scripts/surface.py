@@ -2,9 +2,20 @@ import math
 import numpy as np
 import argparse
 import os
+from contextlib import ExitStack
+from raycast import DEFAULT_MAX_MEMORY, DEFAULT_SKIN, cast_cutoffs, file_method, ray_lengths, hit_vectors
+from trajectory import load_universe, frame_numbers, frame_coords, frame_transform, site_for_args
+from topology import topology_template, template_atoms
+from heme_frame import transforms_for_args
+from parallel import WORKER, map_ordered
+from vecfile import open_writer, cutoff_paths
 
 # Function to read coordinates from a PDB file
 def read_pdb_coords(pdb_filename):
+    # Full precision lattice written by triangular_lattice_sphere.py --binary
+    if pdb_filename.endswith(".npz"):
+        from triangular_lattice_sphere import read_lattice
+        return read_lattice(pdb_filename)["coords"]
     coords = []
     with open(pdb_filename, 'r') as file:
         for line in file:
@@ -17,10 +28,10 @@ def read_pdb_coords(pdb_filename):
     return np.array(coords)
 
 # Function to process the protein structure and filter atoms
-def cavity(name, surface_coords, radius_sphere):
+def cavity(name, surface_coords, radii_sphere, max_memory=DEFAULT_MAX_MEMORY, method="index", exact_geometry=False):
 
-    # Removing the atoms which are below the heme and outside the cutoff, radius is cutoff
-    radius=radius_sphere+2
+    # Removing the atoms which are below the heme and outside the largest cutoff, radius is cutoff
+    radius=max(radii_sphere)+2
     with open(name, "r") as f:
         protein_coords = []
         atom_radius = []
@@ -43,102 +54,134 @@ def cavity(name, surface_coords, radius_sphere):
         protein_coords = np.array(protein_coords)
         atom_radius = np.array(atom_radius)
 
-    def new_vector(V, t1):
-        # Normalize the vector V
-        norm_V = np.linalg.norm(V)
-        V_unit = V / norm_V
-        
-        # Scale the unit vector by distance t
-        V_new = t1 * V_unit
-        return V_new    
+    return cavity_vectors(protein_coords, atom_radius, surface_coords, radii_sphere, max_memory, method,
+                          exact_geometry=exact_geometry)
 
-    # Vector generation for each connection point
-    surface_vectors = []
-    distance_vectors = []
-    for vector in surface_coords:
-        V = np.array(vector)
-        min_dist = float('inf')
-        t1 = float('inf')
-        final_vector = V
-        i = 0
-        for atom, r in zip(protein_coords, atom_radius):
-            i += 1
-            sphere_touching = True
-            S = np.array(atom)
-            d = np.round(np.linalg.norm(S), 3)
-            cos_alpha = np.dot(S, V) / (d * np.round(np.linalg.norm(V), 3))
-            if np.array_equal(S, V):
-                t1 = d - r
-                V = new_vector(V, t1)
-            elif cos_alpha >= 0 and cos_alpha <= 1:
-                y = round(d * math.sqrt(1.0 - cos_alpha * cos_alpha), 3)
-                if y < r:
-                    x = math.sqrt(r * r - y * y)
-                    t = np.round(abs(np.dot(S, V)) / np.linalg.norm(V), 3)
-                    t1 = t - x
-                    t2 = t + x
-                    if (t1<radius_sphere):
-                        temp_vector = new_vector(V, t1)
-                    else:
-                        temp_vector = new_vector(V, radius_sphere)
+# Vector lengths for atoms that are already filtered to the binding site (within the largest cutoff)
+def cavity_vectors(protein_coords, atom_radius, surface_coords, radii_sphere, max_memory=DEFAULT_MAX_MEMORY,
+                   method="index", ids=None, cache=None, exact_geometry=False):
+
+    # Cast all lattice vectors against the retained atoms once, for every cutoff; by default like the original
+    # loop, which rescales each vector to its hits (exact_geometry keeps the rays fixed)
+    results = []
+    for radius_sphere, (t_near, hit_index, members) in zip(radii_sphere, cast_cutoffs(
+            surface_coords, protein_coords, atom_radius, radii_sphere, 3, max_memory, method, ids, cache,
+            sequential=not exact_geometry)):
+        distance_vectors = ray_lengths(t_near, radius_sphere)
+        surface_vectors = hit_vectors(surface_coords, t_near, radius_sphere)
+        '''with open("surface.pdb", "w") as file:
+            atom_count = 1
+            for line in surface_vectors:
+                x, y, z = line  # Unpack the coordinates
+                file.write(f"ATOM  {atom_count:5d}  H   XXX     1    {x:8.3f}{y:8.3f}{z:8.3f}\n")
+                atom_count += 1
+            file.write("END\n")'''
+        results.append((distance_vectors, surface_vectors))
+
+    return results
 
-                    if temp_vector[2] >= 0:  # Ensure it stays in the upper hemisphere
-                        V = temp_vector
-                    if temp_vector[2] < 0:  # Ensure it stays in the upper hemisphere
-                        # Debug: Print current vectors and parameters
-                        print(f"Processing vector: {V}, Atom: {S}, Distance d: {d}")
-                        print(f"Temp vector: {temp_vector}, Z: {temp_vector[2]}")
-                        print(i, cos_alpha, t)
-                elif y == r:
-                    t1 = np.dot(S, V) / np.linalg.norm(V)
-                    temp_vector = new_vector(V, t1)
-                    if (t1<radius_sphere):
-                        temp_vector = new_vector(V, t1)
-                    else:
-                        temp_vector = new_vector(V, radius_sphere)
-                else:
-                    sphere_touching = False
-                
-            if sphere_touching == True and t1 < min_dist:
-                final_vector = temp_vector
-                min_dist = t1
-        if (min_dist > radius_sphere):
-            min_dist=radius_sphere       
-        distance_vectors.append(np.round(min_dist, 3)) #rounding the values
-        surface_vectors.append(final_vector)
-    
-    distance_vectors = np.array(distance_vectors)
-    for i in range(len(distance_vectors)):
-        if distance_vectors[i] == float('inf'):
-            distance_vectors[i] = radius_sphere
-    surface_vectors = np.array(surface_vectors)
-    '''with open("surface.pdb", "w") as file:
-        atom_count = 1
-        for line in surface_vectors:
-            x, y, z = line  # Unpack the coordinates
-            file.write(f"ATOM  {atom_count:5d}  H   XXX     1    {x:8.3f}{y:8.3f}{z:8.3f}\n")
-            atom_count += 1
-        file.write("END\n")'''
 
-    return distance_vectors, surface_vectors
+# Per-worker state for --jobs: the parsed arguments and, for --traj, the open trajectory and atom template
+def worker_setup(args):
+    state = {'args': args}
+    if args.traj:
+        universe = load_universe(args.top, args.traj)
+        state['universe'] = universe
+        template = topology_template(universe, args.top, args.ref, args.template_cache)
+        state['ray_cache'] = {"skin": args.skin}
+        state['template'] = template_atoms(template)
+    return state
+
+# Snapshot name and vector lengths per cutoff for a pqr file or trajectory frame, computed in a worker
+def vector_row(task):
+    args = WORKER['args']
+    surface_coords = WORKER['lattice']
+    max_memory = args.memory * 1024 ** 2
+    if args.traj:
+        indices, atom_radius, charges, keys = WORKER['template']
+        protein_coords, kept = frame_coords(WORKER['universe'], indices, task, max(args.radius), z_min=-2,
+                                            transform=frame_transform(args.transforms, task),
+                                            site=args.site)
+        results = cavity_vectors(protein_coords, atom_radius[kept], surface_coords, args.radius, max_memory,
+                                 args.method, kept, WORKER['ray_cache'], args.exact_geometry)
+        name = task
+    else:
+        results = cavity(task, surface_coords, args.radius, max_memory, file_method(args.method), args.exact_geometry)
+        name = os.path.splitext(os.path.basename(task))[0]
+    return name, [distance_results for distance_results, surface_vectors in results]
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="script")
-    parser.add_argument('-n', '--name', nargs='+', type=str, required=True, help="Name of the pqr file")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-n', '--name', nargs='+', type=str, help="Name of the pqr file")
+    inputs.add_argument('-t', '--traj', type=str, help="Trajectory (e.g. XTC) in the heme frame (or use --heme_frame), instead of pqr files")
+    parser.add_argument('-s', '--top', type=str, help="Topology (GRO/PDB) for --traj")
+    parser.add_argument('--ref', type=str, help="Reference file with radii, required for --traj")
+    parser.add_argument('--start', type=int, default=None, help="First frame for --traj")
+    parser.add_argument('--stop', type=int, default=None, help="Last frame (exclusive) for --traj")
+    parser.add_argument('--step', type=int, default=None, help="Frame stride for --traj")
+    parser.add_argument('--heme_frame', action='store_true',
+                        help="Put every frame of --traj in the heme frame on the fly (see heme_frame.py)")
+    parser.add_argument('--ranges', type=str, default=None,
+                        help="With --heme_frame: residue ranges to superpose every frame on the first one (e.g. '5-8,32-40')")
+    parser.add_argument('--frame_ref', type=str, default=None,
+                        help="With --heme_frame and --ranges: reference PDB (e.g. 4I3Q) the first frame is CE-aligned to")
+    parser.add_argument('--resn', type=str, default="HEM*", help="Heme residue name pattern for --heme_frame (default: HEM*)")
+    parser.add_argument('--template_cache', type=str, default=None,
+                        help="Directory to cache the per-topology atom template for --traj (reused by later runs and workers)")
+    parser.add_argument('--preselect', type=float, default=None, metavar='MARGIN',
+                        help="Pre-select the atoms that come within the cutoff + MARGIN (A) once per trajectory and only "
+                             "read those from every frame (--traj)")
+    parser.add_argument('--preselect_step', type=int, default=10, help="Frame stride of the --preselect pass (default: 10)")
     parser.add_argument('-pdb', '--pdb', type=str, required=True, help="PDB file with surface coordinates")
-    parser.add_argument('-o', '--output', type=str, required=True, help="Output name")
-    parser.add_argument('-r','--radius', type=int, required=True, help="Max sphere radius")
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help="Output name (*.vec for the binary vector format; <name>_r<radius> per radius for several radii)")
+    parser.add_argument('-r','--radius', type=int, nargs='+', required=True,
+                        help="Max sphere radius; several radii are computed in one pass, one output each")
+    parser.add_argument('-m', '--memory', type=int, default=DEFAULT_MAX_MEMORY // 1024 ** 2, help="Memory budget for ray casting in MB")
+    parser.add_argument('--method', choices=["index", "dense", "incremental"], default="index",
+                        help="Ray casting method: cone index over lattice rays, all ray x atom pairs, or (--traj) the "
+                             "cone index with candidate lists reused between frames (pqr files use index) (with --exact_geometry)")
+    parser.add_argument('--skin', type=float, default=DEFAULT_SKIN,
+                        help=f"Skin (A) of the candidate lists of --method incremental (default: {DEFAULT_SKIN})")
+    parser.add_argument('--exact_geometry', action='store_true',
+                        help="Cast fixed rays with --method instead of reproducing the original loop, which rescales "
+                             "each vector to its hits and rounds |V| (lengths change by up to ~1.4 A on grazing rays)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--chunksize', type=int, default=None, help="Files/frames sent to a worker at a time (default: automatic)")
     
     args = parser.parse_args()
+    if args.traj and not (args.top and args.ref):
+        parser.error("--traj requires --top and --ref")
+    if args.heme_frame and not args.traj:
+        parser.error("--heme_frame requires --traj")
+    if len(set(args.radius)) != len(args.radius):
+        parser.error("-r/--radius values must be distinct")
 
     # Read the coordinates from the provided PDB file
     surface_coords = read_pdb_coords(args.pdb)
-    
-    with open(args.output, 'w') as output_file:
-        for filename in args.name:
-            distance_results, surface_vectors = cavity(filename, surface_coords,args.radius)
-            file_name_without_ext = os.path.splitext(os.path.basename(filename))[0]
-            result_with_filename = [file_name_without_ext] + distance_results.tolist()
-            output_file.write(' '.join(map(str, result_with_filename)) + '\n')
+    if args.traj:
+        tasks = frame_numbers(load_universe(args.top, args.traj), args.start, args.stop, args.step)
+    else:
+        tasks = args.name
+    args.transforms = transforms_for_args(args, tasks) if args.traj else None
+    args.site = site_for_args(args, tasks, "pqr", -2) if args.traj else None
 
+    # Rows are written in input order; a failed file/frame is reported and skipped
+    failed = []
+    with ExitStack() as stack:
+        output_files = [stack.enter_context(open_writer(path, {"lattice": args.pdb, "n_rays": len(surface_coords),
+                                                               "radius": radius}, [["lengths", len(surface_coords)]]))
+                        for radius, path in zip(args.radius, cutoff_paths(args.output, args.radius))]
+        for task, row, error in map_ordered(vector_row, tasks, surface_coords, args.jobs, args.chunksize,
+                                            worker_setup, (args,)):
+            if error:
+                print(f"⚠️ Failed: {task}\n{error}")
+                failed.append(task)
+                continue
+            name, lengths = row
+            for output_file, distance_results in zip(output_files, lengths):
+                output_file.write(name, distance_results)
+    if failed:
+        print(f"⚠️ {len(failed)} of {len(tasks)} inputs failed: {' '.join(map(str, failed))}")
@@ -0,0 +1,189 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+# Bump when the template layout or the way it is built changes, so old cache files are not reused
+TEMPLATE_VERSION = "template-v1"
+
+# Read new reference file format
+def read_reference_file(ref_file):
+    ref_map = {}
+    with open(ref_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            parts = line.split()
+            if len(parts) != 4:
+                continue  # skip malformed lines
+            atom_name = parts[0].strip()
+            res_name = parts[1].strip()
+            charge = float(parts[2])
+            radius = float(parts[3])
+            key = (res_name.upper(), atom_name.upper())
+            ref_map[key] = (charge, radius)
+    return ref_map
+
+# Blocks of a GROMOS file (mtb/ifp) as {block name: [lines]}, without comments; repeated blocks are appended
+def read_gromos_blocks(path):
+    blocks = {}
+    name = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if name is None:
+                if line.strip() and not line.startswith("#"):
+                    name = line.strip()
+                    blocks.setdefault(name, []).append([])
+            elif line.strip() == "END":
+                name = None
+            elif not line.startswith("#"):
+                blocks[name][-1].append(line)
+    return blocks
+
+def lj_radii(ifp_file, partner="OTFE"):
+    """
+    Radius of every integer atom code (IAC) of a GROMOS ifp file: half the
+    Lennard-Jones minimum distance, 2^(1/6) (C12/C6)^(1/6) / 2, in angstrom
+    (0 for atoms without LJ parameters, e.g. polar H). C12 is the repulsive
+    type each atom uses against the partner type in the ifp matrix; the
+    default reproduces the radii of reference_charges.txt.
+    """
+    rows = [line.split() for line in read_gromos_blocks(ifp_file)["SINGLEATOMLJPAIR"][0] if line.split()]
+    n_types = int(rows[0][0])
+    params = {}
+    k = 1
+    while k < len(rows):
+        parts = rows[k]
+        # IAC TYPE SQRT(C6) SQRT(C12(1)) SQRT(C12(2)) SQRT(C12(3)), then CS6 CS12 and the C12 type matrix row
+        if len(parts) == 6 and not parts[1].isdigit():
+            k += 2
+            matrix = []
+            while len(matrix) < n_types:
+                matrix += [int(x) for x in rows[k]]
+                k += 1
+            params[int(parts[0])] = (parts[1], float(parts[2]), [float(x) for x in parts[3:6]], matrix)
+        else:
+            k += 1
+
+    partner_iac = next(iac for iac, (name, *_) in params.items() if name == partner)
+    radii = {}
+    for iac, (name, sqrt_c6, sqrt_c12, matrix) in params.items():
+        c12_type = sqrt_c12[matrix[partner_iac - 1] - 1]
+        radius = 0.0
+        if sqrt_c6 > 0 and c12_type > 0:
+            radius = 2 ** (1 / 6) * (c12_type / sqrt_c6) ** (1 / 3) * 10 / 2
+        radii[iac] = radius
+    return radii
+
+def read_mtb(mtb_file, ifp_file):
+    """
+    Reference map {(res_name, atom_name): (charge, radius)} from the amino
+    acid building blocks (TYPE APEP) of a GROMOS mtb file, with radii from
+    the LJ parameters of the ifp file; the same layout as read_reference_file().
+    Radii are rounded to 4 decimals like the reference file.
+    """
+    radii = lj_radii(ifp_file)
+    ref_map = {}
+    with open(mtb_file, 'r') as f:
+        text = f.read()
+    for block in text.split("\nMTBUILDBLSOLUTE\n")[1:]:
+        lines = block.split("\nEND")[0].split("\n")
+        if not any(line.startswith("#@BLOCKTYPE") and " TYPE APEP " in line for line in lines):
+            continue
+        tokens = " ".join(line for line in lines if not line.startswith("#")).split()
+        res_name = tokens[0].upper()
+        n_atoms, n_preceding = int(tokens[1]), int(tokens[2])
+        pos = 3
+        # preceding exclusions: ATOM MAE and MAE atom numbers
+        for _ in range(n_preceding):
+            pos += 2 + int(tokens[pos + 1])
+        for i in range(n_atoms):
+            atom_name, iac, charge = tokens[pos + 1].upper(), int(tokens[pos + 2]), float(tokens[pos + 4])
+            pos += 6
+            # trailing atoms carry no exclusions
+            if i < n_atoms - n_preceding:
+                pos += 1 + int(tokens[pos])
+            ref_map[(res_name, atom_name)] = (charge, round(radii[iac], 4))
+    return ref_map
+
+def ifp_for(mtb_file):
+    """The single ifp file next to an mtb file."""
+    candidates = sorted(glob.glob(os.path.join(os.path.dirname(mtb_file) or ".", "*.ifp")))
+    if len(candidates) != 1:
+        raise ValueError(f"Expected one .ifp file next to {mtb_file}, found {len(candidates)}")
+    return candidates[0]
+
+def read_reference(ref_file):
+    """Reference map from reference_charges.txt or from a GROMOS mtb file (with the ifp file in the same directory)."""
+    if ref_file.endswith(".mtb"):
+        return read_mtb(ref_file, ifp_for(ref_file))
+    return read_reference_file(ref_file)
+
+def build_template(res_names, atom_names, ref_map):
+    """
+    Compile the reference values for every topology atom into arrays.
+
+    Residue and atom names are stored as integer codes into the res_table and
+    atom_table name tables; known marks the atoms found in the reference
+    (their radius and charge, 0 otherwise) and heme the residues starting
+    with HEM.
+    """
+    res_table, res_codes = np.unique(np.char.upper(np.asarray(res_names, dtype=str)), return_inverse=True)
+    atom_table, atom_codes = np.unique(np.char.upper(np.asarray(atom_names, dtype=str)), return_inverse=True)
+    # Look every distinct (residue, atom) pair up once
+    pairs, pair_codes = np.unique(np.stack([res_codes, atom_codes], axis=1), axis=0, return_inverse=True)
+    values = np.array([ref_map.get((res_table[r], atom_table[a]), (np.nan, np.nan)) for r, a in pairs],
+                      dtype=float).reshape(-1, 2)[pair_codes.ravel()]
+    known = ~np.isnan(values[:, 0])
+    return {"res_table": res_table, "atom_table": atom_table,
+            "res_codes": res_codes.astype(np.int32), "atom_codes": atom_codes.astype(np.int32),
+            "charge": np.where(known, values[:, 0], 0.0), "radius": np.where(known, values[:, 1], 0.0),
+            "known": known, "heme": np.char.startswith(res_table, "HEM")[res_codes]}
+
+def file_hash(*paths):
+    """SHA-256 of the template version and the contents of the files."""
+    digest = hashlib.sha256(TEMPLATE_VERSION.encode())
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+def topology_template(universe, topology, ref_file, cache_dir=None):
+    """
+    Atom template of a topology, stored in cache_dir under the hash of the
+    topology and reference files so every later run (and worker) on the same
+    system loads the arrays instead of looking every atom up again.
+    """
+    sources = [topology, ref_file] + ([ifp_for(ref_file)] if ref_file.endswith(".mtb") else [])
+    path = os.path.join(cache_dir, file_hash(*sources) + ".npz") if cache_dir else None
+    if path and os.path.exists(path):
+        with np.load(path) as saved:
+            return {key: saved[key] for key in saved.files}
+
+    template = build_template(universe.atoms.resnames, universe.atoms.names, read_reference(ref_file))
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Written under a temporary name first, so an interrupted run never leaves a partial cache entry
+        partial = f"{path}.{os.getpid()}.part.npz"
+        np.savez(partial, **template)
+        os.replace(partial, path)
+        print(f"Atom template cached in {path}")
+    return template
+
+def template_atoms(template, radii="pqr"):
+    """
+    Atoms used for ray casting, as (indices, atom_radii, charges, keys).
+
+    Only atoms found in the reference are kept, since GRO/XTC files carry no
+    radii. radii="pqr" additionally drops the heme, like surface.py does for
+    PQR files. keys are the (res_name, atom_name) of the kept atoms.
+    """
+    include = template["known"].copy()
+    if radii == "pqr":
+        include &= ~template["heme"]
+    indices = np.flatnonzero(include)
+    keys = list(zip(template["res_table"][template["res_codes"][indices]].tolist(),
+                    template["atom_table"][template["atom_codes"][indices]].tolist()))
+    return indices, template["radius"][indices], template["charge"][indices], keys
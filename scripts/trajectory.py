@@ -0,0 +1,163 @@
+import numpy as np
+
+# Open a topology (GRO/PDB) with an optional trajectory (XTC) as an MDAnalysis universe
+def load_universe(topology, trajectory=None):
+    import MDAnalysis as mda
+
+    if trajectory:
+        return mda.Universe(topology, trajectory)
+    return mda.Universe(topology)
+
+def frame_numbers(universe, start=None, stop=None, step=None):
+    """Frame numbers of the trajectory slice start:stop:step."""
+    return list(range(len(universe.trajectory)))[start:stop:step]
+
+def frame_transform(transforms, frame):
+    """Transform of one frame from transforms_for_args(): the frame's (R, t), a function of its positions, or None."""
+    if isinstance(transforms, dict):
+        return transforms[frame]
+    return transforms
+
+def frame_coords(universe, indices, frame, radius_sphere, z_min=None, transform=None, site=None):
+    """
+    Coordinates of the template atoms within radius_sphere + 2 of the origin
+    (and above z_min if given) in one frame, and their positions in the
+    template arrays. Only this frame is held in memory.
+
+    transform (R, t) is applied first (x -> R x + t), e.g. to put the frame
+    in the heme frame on the fly; it can also be a function that returns
+    (R, t) from the positions of the frame.
+
+    site is the (inside, outside, bounds) split of the template from
+    preselect_atoms(): only the inside atoms are filtered, and an outside
+    atom that comes within the cutoff anyway (a margin violation) is
+    reported and included, so the result is the same as without site.
+    Outside atoms are only looked at one by one when the bounding sphere
+    of their residue reaches the cutoff.
+    """
+    positions = universe.trajectory[frame].positions
+    if callable(transform):
+        transform = transform(positions)
+    selected = np.arange(len(indices)) if site is None else site[0]
+    coords = positions[indices[selected]].astype(float)
+    if transform is not None:
+        R, t = transform
+        coords = coords @ np.asarray(R).T + t
+    keep = np.linalg.norm(coords, axis=1) < radius_sphere + 2
+    if z_min is not None:
+        keep &= coords[:, 2] > z_min
+    coords, kept = coords[keep], selected[keep]
+
+    if site is not None and len(site[1]):
+        # The excluded atoms are checked in the raw frame: distance to the origin mapped back, and z after the transform
+        R, t = (np.eye(3), np.zeros(3)) if transform is None else (np.asarray(transform[0]), np.asarray(transform[1]))
+        centers, extents, group = site[2]
+        raw = positions[indices[centers]].astype(float)
+        reach = np.linalg.norm(raw + R.T @ t, axis=1) - extents < radius_sphere + 2
+        if z_min is not None:
+            reach &= raw @ R[2] + t[2] + extents > z_min
+        candidates = site[1][reach[group]]
+        raw = positions[indices[candidates]].astype(float)
+        near = np.linalg.norm(raw + R.T @ t, axis=1) < radius_sphere + 2
+        if z_min is not None:
+            near &= raw @ R[2] + t[2] > z_min
+        if near.any():
+            print(f"⚠️ Frame {frame}: {near.sum()} atoms outside the binding-site pre-selection came within the cutoff "
+                  f"(included; increase --preselect)")
+            extra_coords, extra = frame_coords(universe, indices, frame, radius_sphere, z_min, transform,
+                                               (candidates[near], []))
+            order = np.argsort(np.concatenate([kept, extra]))
+            coords, kept = np.concatenate([coords, extra_coords])[order], np.concatenate([kept, extra])[order]
+    return coords, kept
+
+def preselect_atoms(universe, indices, frames, radius_sphere, margin, z_min=None, transforms=None, step=10):
+    """
+    Split the template atoms into those that can enter the binding-site
+    cutoff during the trajectory and the rest, from every step-th frame.
+
+    An atom is kept if it is within radius_sphere + 2 + margin of the origin
+    (and above z_min - margin) in any sampled frame; transforms are those
+    of --heme_frame (see frame_transform()). The excluded atoms are bounded
+    per residue by a sphere around its most central atom, with the
+    largest radius seen in the sampled frames plus margin, so frame_coords()
+    checks one distance per residue instead of one per atom.
+
+    Returns (inside, outside, (centers, extents, group)) for
+    frame_coords(site=...): positions in the template arrays, the center
+    atom and radius of every residue sphere, and the sphere of every
+    outside atom.
+    """
+    sampled = list(frames[::step])
+    if frames[-1] not in sampled:
+        sampled.append(frames[-1])
+    residues, residue = np.unique(universe.atoms.resindices[indices], return_inverse=True)
+    # sphere centers: the atom of every residue closest to its mean position in the first sampled frame
+    coords = universe.trajectory[sampled[0]].positions[indices].astype(float)
+    mean = np.stack([np.bincount(residue, coords[:, k]) for k in range(3)], axis=1) / np.bincount(residue)[:, None]
+    order = np.lexsort((np.linalg.norm(coords - mean[residue], axis=1), residue))
+    centers = order[np.concatenate([[0], np.flatnonzero(np.diff(residue[order])) + 1])]
+    near = np.zeros(len(indices), dtype=bool)
+    extents = np.zeros(len(residues))
+    for frame in sampled:
+        positions = universe.trajectory[frame].positions
+        coords = positions[indices].astype(float)
+        np.maximum.at(extents, residue, np.linalg.norm(coords - coords[centers[residue]], axis=1))
+        transform = frame_transform(transforms, frame)
+        if transform is not None:
+            R, t = transform(positions) if callable(transform) else transform
+            coords = coords @ np.asarray(R).T + t
+        hit = np.linalg.norm(coords, axis=1) < radius_sphere + 2 + margin
+        if z_min is not None:
+            hit &= coords[:, 2] > z_min - margin
+        near |= hit
+    inside, outside = np.flatnonzero(near), np.flatnonzero(~near)
+    # spheres of the residues with excluded atoms only
+    used, group = np.unique(residue[outside], return_inverse=True)
+    print(f"Binding-site pre-selection: {len(inside)} of {len(indices)} template atoms kept "
+          f"({len(outside)} excluded, checked every frame through {len(used)} residue spheres), "
+          f"margin {margin} A from {len(sampled)} frames")
+    return inside, outside, (centers[used], extents[used] + margin, group)
+
+def site_for_args(args, frames, radii, z_min=None):
+    """(inside, outside, bounds) pre-selection for the --preselect options of surface.py, charge.py and vectors.py (for the largest of the -r cutoffs), or None."""
+    if args.preselect is None:
+        return None
+    from topology import topology_template, template_atoms
+
+    universe = load_universe(args.top, args.traj)
+    indices = template_atoms(topology_template(universe, args.top, args.ref, args.template_cache), radii)[0]
+    return preselect_atoms(universe, indices, frames, max(args.radius), args.preselect, z_min, args.transforms,
+                           args.preselect_step)
+
+def read_ndx(path):
+    """GROMACS index file as {group name: 0-based atom indices}."""
+    groups = {}
+    name = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                name = line.strip("[] ")
+                groups[name] = []
+            elif line and name is not None:
+                groups[name].extend(int(i) - 1 for i in line.split())
+    return {name: np.array(indices, dtype=int) for name, indices in groups.items()}
+
+def universe_structure(universe, frame=None):
+    """Names, residue names, residue numbers and coordinates (of frame, or the current one) in the alignment.read_pdb() layout."""
+    if frame is not None:
+        universe.trajectory[frame]
+    return {"names": np.char.upper(universe.atoms.names.astype(str)),
+            "resnames": np.char.upper(universe.atoms.resnames.astype(str)),
+            "resids": universe.atoms.resids,
+            "coords": universe.atoms.positions.astype(float)}
+
+def write_transformed(universe, frames, R, t, output):
+    """Write the frames with every atom moved by its frame's transform (x -> R x + t); format from the output extension."""
+    import MDAnalysis as mda
+
+    with mda.Writer(output, universe.atoms.n_atoms) as w:
+        for i, frame in enumerate(frames):
+            universe.trajectory[frame]
+            universe.atoms.positions = universe.atoms.positions @ R[i].T + t[i]
+            w.write(universe.atoms)
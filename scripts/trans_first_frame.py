@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 import argparse
-from pymol import cmd
+from alignment import read_pdb, write_pdb, select
 
-def translate_to_fe_origin(pdb_file, output_pdb):
+def translate_to_fe_origin(pdb_file, output_pdb, backend="numpy"):
     """Translate so that FE atom of HEM/HEMO* residue is at the origin."""
+    if backend == "pymol":
+        return translate_to_fe_origin_pymol(pdb_file, output_pdb)
+
+    structure = read_pdb(pdb_file)
+    # Match any residue starting with HEM (HEM, HEMO, HEMOA, etc.)
+    fe_atom = select(structure, resn="HEM*", name="FE")
+    if len(fe_atom) == 0:
+        print(f"⚠️ No FE atom found in residues HEM* in {pdb_file}")
+        return False
+
+    write_pdb(output_pdb, structure, structure["coords"] - structure["coords"][fe_atom[0]])
+    print(f"✅ Saved translated structure to {output_pdb}")
+    return True
+
+# Reference implementation with PyMOL
+def translate_to_fe_origin_pymol(pdb_file, output_pdb):
+    from pymol import cmd
+
     cmd.reinitialize()
     cmd.load(pdb_file, "structure")
 
@@ -26,7 +44,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate structure so FE in HEM*/HEMO* is at origin.")
     parser.add_argument("input_pdb", help="Input PDB file")
     parser.add_argument("output_pdb", help="Output PDB file")
+    parser.add_argument("--backend", choices=["numpy", "pymol"], default="numpy",
+                        help="Translate with NumPy (default) or with PyMOL (reference)")
     args = parser.parse_args()
 
-    translate_to_fe_origin(args.input_pdb, args.output_pdb)
-
+    translate_to_fe_origin(args.input_pdb, args.output_pdb, args.backend)
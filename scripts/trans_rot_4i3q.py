@@ -1,8 +1,9 @@
-import pymol
 import numpy as np
 import argparse
+from alignment import read_pdb, write_pdb, select, rotation_matrix, transform
 
 def tranlate_to_iron(resn):
+    import pymol
     pymol.cmd.select('select', f'resn {resn} and name FE')  
     fe = pymol.cmd.get_coords('select')
     translation_vector = [-fe[0][0], -fe[0][1], -fe[0][2]]
@@ -23,13 +24,17 @@ def norm_cross_product(v1, v2):
 def rad_to_degree(rad_angle):
     return np.round(np.rad2deg(rad_angle), 6)
 
+def axis_normal(axis):
+    return (0., 1., 0.) if axis == "xz" else (0., 0., 1.) if axis == "xy" else (1., 0., 0.)
+
 def get_rotation_angle_and_axis(resn, axis):
+    import pymol
     pymol.cmd.select('select', f'resn {resn} and name NA')
     v1 = tuple(pymol.cmd.get_coords('select')[0].tolist())
     pymol.cmd.select('select', f'resn {resn} and name NB')
     v2 = tuple(pymol.cmd.get_coords('select')[0].tolist())
       
-    v = (0., 1., 0.) if axis == "xz" else (0., 0., 1.) if axis == "xy" else (1., 0., 0.)
+    v = axis_normal(axis)
     norm = norm_cross_product(v1, v2)
     angle_rad = angle_between(norm, v)
     angle_degree = rad_to_degree(angle_rad)
@@ -37,12 +42,14 @@ def get_rotation_angle_and_axis(resn, axis):
     return angle_degree, vector_to_rotate_around
 
 def rotate_around_iron(resn, axis):
+    import pymol
     angle_degree, vector_to_rotate_around = get_rotation_angle_and_axis(resn, axis)
     if angle_degree != "Done":
         pymol.cmd.rotate(vector_to_rotate_around, angle=angle_degree, selection="all", origin=[0, 0, 0])
         #pymol.cmd.save('fe_rotate.pdb')
 
 def additional_rotation(resn, output_name):
+    import pymol
     pymol.cmd.select('select', f'resn {resn} and name FE')
     fe = pymol.cmd.get_coords('select')[0]
     pymol.cmd.select('select', f'resn {resn} and name NA')
@@ -58,17 +65,57 @@ def additional_rotation(resn, output_name):
     pymol.cmd.rotate(rotation_axis, angle=angle_degree, selection="all", origin=[0, 0, 0])
     pymol.cmd.save(output_name)
 
+# NumPy backend: the same three steps as one rigid transform, without PyMOL
+def heme_atom(structure, resn, name):
+    """Coordinates of atom `name` in the first residue matching `resn` (case-insensitive, wildcards allowed)."""
+    index = select(structure, resn=resn, name=name)
+    if len(index) == 0:
+        raise ValueError(f"No atom {name} in residue {resn}")
+    return structure["coords"][index[0]]
+
+def heme_transform(fe, na, nb, axis="xy"):
+    """
+    Rotation R and translation t (x -> R x + t) that move FE to the origin,
+    turn the FE-NA-NB plane normal onto the normal of `axis` and then FE->NA
+    onto x, with the same rounded angles as the PyMOL steps above.
+    """
+    na = np.asarray(na, dtype=float) - fe
+    nb = np.asarray(nb, dtype=float) - fe
+    v = axis_normal(axis)
+    norm = norm_cross_product(na, nb)
+    R = np.eye(3)
+    angle_degree = rad_to_degree(angle_between(norm, v))
+    if angle_degree != 0:
+        R = rotation_matrix(norm_cross_product(norm, v), angle_degree)
+
+    fe_na_vector = R @ na
+    angle_degree = rad_to_degree(angle_between(fe_na_vector, [1, 0, 0]))
+    if angle_degree != 0:
+        R = rotation_matrix(norm_cross_product(fe_na_vector, [1, 0, 0]), angle_degree) @ R
+    return R, -R @ np.asarray(fe, dtype=float)
+
+def heme_frame(pdb, resn, axis, output_name):
+    structure = read_pdb(pdb)
+    R, t = heme_transform(heme_atom(structure, resn, "FE"), heme_atom(structure, resn, "NA"),
+                          heme_atom(structure, resn, "NB"), axis)
+    write_pdb(output_name, structure, transform(structure["coords"], R, t))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Align and rotate molecular structures.")
     parser.add_argument('-p', '--pdb', type=str, required=True, help="Path to pdb file")
     parser.add_argument('-a', '--axis', type=str, default="xy", required=False, help="Axis for angle calculation.")
     parser.add_argument('-n', '--name', type=str, default="HEMO", required=False, help="Residue name [upper case]")
     parser.add_argument('-o', '--output', type=str, default="fe_rotate.pdb", required=False, help="Output file name")
+    parser.add_argument('--backend', choices=["numpy", "pymol"], default="numpy",
+                        help="Transform with NumPy (default) or with PyMOL (reference)")
     args = parser.parse_args()
-    
-    pymol.cmd.load(args.pdb, 'ime')
-    tranlate_to_iron(args.name)
-    if get_rotation_angle_and_axis(args.name, args.axis) != "Done":
-        rotate_around_iron(args.name, args.axis)
-    additional_rotation(args.name, args.output)
 
+    if args.backend == "numpy":
+        heme_frame(args.pdb, args.name, args.axis, args.output)
+    else:
+        import pymol
+        pymol.cmd.load(args.pdb, 'ime')
+        tranlate_to_iron(args.name)
+        if get_rotation_angle_and_axis(args.name, args.axis) != "Done":
+            rotate_around_iron(args.name, args.axis)
+        additional_rotation(args.name, args.output)
@@ -2,6 +2,9 @@ import numpy as np
 import argparse
 import os
 
+# Bump when the lattice layout or the way it is built changes, so old cache files are not reused
+LATTICE_VERSION = "lattice-v1"
+
 def icosahedron_vertices():
     """Generate the vertices of a regular icosahedron centered at the origin."""
     phi = (1 + np.sqrt(5)) / 2  # The golden ratio
@@ -25,17 +28,138 @@ def icosahedron_faces():
         [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]
     ])
 
-def subdivide_triangle(v1, v2, v3, n):
-    """Subdivide a triangle into smaller triangles projected onto a sphere."""
-    points = []
-    for i in range(n + 1):
-        for j in range(n + 1 - i):
-            u = i / n
-            v = j / n
-            w = 1 - u - v
-            point = u * v1 + v * v2 + w * v3
-            points.append(point / np.linalg.norm(point))
-    return np.array(points)
+def subdivided_icosahedron(subdivisions):
+    """
+    Unit sphere vertices and triangles of the subdivided icosahedron, with every vertex generated once.
+
+    The 12 icosahedron vertices come first, then the subdivisions - 1 points
+    of each of the 30 edges and then the interior points of each of the 20
+    faces; a face looks the points of its corners and edges up instead of
+    computing them again. Point (i, j) of a face (v1, v2, v3) is
+    i/n v1 + j/n v2 + (1 - i/n - j/n) v3, projected onto the sphere.
+
+    Returns vertices (10 n^2 + 2, 3) and triangles (20 n^2, 3) as vertex
+    indices, wound like the icosahedron faces.
+    """
+    n = subdivisions
+    if n < 1:
+        raise ValueError("subdivisions must be at least 1")
+    corners = icosahedron_vertices()
+    faces = icosahedron_faces()
+
+    # Barycentric grid of one face: weights (i, j, k) on (v1, v2, v3), i + j + k = n
+    row = np.arange(n + 1)
+    i = np.repeat(row, n + 1 - row)
+    offset = np.concatenate([[0], np.cumsum(n + 1 - row)])
+    j = np.arange(len(i)) - offset[i]
+    weights = np.stack([i, j, n - i - j], axis=1)
+    n_zero = (weights == 0).sum(axis=1)
+
+    # Edge points, once per edge (a < b), k steps from a towards b
+    edges = np.unique(np.sort(faces[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2), axis=1), axis=0)
+    edge_of = np.full((len(corners), len(corners)), -1)
+    edge_of[edges[:, 0], edges[:, 1]] = np.arange(len(edges))
+    k = np.arange(1, n)[None, :, None] / n
+    edge_points = (1 - k) * corners[edges[:, 0]][:, None] + k * corners[edges[:, 1]][:, None]
+
+    # Interior points, once per face
+    inner = np.flatnonzero(n_zero == 0)
+    u, v = i[inner] / n, j[inner] / n
+    face_points = (u[None, :, None] * corners[faces[:, 0]][:, None] + v[None, :, None] * corners[faces[:, 1]][:, None]
+                   + (1 - u - v)[None, :, None] * corners[faces[:, 2]][:, None])
+
+    points = np.concatenate([corners, edge_points.reshape(-1, 3), face_points.reshape(-1, 3)])
+    points[len(corners):] /= np.linalg.norm(points[len(corners):], axis=1)[:, None]
+
+    # Vertex index of every grid point of every face
+    ids = np.empty((len(faces), len(i)), dtype=np.int64)
+    corner = np.flatnonzero(n_zero == 2)
+    ids[:, corner] = faces[:, np.argmax(weights[corner], axis=1)]
+    on_edge = np.flatnonzero(n_zero == 1)
+    # the two corners with a non-zero weight, in face order
+    cols = np.sort(np.argsort(weights[on_edge] == 0, axis=1, kind="stable")[:, :2], axis=1)
+    p, q = faces[:, cols[:, 0]], faces[:, cols[:, 1]]
+    steps = np.where(p < q, weights[on_edge, cols[:, 1]], weights[on_edge, cols[:, 0]])
+    ids[:, on_edge] = len(corners) + edge_of[np.minimum(p, q), np.maximum(p, q)] * (n - 1) + steps - 1
+    ids[:, inner] = len(corners) + len(edges) * (n - 1) + np.arange(len(faces))[:, None] * len(inner) + np.arange(len(inner))
+
+    # Two triangles per grid cell: (i, j), (i + 1, j), (i, j + 1) and (i + 1, j), (i + 1, j + 1), (i, j + 1)
+    up = np.flatnonzero(i + j < n)
+    down = np.flatnonzero(i + j < n - 1)
+    local = np.concatenate([np.stack([up, offset[i[up] + 1] + j[up], up + 1], axis=1),
+                            np.stack([offset[i[down] + 1] + j[down], offset[i[down] + 1] + j[down] + 1, down + 1],
+                                     axis=1)])
+    triangles = ids[:, local].reshape(-1, 3)
+    return points, triangles
+
+def neighbour_lists(triangles, n_points):
+    """Neighbours of every point along the triangle edges, as CSR arrays (neighbour_ptr, neighbours)."""
+    pairs = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]]).astype(np.int64)
+    # every edge in both directions, as one sortable key per (point, neighbour)
+    keys = np.sort(np.concatenate([pairs[:, 0] * n_points + pairs[:, 1], pairs[:, 1] * n_points + pairs[:, 0]]))
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    neighbour_ptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n_points, minlength=n_points))])
+    return neighbour_ptr, keys % n_points
+
+def build_lattice(radius, subdivisions, hemisphere=False):
+    """
+    Triangular lattice on a sphere or hemisphere with its adjacency.
+
+    Points are ordered by their coordinates (rounded to 8 decimals on the
+    unit sphere), the order of the lattice PDB files used so far, so ray
+    indices and vector columns do not change. Coordinates keep full
+    precision. The hemisphere keeps z >= 0 and the triangles with all
+    three points in it.
+
+    Returns a dict with coords (N, 3), triangles (T, 3) and the CSR
+    neighbour lists neighbour_ptr (N + 1) and neighbours.
+    """
+    points, triangles = subdivided_icosahedron(subdivisions)
+    key = np.round(points, decimals=8)
+    order = np.lexsort((key[:, 2], key[:, 1], key[:, 0]))
+    if hemisphere:
+        order = order[key[order, 2] >= 0]
+
+    rank = np.full(len(points), -1)
+    rank[order] = np.arange(len(order))
+    triangles = rank[triangles]
+    triangles = triangles[(triangles >= 0).all(axis=1)]
+    neighbour_ptr, neighbours = neighbour_lists(triangles, len(order))
+    return {"coords": points[order] * radius, "triangles": triangles, "neighbour_ptr": neighbour_ptr,
+            "neighbours": neighbours}
+
+def lattice_path(cache_dir, radius, subdivisions, hemisphere=False):
+    """Cache file of a lattice in cache_dir, named by its parameters."""
+    shape = "hemisphere" if hemisphere else "sphere"
+    return os.path.join(cache_dir, f"{LATTICE_VERSION}_r{float(radius)!r}_s{subdivisions}_{shape}.npz")
+
+def read_lattice(path):
+    """Lattice dict from a .npz file written by write_lattice()."""
+    with np.load(path) as saved:
+        return {key: saved[key] for key in saved.files}
+
+def write_lattice(lattice, path):
+    """Write a lattice dict (full precision coordinates and adjacency) to a .npz file."""
+    # Written under a temporary name first, so an interrupted run never leaves a partial file
+    partial = f"{path}.{os.getpid()}.part.npz"
+    np.savez(partial, **lattice)
+    os.replace(partial, path)
+
+def triangular_lattice(radius, subdivisions, hemisphere=False, cache_dir=None):
+    """
+    Lattice dict of build_lattice(), loaded from cache_dir if it was built
+    before with the same (radius, subdivisions, hemisphere) and stored there
+    otherwise.
+    """
+    path = lattice_path(cache_dir, radius, subdivisions, hemisphere) if cache_dir else None
+    if path and os.path.exists(path):
+        return read_lattice(path)
+
+    lattice = build_lattice(radius, subdivisions, hemisphere)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_lattice(lattice, path)
+    return lattice
 
 def triangular_lattice_on_sphere(radius, subdivisions, hemisphere=False):
     """
@@ -46,86 +170,44 @@ def triangular_lattice_on_sphere(radius, subdivisions, hemisphere=False):
         subdivisions (int): Number of subdivisions per triangle.
         hemisphere (bool): If True, keep only z >= 0 (upper hemisphere).
     """
-    vertices = icosahedron_vertices()
-    faces = icosahedron_faces()
-
-    points = []
-    for face in faces:
-        v1, v2, v3 = vertices[face]
-        subdivided_points = subdivide_triangle(v1, v2, v3, subdivisions)
-        points.append(subdivided_points)
-
-    points = np.concatenate(points)
-    rounded_points = np.round(points, decimals=8)
-    unique_points = np.unique(rounded_points, axis=0)
-
-    # Filter for hemisphere if requested
-    if hemisphere:
-        unique_points = unique_points[unique_points[:, 2] >= 0]
-
-    unique_points *= radius
-    return unique_points
+    return build_lattice(radius, subdivisions, hemisphere)["coords"]
 
 def write_pdb(coords, filename):
-    """Write 3D points to a PDB file."""
+    """Write 3D points to a PDB file (ATOM records only, like the lattice files written so far)."""
     with open(filename, "w") as pdb_file:
-        pdb_file.write("REMARK   Generated PDB of triangular lattice points on a sphere\n")
         for i, (x, y, z) in enumerate(coords, start=1):
-            pdb_file.write(f"ATOM  {i:5d}  C   SPH A   1    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           C\n")
-        pdb_file.write("TER\nEND\n")
-
-def remove_duplicate_atoms(input_file, output_file):
-    """Remove duplicate atom coordinates and renumber atoms sequentially."""
-    unique_coordinates = set()
-    unique_lines = []
-
-    with open(input_file, 'r') as infile:
-        for line in infile:
-            if line.startswith("ATOM"):
-                x = float(line[30:38].strip())
-                y = float(line[38:46].strip())
-                z = float(line[46:54].strip())
-                x, y, z = (0.0 if abs(coord) < 1e-6 else coord for coord in (x, y, z))
-                if (x, y, z) not in unique_coordinates:
-                    unique_coordinates.add((x, y, z))
-                    unique_lines.append(line)
-
-    with open(output_file, 'w') as outfile:
-        for i, line in enumerate(unique_lines, start=1):
-            new_line = f"{line[:6]}{i:5d}{line[11:]}"
-            outfile.write(new_line)
+            # serial numbers wrap after 99999 so the coordinate columns stay in place
+            pdb_file.write(f"ATOM  {i % 100000:5d}  C   SPH A   1    {x:8.3f}{y:8.3f}{z:8.3f}  1.00  0.00           C\n")
 
 # =============================
 # Main execution block
 # =============================
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Generate a triangular lattice (sphere or hemisphere) and remove duplicate points."
+        description="Generate a triangular lattice (sphere or hemisphere) with every point generated once."
     )
     parser.add_argument('-r', '--radius', type=float, required=True, help="Radius of the sphere")
     parser.add_argument('-s', '--subdivisions', type=int, required=True, help="Number of subdivisions per triangle")
     parser.add_argument('-o', '--output_name', type=str, required=True, help="Name of the final PDB output file")
     parser.add_argument('--hemisphere', action='store_true', default=False,
                         help="Generate only the upper hemisphere (z >= 0). Default: full sphere")
+    parser.add_argument('--binary', type=str, default=None,
+                        help="Also write full precision coordinates, triangles and neighbour lists to this .npz file")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Directory to cache lattices by radius, subdivisions and hemisphere")
 
     args = parser.parse_args()
 
-    temp_file = "temp_lattice.pdb"
-
     # Generate lattice
-    coords = triangular_lattice_on_sphere(args.radius, args.subdivisions, hemisphere=args.hemisphere)
-    write_pdb(coords, temp_file)
-
-    # Remove duplicates
-    remove_duplicate_atoms(temp_file, args.output_name)
-
-    # Clean up
-    if os.path.exists(temp_file):
-        os.remove(temp_file)
+    lattice = triangular_lattice(args.radius, args.subdivisions, args.hemisphere, args.cache)
+    coords = lattice["coords"]
+    # The PDB keeps the unit coordinates rounded to 8 decimals, so its 8.3f columns match the lattice files written so far
+    write_pdb(np.round(coords / args.radius, decimals=8) * args.radius, args.output_name)
+    if args.binary:
+        write_lattice(lattice, args.binary)
 
     print(f"\n✅ PDB file '{args.output_name}' created successfully.")
     print(f"   Radius: {args.radius}")
     print(f"   Subdivisions: {args.subdivisions}")
     print(f"   Hemisphere mode: {args.hemisphere}")
     print(f"   Total points generated: {len(coords)}")
-
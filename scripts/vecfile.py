@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import struct
+import numpy as np
+
+# Binary vector matrix (.vec):
+#   8 bytes   magic
+#   offset 64 N_rows x N_cols float32 matrix, row-major
+#   trailer   JSON with shape, snapshot ids, column blocks and metadata (lattice, cutoff, ...)
+#   8 bytes   offset of the trailer
+# The trailer is written last so rows can be streamed without knowing N_rows in advance,
+# and the matrix sits at a fixed offset so it can be memory-mapped.
+VEC_SUFFIX = ".vec"
+MAGIC = b"VECMAT\x00\x01"
+DATA_OFFSET = 64
+DTYPE = np.dtype("<f4")
+
+
+def is_vector_file(path):
+    """True if path is a binary vector matrix (checked by its magic bytes)."""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class VectorWriter:
+    """Stream rows (snapshot id + values) into a binary vector matrix."""
+
+    def __init__(self, path, metadata=None, blocks=None):
+        self.path = path
+        self.metadata = metadata or {}
+        self.blocks = blocks
+        self.ids = []
+        self.n_cols = None
+        self.file = open(path, "wb")
+        self.file.write(MAGIC.ljust(DATA_OFFSET, b"\x00"))
+
+    def write(self, snapshot_id, values):
+        values = np.asarray(values, dtype=DTYPE).ravel()
+        if self.n_cols is None:
+            self.n_cols = len(values)
+        elif len(values) != self.n_cols:
+            raise ValueError(f"Row {snapshot_id} has {len(values)} values, expected {self.n_cols}")
+        self.file.write(values.tobytes())
+        self.ids.append(str(snapshot_id))
+
+    def close(self):
+        if self.file.closed:
+            return
+        trailer = {
+            "shape": [len(self.ids), self.n_cols or 0],
+            "dtype": DTYPE.str,
+            "ids": self.ids,
+            "blocks": self.blocks or [["values", self.n_cols or 0]],
+            "metadata": self.metadata,
+        }
+        offset = self.file.tell()
+        self.file.write(json.dumps(trailer).encode())
+        self.file.write(struct.pack("<Q", offset))
+        self.file.close()
+
+    def abort(self):
+        """Close without a trailer and remove the file, so a failed run leaves no file that looks complete."""
+        if self.file.closed:
+            return
+        self.file.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class TextWriter:
+    """Same interface as VectorWriter for the space-separated text format."""
+
+    def __init__(self, path, fmt=None):
+        self.file = open(path, "w")
+        self.fmt = fmt
+
+    def write(self, snapshot_id, values):
+        if self.fmt:
+            values = [format(v, self.fmt) for v in values]
+        self.file.write(' '.join(map(str, [snapshot_id] + list(values))) + '\n')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_writer(path, metadata=None, blocks=None, fmt=None):
+    """Binary writer for *.vec paths, text writer (values formatted with fmt) otherwise."""
+    if path.endswith(VEC_SUFFIX):
+        return VectorWriter(path, metadata, blocks)
+    return TextWriter(path, fmt)
+
+
+def cutoff_paths(path, cutoffs):
+    """Output path per cutoff: path itself for a single cutoff, otherwise <name>_r<cutoff><ext>."""
+    if len(cutoffs) == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return [f"{root}_r{cutoff}{ext}" for cutoff in cutoffs]
+
+
+def read_vectors(path, mmap=True):
+    """
+    Open a binary vector matrix.
+
+    Returns:
+        ids (list of str), matrix (N_rows x N_cols float32, memory-mapped unless mmap=False),
+        info (dict with "blocks" and "metadata")
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a binary vector matrix")
+        f.seek(0, os.SEEK_END)
+        end = f.tell() - 8
+        if end < DATA_OFFSET:
+            raise ValueError(f"{path} is incomplete (no trailer)")
+        f.seek(end)
+        (offset,) = struct.unpack("<Q", f.read(8))
+        if not DATA_OFFSET <= offset <= end:
+            raise ValueError(f"{path} is incomplete (no trailer)")
+        f.seek(offset)
+        trailer = json.loads(f.read(end - offset))
+
+    shape = tuple(trailer["shape"])
+    if shape[0] == 0:
+        matrix = np.empty(shape, dtype=trailer["dtype"])
+    elif mmap:
+        matrix = np.memmap(path, dtype=trailer["dtype"], mode="r", offset=DATA_OFFSET, shape=shape)
+    else:
+        matrix = np.fromfile(path, dtype=trailer["dtype"], count=shape[0] * shape[1],
+                             offset=DATA_OFFSET).reshape(shape)
+    info = {"blocks": trailer["blocks"], "metadata": trailer["metadata"]}
+    return trailer["ids"], matrix, info
+
+
+def read_text(path):
+    """Read a space-separated matrix: snapshot id followed by values on every line."""
+    ids = []
+    rows = []
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            ids.append(parts[0])
+            rows.append(np.array(parts[1:], dtype=float))
+    matrix = np.array(rows) if rows else np.empty((0, 0))
+    return ids, matrix, {"blocks": [["values", matrix.shape[1]]], "metadata": {}}
+
+
+def load_vectors(path, mmap=True):
+    """Read a vector matrix in either format (binary detected by its magic bytes)."""
+    if is_vector_file(path):
+        return read_vectors(path, mmap)
+    return read_text(path)
+
+
+def iter_rows(path):
+    """Yield (snapshot id, values) one row at a time from either format."""
+    if is_vector_file(path):
+        ids, matrix, info = read_vectors(path)
+        for snapshot_id, row in zip(ids, matrix):
+            yield snapshot_id, row
+    else:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if parts:
+                    yield parts[0], np.array(parts[1:], dtype=float)
+
+
+def iter_batches(path, batch_rows=4096):
+    """Yield (ids, values) blocks of up to batch_rows rows from either format, so memory stays bounded."""
+    if is_vector_file(path):
+        ids, matrix, info = read_vectors(path)
+        for start in range(0, len(ids), batch_rows):
+            yield ids[start:start + batch_rows], np.asarray(matrix[start:start + batch_rows], dtype=float)
+        return
+    ids = []
+    rows = []
+    for snapshot_id, row in iter_rows(path):
+        ids.append(snapshot_id)
+        rows.append(row)
+        if len(rows) == batch_rows:
+            yield ids, np.array(rows)
+            ids, rows = [], []
+    if rows:
+        yield ids, np.array(rows)
+
+
+def read_info(path):
+    """Blocks and metadata of a vector matrix without loading the values (text files: one block)."""
+    if is_vector_file(path):
+        return read_vectors(path)[2]
+    for snapshot_id, row in iter_rows(path):
+        return {"blocks": [["values", len(row)]], "metadata": {}}
+    return {"blocks": [["values", 0]], "metadata": {}}
+
+
+if __name__ == "__main__":
+    # Convert between formats: python vecfile.py input output (.vec output = binary, anything else = text)
+    if len(sys.argv) != 3:
+        print("Usage: python vecfile.py <input.vec|input.txt> <output.txt|output.vec>")
+    else:
+        ids, matrix, info = load_vectors(sys.argv[1])
+        with open_writer(sys.argv[2], info["metadata"], info["blocks"]) as writer:
+            for snapshot_id, row in zip(ids, matrix):
+                writer.write(snapshot_id, row)
+        print(f"Converted {len(ids)} rows from {sys.argv[1]} to {sys.argv[2]}")
@@ -0,0 +1,208 @@
+import math
+import numpy as np
+import argparse
+import os
+from contextlib import ExitStack
+from raycast import DEFAULT_MAX_MEMORY, DEFAULT_SKIN, cast_cutoffs, file_method, ray_lengths
+from surface import read_pdb_coords
+from trajectory import load_universe, frame_numbers, frame_coords, frame_transform, site_for_args
+from topology import read_reference, topology_template, template_atoms
+from heme_frame import transforms_for_args
+from parallel import WORKER, map_ordered
+from vecfile import open_writer, cutoff_paths
+
+# Read the binding-site atoms of one PQR file in a single pass
+def read_atoms(name_file, radius_sphere, ref_map, radii="pqr"):
+    """
+    Parse a PQR file once and keep the atoms within radius_sphere + 2 of the origin.
+
+    radii="pqr" selects atoms like surface.py (z > -2, no HEM, radius from the
+    PQR radius column) and looks their charge up in ref_map (0.0 if missing).
+    radii="ref" selects atoms like charge.py (only atoms in ref_map, radius
+    and charge from the reference file).
+
+    Returns:
+        coords (array), atom_radii (array), charges (array), keys (list of (res_name, atom_name))
+    """
+    radius_limit = radius_sphere + 2
+    coords = []
+    atom_radii = []
+    charges = []
+    keys = []
+
+    with open(name_file, "r") as f:
+        for line in f:
+            if not line.startswith("ATOM"):
+                continue
+            x = float(line[30:38])
+            y = float(line[38:46])
+            z = float(line[46:53])
+            parts = line.split()
+            key = (parts[3].strip().upper(), parts[2].strip().upper())
+
+            if radii == "pqr":
+                if z <= -2 or line[17:20] in ["HEM"]:
+                    continue
+                radius = float(line[69:75])
+                charge = ref_map.get(key, (0.0, None))[0]
+            else:
+                if key not in ref_map:
+                    continue
+                charge, radius = ref_map[key]
+
+            if math.sqrt(x * x + y * y + z * z) < radius_limit:
+                coords.append([x, y, z])
+                atom_radii.append(radius)
+                charges.append(charge)
+                keys.append(key)
+
+    return np.array(coords).reshape(-1, 3), np.array(atom_radii), np.array(charges), keys
+
+# Lengths, charges and names of the hit atoms per cutoff from one ray cast
+def cavity(name_file, surface_coords, radii_sphere, ref_map, radii="pqr", max_memory=DEFAULT_MAX_MEMORY,
+           method="index", exact_geometry=False):
+    coords, atom_radii, charges, keys = read_atoms(name_file, max(radii_sphere), ref_map, radii)
+    return cavity_vectors(coords, atom_radii, charges, keys, surface_coords, radii_sphere, radii, max_memory, method,
+                          exact_geometry=exact_geometry)
+
+# Lengths, charges and names of the hit atoms per cutoff for atoms already filtered to the binding site (largest cutoff)
+def cavity_vectors(coords, atom_radii, charges, keys, surface_coords, radii_sphere, radii="pqr",
+                   max_memory=DEFAULT_MAX_MEMORY, method="index", ids=None, cache=None, exact_geometry=False):
+
+    # surface.py rounds the intersection geometry and rescales each vector to its hits (unless exact_geometry),
+    # charge.py does neither
+    decimals = 3 if radii == "pqr" else None
+    results = []
+    for radius_sphere, (t_near, hit_index, members) in zip(radii_sphere, cast_cutoffs(
+            surface_coords, coords, atom_radii, radii_sphere, decimals, max_memory, method, ids, cache,
+            sequential=radii == "pqr" and not exact_geometry)):
+        hit = hit_index != -1
+
+        distance_vectors = ray_lengths(t_near, radius_sphere)
+        hit_charges = np.where(hit, charges[hit_index] if len(charges) else 0.0, 0.0)
+        hit_atom_names = [keys[i][1] if i != -1 else "UNK" for i in hit_index]
+        hit_residue_names = [keys[i][0] if i != -1 else "UNK" for i in hit_index]
+        results.append((distance_vectors, hit_charges, hit_atom_names, hit_residue_names))
+
+    return results
+
+# Write one snapshot: name, lengths, charges to a vecfile writer (and RES-ATOM of each hit to names_file)
+def write_row(output_file, names_file, name, dist_vals, hit_charges, hit_atom_names, hit_residue_names):
+    output_file.write(name, np.concatenate([dist_vals, np.round(hit_charges, 4)]))
+    if names_file:
+        hits = [f"{res}-{atom}" for res, atom in zip(hit_residue_names, hit_atom_names)]
+        names_file.write(f"{name} " + ' '.join(hits) + "\n")
+
+
+# Per-worker state for --jobs: the parsed arguments, the reference map and, for --traj, the open trajectory and atom template
+def worker_setup(args):
+    state = {'args': args, 'ref_map': read_reference(args.ref)}
+    if args.traj:
+        universe = load_universe(args.top, args.traj)
+        state['universe'] = universe
+        template = topology_template(universe, args.top, args.ref, args.template_cache)
+        state['ray_cache'] = {"skin": args.skin}
+        state['template'] = template_atoms(template, args.radii)
+    return state
+
+# Snapshot name and cavity_vectors() results (one per cutoff) for a pqr file or trajectory frame, computed in a worker
+def snapshot_results(task):
+    args = WORKER['args']
+    surface_coords = WORKER['lattice']
+    max_memory = args.memory * 1024 ** 2
+    if args.traj:
+        indices, atom_radii, charges, keys = WORKER['template']
+        z_min = -2 if args.radii == "pqr" else None
+        coords, kept = frame_coords(WORKER['universe'], indices, task, max(args.radius), z_min=z_min,
+                                    transform=frame_transform(args.transforms, task),
+                                    site=args.site)
+        return task, cavity_vectors(coords, atom_radii[kept], charges[kept], [keys[i] for i in kept],
+                                    surface_coords, args.radius, args.radii, max_memory, args.method, kept,
+                                    WORKER['ray_cache'], args.exact_geometry)
+    base_name = os.path.splitext(os.path.basename(task))[0]
+    return base_name, cavity(task, surface_coords, args.radius, WORKER['ref_map'], args.radii, max_memory,
+                             file_method(args.method), args.exact_geometry)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calculate vector lengths and charges in one pass, in the combine.py layout.")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-n', '--name', nargs='+', type=str, help="Name of the pqr file(s)")
+    inputs.add_argument('-t', '--traj', type=str, help="Trajectory (e.g. XTC) in the heme frame (or use --heme_frame), instead of pqr files")
+    parser.add_argument('-s', '--top', type=str, help="Topology (GRO/PDB) for --traj")
+    parser.add_argument('--start', type=int, default=None, help="First frame for --traj")
+    parser.add_argument('--stop', type=int, default=None, help="Last frame (exclusive) for --traj")
+    parser.add_argument('--step', type=int, default=None, help="Frame stride for --traj")
+    parser.add_argument('--heme_frame', action='store_true',
+                        help="Put every frame of --traj in the heme frame on the fly (see heme_frame.py)")
+    parser.add_argument('--ranges', type=str, default=None,
+                        help="With --heme_frame: residue ranges to superpose every frame on the first one (e.g. '5-8,32-40')")
+    parser.add_argument('--frame_ref', type=str, default=None,
+                        help="With --heme_frame and --ranges: reference PDB (e.g. 4I3Q) the first frame is CE-aligned to")
+    parser.add_argument('--resn', type=str, default="HEM*", help="Heme residue name pattern for --heme_frame (default: HEM*)")
+    parser.add_argument('--template_cache', type=str, default=None,
+                        help="Directory to cache the per-topology atom template for --traj (reused by later runs and workers)")
+    parser.add_argument('--preselect', type=float, default=None, metavar='MARGIN',
+                        help="Pre-select the atoms that come within the cutoff + MARGIN (A) once per trajectory and only "
+                             "read those from every frame (--traj)")
+    parser.add_argument('--preselect_step', type=int, default=10, help="Frame stride of the --preselect pass (default: 10)")
+    parser.add_argument('-pdb', '--pdb', type=str, required=True, help="PDB file with surface coordinates")
+    parser.add_argument('-r', '--radius', type=int, nargs='+', required=True,
+                        help="Max sphere radius; several radii are computed in one pass, one output each")
+    parser.add_argument('--ref', type=str, required=True, help="Reference file with radii and charges")
+    parser.add_argument('-o', '--output', type=str, required=True, help="Output file: snapshot, lengths, then charges (*.vec for the binary vector format; "
+                             "<name>_r<radius> per radius for several radii, also for --names)")
+    parser.add_argument('--names', type=str, default=None, help="Optional output file with RES-ATOM of each hit")
+    parser.add_argument('--radii', choices=["pqr", "ref"], default="pqr",
+                        help="Atom selection and radii like surface.py (pqr: lengths match surface.py, charges differ "
+                             "from charge.py) or like charge.py (ref: charges match charge.py, lengths differ from "
+                             "surface.py)")
+    parser.add_argument('-m', '--memory', type=int, default=DEFAULT_MAX_MEMORY // 1024 ** 2, help="Memory budget for ray casting in MB")
+    parser.add_argument('--method', choices=["index", "dense", "incremental"], default="index",
+                        help="Ray casting method: cone index over lattice rays, all ray x atom pairs, or (--traj) the "
+                             "cone index with candidate lists reused between frames (pqr files use index) (with --radii ref or --exact_geometry)")
+    parser.add_argument('--skin', type=float, default=DEFAULT_SKIN,
+                        help=f"Skin (A) of the candidate lists of --method incremental (default: {DEFAULT_SKIN})")
+    parser.add_argument('--exact_geometry', action='store_true',
+                        help="With --radii pqr: cast fixed rays with --method instead of reproducing the loop of the "
+                             "original surface.py (see surface.py --exact_geometry)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of worker processes")
+    parser.add_argument('--chunksize', type=int, default=None, help="Files/frames sent to a worker at a time (default: automatic)")
+
+    args = parser.parse_args()
+    if args.traj and not args.top:
+        parser.error("--traj requires --top")
+    if args.heme_frame and not args.traj:
+        parser.error("--heme_frame requires --traj")
+    if len(set(args.radius)) != len(args.radius):
+        parser.error("-r/--radius values must be distinct")
+
+    surface_coords = read_pdb_coords(args.pdb)
+    if args.traj:
+        tasks = frame_numbers(load_universe(args.top, args.traj), args.start, args.stop, args.step)
+    else:
+        tasks = args.name
+    args.transforms = transforms_for_args(args, tasks) if args.traj else None
+    z_min = -2 if args.radii == "pqr" else None
+    args.site = site_for_args(args, tasks, args.radii, z_min) if args.traj else None
+
+    # Rows are written in input order; a failed file/frame is reported and skipped
+    failed = []
+    blocks = [["lengths", len(surface_coords)], ["charges", len(surface_coords)]]
+    with ExitStack() as stack:
+        output_files = [stack.enter_context(open_writer(path, {"lattice": args.pdb, "n_rays": len(surface_coords),
+                                                               "radius": radius, "radii": args.radii}, blocks))
+                        for radius, path in zip(args.radius, cutoff_paths(args.output, args.radius))]
+        names_files = [stack.enter_context(open(path, 'w')) if args.names else None
+                       for path in (cutoff_paths(args.names, args.radius) if args.names else args.radius)]
+        for task, result, error in map_ordered(snapshot_results, tasks, surface_coords, args.jobs, args.chunksize,
+                                               worker_setup, (args,)):
+            if error:
+                print(f"⚠️ Failed: {task}\n{error}")
+                failed.append(task)
+                continue
+            name, cutoff_results = result
+            for output_file, names_file, results in zip(output_files, names_files, cutoff_results):
+                write_row(output_file, names_file, name, *results)
+    if failed:
+        print(f"⚠️ {len(failed)} of {len(tasks)} inputs failed: {' '.join(map(str, failed))}")